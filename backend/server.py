@@ -1,31 +1,564 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request, Response
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, PlainTextResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers, MutableHeaders
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne, monitoring, timeout as mongo_timeout
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, NetworkTimeout, OperationFailure, PyMongoError, WaitQueueTimeoutError
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
 import os
+import sys
+import asyncio
+import threading
 import logging
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional
+from typing import Any, List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
+from zoneinfo import ZoneInfo
 import httpx
 import bcrypt
+import hashlib
+import bson
+import json
+import re
+import math
+import random
+import time
+import zlib
+import tempfile
+import unicodedata
+import base64
+import ipaddress
+import brotli
+import xlsxwriter
+import pandas as pd
+import pyarrow as pa
+import numpy as np
+from collections import OrderedDict, deque
+import heapq
+import itertools
+from functools import lru_cache
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
-
-app = FastAPI(title="HALIYOL API")
-api_router = APIRouter(prefix="/api")
-
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# ============== SETTINGS & DATABASE ==============
+
+class Settings(BaseModel):
+    mongo_url: str
+    db_name: str
+    max_pool_size: int = 100
+    min_pool_size: int = 0
+    max_idle_time_ms: Optional[int] = None
+    server_selection_timeout_ms: int = 5000
+    connect_timeout_ms: int = 10000
+    socket_timeout_ms: Optional[int] = None
+    compressors: Optional[str] = None  # örn. "zstd,snappy,zlib"
+    warm_pool: bool = True
+    # Endpoint sınıflarına göre okuma tercihi: işlem yolları primary'de kalır,
+    # rapor/istatistik/export sorguları secondary'lere yönlendirilir
+    transactional_read_concern: Optional[str] = None
+    analytics_read_preference: str = "secondaryPreferred"
+    analytics_max_staleness_s: int = 90
+    analytics_read_concern: Optional[str] = "local"
+    job_workers: int = 2
+    job_results_dir: str = str(ROOT_DIR / "job_results")
+    job_result_ttl_s: int = 3600
+    job_lease_s: int = 1800
+    job_poll_interval_s: float = 5.0
+    pool_resync_interval_s: float = 30.0
+    snapshot_dir: str = str(ROOT_DIR / "snapshots")
+    snapshot_batch_size: int = 50000
+    snapshot_watermark_lag_s: int = 300
+    propagation_chunk_size: int = 500
+    propagation_pause_s: float = 0.05
+    archive_after_days: int = 365
+    archive_batch_size: int = 1000
+    order_compaction_batch_size: int = 500
+    order_id_block_size: int = 100
+    company_cache_ttl_s: float = 30.0  # 0 = kapalı
+    rate_limit_backend: str = "memory"  # memory | mongo | off
+    max_in_flight_requests: int = 0  # 0 = sınırsız
+    load_shed_retry_after_s: int = 1
+    trusted_proxies: List[str] = []  # X-Forwarded-For'a güvenilen proxy IP/CIDR'ları, boş = başlık yok sayılır
+    compression_min_size: int = 1024  # 0 = kapalı
+    compression_offload_size: int = 256 * 1024
+    compression_gzip_level: int = 6
+    compression_brotli_quality: int = 4
+    notification_channel: str = "stub"  # stub | sms | whatsapp
+    sms_api_url: Optional[str] = None
+    sms_api_key: Optional[str] = None
+    sms_sender_id: Optional[str] = None
+    whatsapp_phone_number_id: Optional[str] = None
+    whatsapp_access_token: Optional[str] = None
+    outbox_batch_size: int = 100
+    outbox_poll_interval_s: float = 2.0
+    outbox_coalesce_window_s: float = 15.0
+    outbox_max_attempts: int = 6
+    outbox_backoff_base_s: float = 5.0
+    audit_batch_size: int = 200
+    audit_flush_interval_s: float = 1.0
+    audit_max_queue: int = 10000
+    profiling_enabled: bool = True
+    profiling_interval_ms: float = 5.0
+    profile_ttl_s: int = 7 * 24 * 3600
+    forecast_history_days: int = 182
+    forecast_ttl_s: float = 6 * 3600
+    loop_lag_interval_s: float = 0.5
+    ready_ping_timeout_ms: int = 1000
+    ready_max_ping_ms: float = 250.0
+    ready_max_checkout_wait_ms: float = 250.0  # 0 = kontrol edilmez
+    ready_max_loop_lag_ms: float = 250.0  # 0 = kontrol edilmez
+    ready_max_in_flight: int = 0  # 0 = kontrol edilmez
+    mongo_request_timeout_ms: int = 10000  # istek başına toplam Mongo süresi, 0 = sınırsız
+    mongo_analytics_timeout_ms: int = 60000  # tahmin, trend ve arama yolları için ayrı bütçe
+    oauth_session_url: str = "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data"
+    oauth_timeout_s: float = 5.0
+    breaker_failure_threshold: int = 5
+    breaker_reset_timeout_s: float = 10.0
+    public_settings_ttl_s: float = 60.0
+    cors_origins: List[str] = ["*"]
+
+    @classmethod
+    def from_env(cls, require_mongo: bool = True) -> "Settings":
+        # Veritabanı dışarıdan enjekte edildiyse MONGO_URL/DB_NAME zorunlu değildir
+        env = os.environ
+        return cls(
+            mongo_url=env['MONGO_URL'] if require_mongo else env.get('MONGO_URL', ''),
+            db_name=env['DB_NAME'] if require_mongo else env.get('DB_NAME', ''),
+            max_pool_size=int(env.get('MONGO_MAX_POOL_SIZE', 100)),
+            min_pool_size=int(env.get('MONGO_MIN_POOL_SIZE', 0)),
+            max_idle_time_ms=int(env['MONGO_MAX_IDLE_TIME_MS']) if env.get('MONGO_MAX_IDLE_TIME_MS') else None,
+            server_selection_timeout_ms=int(env.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+            connect_timeout_ms=int(env.get('MONGO_CONNECT_TIMEOUT_MS', 10000)),
+            socket_timeout_ms=int(env['MONGO_SOCKET_TIMEOUT_MS']) if env.get('MONGO_SOCKET_TIMEOUT_MS') else None,
+            compressors=env.get('MONGO_COMPRESSORS') or None,
+            warm_pool=env.get('MONGO_WARM_POOL', 'true').lower() in ('1', 'true', 'yes'),
+            transactional_read_concern=env.get('MONGO_TRANSACTIONAL_READ_CONCERN') or None,
+            analytics_read_preference=env.get('MONGO_ANALYTICS_READ_PREFERENCE', 'secondaryPreferred'),
+            analytics_max_staleness_s=int(env.get('MONGO_ANALYTICS_MAX_STALENESS_S', 90)),
+            analytics_read_concern=env.get('MONGO_ANALYTICS_READ_CONCERN', 'local') or None,
+            job_workers=int(env.get('JOB_WORKERS', 2)),
+            job_results_dir=env.get('JOB_RESULTS_DIR', str(ROOT_DIR / "job_results")),
+            job_result_ttl_s=int(env.get('JOB_RESULT_TTL_S', 3600)),
+            job_lease_s=int(env.get('JOB_LEASE_S', 1800)),
+            job_poll_interval_s=float(env.get('JOB_POLL_INTERVAL_S', 5)),
+            pool_resync_interval_s=float(env.get('POOL_RESYNC_INTERVAL_S', 30)),
+            snapshot_dir=env.get('SNAPSHOT_DIR', str(ROOT_DIR / "snapshots")),
+            snapshot_batch_size=int(env.get('SNAPSHOT_BATCH_SIZE', 50000)),
+            snapshot_watermark_lag_s=int(env.get('SNAPSHOT_WATERMARK_LAG_S', 300)),
+            propagation_chunk_size=int(env.get('PROPAGATION_CHUNK_SIZE', 500)),
+            propagation_pause_s=float(env.get('PROPAGATION_PAUSE_S', 0.05)),
+            archive_after_days=int(env.get('ARCHIVE_AFTER_DAYS', 365)),
+            archive_batch_size=int(env.get('ARCHIVE_BATCH_SIZE', 1000)),
+            order_compaction_batch_size=int(env.get('ORDER_COMPACTION_BATCH_SIZE', 500)),
+            order_id_block_size=int(env.get('ORDER_ID_BLOCK_SIZE', 100)),
+            company_cache_ttl_s=float(env.get('COMPANY_CACHE_TTL_S', 30)),
+            rate_limit_backend=env.get('RATE_LIMIT_BACKEND', 'memory'),
+            max_in_flight_requests=int(env.get('MAX_IN_FLIGHT_REQUESTS', 0)),
+            load_shed_retry_after_s=int(env.get('LOAD_SHED_RETRY_AFTER_S', 1)),
+            trusted_proxies=[p.strip() for p in env.get('TRUSTED_PROXIES', '').split(',') if p.strip()],
+            compression_min_size=int(env.get('COMPRESSION_MIN_SIZE', 1024)),
+            compression_offload_size=int(env.get('COMPRESSION_OFFLOAD_SIZE', 256 * 1024)),
+            compression_gzip_level=int(env.get('COMPRESSION_GZIP_LEVEL', 6)),
+            compression_brotli_quality=int(env.get('COMPRESSION_BROTLI_QUALITY', 4)),
+            notification_channel=env.get('NOTIFICATION_CHANNEL', 'stub'),
+            sms_api_url=env.get('SMS_API_URL') or None,
+            sms_api_key=env.get('SMS_API_KEY') or None,
+            sms_sender_id=env.get('SMS_SENDER_ID') or None,
+            whatsapp_phone_number_id=env.get('WHATSAPP_PHONE_NUMBER_ID') or None,
+            whatsapp_access_token=env.get('WHATSAPP_ACCESS_TOKEN') or None,
+            outbox_batch_size=int(env.get('OUTBOX_BATCH_SIZE', 100)),
+            outbox_poll_interval_s=float(env.get('OUTBOX_POLL_INTERVAL_S', 2)),
+            outbox_coalesce_window_s=float(env.get('OUTBOX_COALESCE_WINDOW_S', 15)),
+            outbox_max_attempts=int(env.get('OUTBOX_MAX_ATTEMPTS', 6)),
+            outbox_backoff_base_s=float(env.get('OUTBOX_BACKOFF_BASE_S', 5)),
+            audit_batch_size=int(env.get('AUDIT_BATCH_SIZE', 200)),
+            audit_flush_interval_s=float(env.get('AUDIT_FLUSH_INTERVAL_S', 1)),
+            audit_max_queue=int(env.get('AUDIT_MAX_QUEUE', 10000)),
+            profiling_enabled=env.get('PROFILING_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+            profiling_interval_ms=float(env.get('PROFILING_INTERVAL_MS', 5)),
+            profile_ttl_s=int(env.get('PROFILE_TTL_S', 7 * 24 * 3600)),
+            forecast_history_days=int(env.get('FORECAST_HISTORY_DAYS', 182)),
+            forecast_ttl_s=float(env.get('FORECAST_TTL_S', 6 * 3600)),
+            loop_lag_interval_s=float(env.get('LOOP_LAG_INTERVAL_S', 0.5)),
+            ready_ping_timeout_ms=int(env.get('READY_PING_TIMEOUT_MS', 1000)),
+            ready_max_ping_ms=float(env.get('READY_MAX_PING_MS', 250)),
+            ready_max_checkout_wait_ms=float(env.get('READY_MAX_CHECKOUT_WAIT_MS', 250)),
+            ready_max_loop_lag_ms=float(env.get('READY_MAX_LOOP_LAG_MS', 250)),
+            ready_max_in_flight=int(env.get('READY_MAX_IN_FLIGHT', 0)),
+            mongo_request_timeout_ms=int(env.get('MONGO_REQUEST_TIMEOUT_MS', 10000)),
+            mongo_analytics_timeout_ms=int(env.get('MONGO_ANALYTICS_TIMEOUT_MS', 60000)),
+            oauth_session_url=env.get('OAUTH_SESSION_DATA_URL', "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data"),
+            oauth_timeout_s=float(env.get('OAUTH_TIMEOUT_S', 5)),
+            breaker_failure_threshold=int(env.get('BREAKER_FAILURE_THRESHOLD', 5)),
+            breaker_reset_timeout_s=float(env.get('BREAKER_RESET_TIMEOUT_S', 10)),
+            public_settings_ttl_s=float(env.get('PUBLIC_SETTINGS_TTL_S', 60)),
+            cors_origins=env.get('CORS_ORIGINS', '*').split(','),
+        )
+
+class AppScope:
+    """Bir uygulama örneğine ait kaynaklar ve süreç içi durum. Lifespan içinde doldurulur;
+    aynı süreçte çalışan iki uygulama (ör. testler) bağlantı, önbellek ve worker paylaşmaz."""
+
+    def __init__(self):
+        self.app_settings: Optional[Settings] = None
+        self.client: Optional[AsyncIOMotorClient] = None
+        self.db: Any = None
+        self.analytics_db: Any = None
+        self.job_runner = None
+        self.rate_limiter = None
+        self.propagation_worker = None
+        self.order_id_allocator = None
+        self.outbox_dispatcher = None
+        self.audit_log = None
+        self.demand_forecaster = None
+        self.loop_lag_monitor = None
+        self.index_task: Optional[asyncio.Task] = None
+        self.mongo_breaker = None
+        self.oauth_breaker = None
+        self.pool_stats = PoolStatsListener()
+        self.order_pool = OrderPool()
+        self.company_cache = CompanyProfileCache()
+        self.public_settings_cache: dict = {}  # value, expires_at
+        self.email_keys_migrated = False
+        self.email_migration_checked_at = 0.0
+        self.in_flight_requests = 0
+        self.outbox_transactions_supported = True
+        self.missing_unique_indexes: List[str] = []
+
+# İstek ve arka plan görevleri kendi uygulamasının kapsamını görür (AppScopeMiddleware ve lifespan
+# ayarlar). İstek dışından yapılan çağrılar (betikler, testler) son başlatılan uygulamayı kullanır.
+current_app_scope: ContextVar[Optional[AppScope]] = ContextVar("current_app_scope", default=None)
+_fallback_scope: Optional[AppScope] = None
+
+def active_scope() -> AppScope:
+    global _fallback_scope
+    scope = current_app_scope.get()
+    if scope is None:
+        if _fallback_scope is None:
+            _fallback_scope = AppScope()
+        scope = _fallback_scope
+    return scope
+
+class ScopedResource:
+    """Modül düzeyindeki adı etkin uygulamanın kaynağına yönlendirir; kod `db.orders` gibi
+    global adlarla yazılmaya devam eder. Kaynak henüz kurulmadıysa nesne False değerlidir."""
+    __slots__ = ("_name",)
+
+    def __init__(self, name: str):
+        object.__setattr__(self, "_name", name)
+
+    def _target(self):
+        return getattr(active_scope(), self._name)
+
+    def __getattr__(self, item):
+        return getattr(self._target(), item)
+
+    def __getitem__(self, key):
+        return self._target()[key]
+
+    def __setitem__(self, key, value):
+        self._target()[key] = value
+
+    def __bool__(self):
+        return self._target() is not None
+
+    def __repr__(self):
+        return f"<scoped {self._name}: {self._target()!r}>"
+
+class AppScopeMiddleware:
+    """En dış katman: isteği, onu karşılayan uygulamanın kapsamına bağlar."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        app_scope = getattr(scope["app"].state, "scope", None) if "app" in scope else None
+        if app_scope is None:
+            await self.app(scope, receive, send)
+            return
+        token = current_app_scope.set(app_scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_app_scope.reset(token)
+
+app_settings: Any = ScopedResource("app_settings")
+client: Any = ScopedResource("client")
+db: Any = ScopedResource("db")  # işlem (transactional) yolları - primary
+analytics_db: Any = ScopedResource("analytics_db")  # rapor, istatistik ve export yolları
+
+READ_PREFERENCE_MODES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+def build_read_preference(mode: str, max_staleness_s: int):
+    if mode not in READ_PREFERENCE_MODES:
+        raise ValueError(f"Unknown read preference: {mode}")
+    if mode == "primary":
+        return Primary()
+    # MongoDB maxStalenessSeconds için en az 90 saniye ister; -1 sınırsız demektir
+    if max_staleness_s != -1 and max_staleness_s < 90:
+        raise ValueError("maxStalenessSeconds must be at least 90")
+    return READ_PREFERENCE_MODES[mode](max_staleness=max_staleness_s)
+
+def build_database_handles(mongo_client: AsyncIOMotorClient, settings: Settings):
+    base = mongo_client[settings.db_name]
+    transactional = base.with_options(
+        read_preference=Primary(),
+        read_concern=ReadConcern(settings.transactional_read_concern),
+    )
+    analytics = base.with_options(
+        read_preference=build_read_preference(settings.analytics_read_preference, settings.analytics_max_staleness_s),
+        read_concern=ReadConcern(settings.analytics_read_concern),
+    )
+    return transactional, analytics
+
+def create_mongo_client(settings: Settings, pool_listener: Optional[monitoring.ConnectionPoolListener] = None) -> AsyncIOMotorClient:
+    options = {
+        "maxPoolSize": settings.max_pool_size,
+        "minPoolSize": settings.min_pool_size,
+        "serverSelectionTimeoutMS": settings.server_selection_timeout_ms,
+        "connectTimeoutMS": settings.connect_timeout_ms,
+    }
+    if settings.max_idle_time_ms is not None:
+        options["maxIdleTimeMS"] = settings.max_idle_time_ms
+    if settings.socket_timeout_ms is not None:
+        options["socketTimeoutMS"] = settings.socket_timeout_ms
+    if settings.compressors:
+        options["compressors"] = settings.compressors
+    options["event_listeners"] = [pool_listener] if pool_listener is not None else []
+    if settings.profiling_enabled:
+        options["event_listeners"].append(ProfilingCommandListener())
+    return AsyncIOMotorClient(settings.mongo_url, **options)
+
+async def warm_mongo_pool(mongo_client: AsyncIOMotorClient, settings: Settings):
+    # minPoolSize kadar bağlantıyı eşzamanlı ping ile önceden aç
+    try:
+        await asyncio.gather(*[mongo_client.admin.command("ping") for _ in range(max(1, settings.min_pool_size))])
+        logger.info("MongoDB pool warmed with %d connection(s)", max(1, settings.min_pool_size))
+    except PyMongoError as e:
+        # Mongo erişilemezse uygulama yine de açılır, bağlantı ilk istekte denenir
+        logger.warning("MongoDB pool warm-up failed: %s", e)
+
+TURKISH_CI_COLLATION = {"locale": "tr", "strength": 2}
+EMAIL_COLLATION = {"locale": "en", "strength": 2}
+
+# (koleksiyon, anahtarlar, seçenekler)
+INDEX_SPECS = [
+    ("jobs", [("dedupe_key", 1), ("created_at", -1)], {}),
+    ("jobs", [("status", 1), ("created_at", 1)], {}),
+    ("jobs", "job_id", {"unique": True}),
+    ("rate_limits", "expires_at", {"expireAfterSeconds": 0}),
+    ("profiles", "profile_id", {"unique": True}),
+    ("profiles", "expires_at", {"expireAfterSeconds": 0}),
+    ("propagations", [("status", 1), ("created_at", 1)], {}),
+    ("slots", "slot_id", {"unique": True}),
+    ("slots", [("company_id", 1), ("start", 1)], {"unique": True}),
+    # Şehir + hafta müsaitlik sorgusu
+    ("slots", [("city", 1), ("start", 1)], {}),
+    ("propagations", "task_id", {"unique": True}),
+    ("outbox", [("status", 1), ("next_attempt_at", 1)], {}),
+    ("audit_log", "audit_id", {"unique": True}),
+    # Denetim kaydı; (at, audit_id) sıralaması imleçli sayfalamayı index'ten karşılar.
+    # target_id tek başına sorgulanmaz, her zaman target_type ile birlikte verilir
+    ("audit_log", [("actor_id", 1), ("at", -1), ("audit_id", -1)], {}),
+    ("audit_log", [("target_type", 1), ("target_id", 1), ("at", -1), ("audit_id", -1)], {}),
+    ("audit_log", [("action", 1), ("at", -1), ("audit_id", -1)], {}),
+    ("audit_log", [("at", -1), ("audit_id", -1)], {}),
+    ("outbox", "claim_id", {"sparse": True}),
+    ("outbox", [("order_id", 1), ("created_at", -1)], {}),
+    # Penceresi dolmamış kardeş mesajlar aynı partiye çekilir; gönderilen satırlar 30 gün sonra silinir
+    # (sent_at BSON date olarak yazılır, TTL string değerleri yok sayar)
+    ("outbox", [("coalesce_key", 1), ("status", 1)], {}),
+    ("outbox", "sent_at", {"expireAfterSeconds": 30 * 24 * 3600}),
+    ("users", "email_key", {"unique": True, "collation": EMAIL_COLLATION, "partialFilterExpression": {"email_key": {"$exists": True}}, "name": "email_key_ci"}),
+    # Migration bitene kadar anahtarı olmayan eski kayıtlar aynı collation ile `email` üzerinden bulunur.
+    # partialFilterExpression `$exists: false` kabul etmediği için index tüm kullanıcıları kapsar;
+    # anahtar koşulu sorguda kalır
+    ("users", "email", {"collation": EMAIL_COLLATION, "name": "email_ci"}),
+    ("orders", "customer_id", {}),
+    # Sipariş numarası tekilliği; eski rastgele ID'lerde çakışma varsa oluşturulamaz, `dedupe_order_ids` işi giderir
+    ("orders", "order_id", {"unique": True}),
+    # Admin sipariş araması; (created_at, order_id) sıralaması imleçli sayfalamayı index'ten karşılar
+    ("orders", [("customer_phone", 1), ("created_at", -1), ("order_id", -1)], {}),
+    ("orders", [("customer_name", 1), ("created_at", -1)], {"collation": TURKISH_CI_COLLATION, "name": "customer_name_tr_ci"}),
+    ("orders", [("city", 1), ("district", 1), ("status", 1), ("created_at", -1), ("order_id", -1)], {}),
+    ("orders", [("company_id", 1), ("status", 1), ("created_at", -1), ("order_id", -1)], {}),
+    ("orders", [("status", 1), ("created_at", -1), ("order_id", -1)], {}),
+    ("orders", [("customer_name", "text"), ("customer_address", "text"), ("special_notes", "text")], {"default_language": "turkish", "name": "orders_text"}),
+    # Raporlar, snapshot ve arşiv
+    ("orders", [("status", 1), ("delivery_date", 1), ("company_id", 1)], {}),
+    ("orders", "updated_at", {}),
+    ("orders", [("status", 1), ("cancelled_at", 1)], {}),
+    ("orders_archive", "order_id", {"unique": True}),
+    ("orders_archive", [("status", 1), ("delivery_date", 1), ("company_id", 1)], {}),
+    # Sipariş listeleri ve arama arşivi de okur
+    ("orders_archive", [("customer_id", 1), ("created_at", -1)], {}),
+    ("orders_archive", [("company_id", 1), ("status", 1), ("created_at", -1), ("order_id", -1)], {}),
+    ("orders_archive", [("customer_phone", 1), ("created_at", -1), ("order_id", -1)], {}),
+    ("orders_archive", [("customer_name", 1), ("created_at", -1)], {"collation": TURKISH_CI_COLLATION, "name": "customer_name_tr_ci"}),
+    ("orders_archive", [("city", 1), ("district", 1), ("status", 1), ("created_at", -1), ("order_id", -1)], {}),
+    ("orders_archive", [("created_at", -1), ("order_id", -1)], {}),
+    ("orders_archive", [("customer_name", "text"), ("customer_address", "text"), ("special_notes", "text")], {"default_language": "turkish", "name": "orders_text"}),
+    ("order_fanout", [("order_id", 1), ("company_id", 1)], {"unique": True}),
+]
+
+# Yerine daha geniş bir index konmuş, artık kullanılmayan index'ler (koleksiyon, index adı)
+RETIRED_INDEXES = [
+    ("orders", "customer_phone_1_created_at_-1"),
+    ("orders", "city_1_district_1_status_1_created_at_-1"),
+    ("orders", "company_id_1_status_1_created_at_-1"),
+    ("orders", "status_1_created_at_-1"),
+    ("audit_log", "actor_id_1_at_-1"),
+    ("audit_log", "target_type_1_target_id_1_at_-1"),
+    ("audit_log", "action_1_at_-1"),
+    ("audit_log", "at_-1"),
+]
+
+def index_label(collection: str, keys) -> str:
+    return f"{collection}." + (keys if isinstance(keys, str) else ",".join(str(key[0]) for key in keys))
+
+async def ensure_indexes(specs: Optional[list] = None):
+    # Her index ayrı denenir; biri başarısız olursa diğerleri yine oluşturulur. Kurulamayan unique
+    # index'ler (ör. mevcut çakışan ID'ler) readiness yanıtında raporlanır; çakışmalar
+    # `dedupe_order_ids` işiyle giderilince o iş index'i yeniden kurar
+    scope = active_scope()
+    for collection, keys, options in specs or INDEX_SPECS:
+        label = index_label(collection, keys)
+        try:
+            await db[collection].create_index(keys, **options)
+        except PyMongoError as e:
+            logger.log(logging.ERROR if options.get("unique") else logging.WARNING, "Index creation failed on %s: %s", label, e)
+            if options.get("unique") and label not in scope.missing_unique_indexes:
+                scope.missing_unique_indexes.append(label)
+        else:
+            if label in scope.missing_unique_indexes:
+                scope.missing_unique_indexes.remove(label)
+    if specs:
+        return
+    # Eskiler, yerlerine geçen index'ler kurulduktan sonra kaldırılır
+    for collection, name in RETIRED_INDEXES:
+        try:
+            await db[collection].drop_index(name)
+        except PyMongoError:
+            pass  # index zaten yok
+
+# Mongo erişilemezken index bakımının yeniden deneme aralığı
+INDEX_RETRY_S = 30
+
+async def maintain_indexes():
+    """Index bakımı açılışı bekletmez, arka planda çalışır. Mongo erişilemezken her create_index sunucu
+    seçimi süresi kadar bekleyeceğinden önce ping atılır; cevap yoksa aralıklarla yeniden denenir."""
+    while True:
+        try:
+            await db.command("ping")
+        except PyMongoError as e:
+            logger.warning("Index maintenance postponed, MongoDB unavailable: %s", e)
+            await asyncio.sleep(INDEX_RETRY_S)
+            continue
+        await ensure_indexes()
+        return
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _fallback_scope
+    # Bu uygulamanın kaynakları kendi kapsamında tutulur; lifespan'de başlatılan görevler bağlamı devralır
+    scope = app.state.scope = AppScope()
+    current_app_scope.set(scope)
+    _fallback_scope = scope
+    scope.app_settings = app.state.settings or Settings.from_env(require_mongo=app.state.database is None)
+    # Hatalı TRUSTED_PROXIES ilk istekte değil açılışta hata verir
+    parse_trusted_proxies(tuple(app_settings.trusted_proxies))
+    if app.state.database is not None:
+        scope.db = scope.analytics_db = app.state.database
+    else:
+        scope.client = create_mongo_client(app_settings, scope.pool_stats)
+        scope.db, scope.analytics_db = build_database_handles(scope.client, app_settings)
+        if app_settings.warm_pool:
+            await warm_mongo_pool(scope.client, app_settings)
+    
+    scope.index_task = asyncio.create_task(maintain_indexes())
+    try:
+        await load_email_migration_state()
+    except PyMongoError as e:
+        logger.warning("Email migration state could not be loaded: %s", e)
+    scope.mongo_breaker = CircuitBreaker("mongo", app_settings.breaker_failure_threshold, app_settings.breaker_reset_timeout_s)
+    scope.oauth_breaker = CircuitBreaker("oauth", app_settings.breaker_failure_threshold, app_settings.breaker_reset_timeout_s)
+    scope.demand_forecaster = DemandForecaster(app_settings.forecast_ttl_s)
+    scope.loop_lag_monitor = LoopLagMonitor(app_settings.loop_lag_interval_s)
+    await loop_lag_monitor.start()
+    scope.audit_log = AuditLog(app_settings.audit_batch_size, app_settings.audit_flush_interval_s, app_settings.audit_max_queue)
+    await audit_log.start()
+    scope.order_id_allocator = OrderIdAllocator(app_settings.order_id_block_size)
+    if app_settings.rate_limit_backend == "mongo":
+        scope.rate_limiter = MongoRateLimiter()
+    elif app_settings.rate_limit_backend == "memory":
+        scope.rate_limiter = InMemoryRateLimiter()
+    scope.job_runner = JobRunner(
+        workers=app_settings.job_workers,
+        results_dir=Path(app_settings.job_results_dir),
+        result_ttl_s=app_settings.job_result_ttl_s,
+        lease_s=app_settings.job_lease_s,
+        poll_interval_s=app_settings.job_poll_interval_s,
+    )
+    await job_runner.start()
+    scope.propagation_worker = PropagationWorker(
+        chunk_size=app_settings.propagation_chunk_size,
+        pause_s=app_settings.propagation_pause_s,
+        lease_s=app_settings.job_lease_s,
+        poll_interval_s=app_settings.job_poll_interval_s,
+    )
+    await propagation_worker.start()
+    scope.outbox_dispatcher = OutboxDispatcher(
+        senders=build_notification_senders(app_settings),
+        batch_size=app_settings.outbox_batch_size,
+        poll_interval_s=app_settings.outbox_poll_interval_s,
+        max_attempts=app_settings.outbox_max_attempts,
+        backoff_base_s=app_settings.outbox_backoff_base_s,
+        lease_s=OUTBOX_LEASE_S,
+    )
+    await outbox_dispatcher.start()
+    try:
+        await order_pool.load()
+    except PyMongoError as e:
+        logger.warning("Order pool initial load failed: %s", e)
+    pool_resync_task = asyncio.create_task(order_pool.resync_forever(app_settings.pool_resync_interval_s))
+    try:
+        yield
+    finally:
+        pool_resync_task.cancel()
+        scope.index_task.cancel()
+        await loop_lag_monitor.stop()
+        await outbox_dispatcher.stop()
+        await propagation_worker.stop()
+        await job_runner.stop()
+        # Kapanışta bekleyen denetim kayıtları bağlantı kapanmadan yazılır
+        await audit_log.stop()
+        if scope.client is not None:
+            scope.client.close()
+            scope.client = None
+        if _fallback_scope is scope:
+            _fallback_scope = None
+
+api_router = APIRouter(prefix="/api")
+
 # ============== MODELS ==============
 
 class UserCreate(BaseModel):
@@ -64,6 +597,15 @@ class OrderCreate(BaseModel):
     district: str
     address: str
     phone: str
+    slot_id: Optional[str] = None  # seçilirse sipariş slotun firmasına doğrudan atanır
+
+class SlotCreate(BaseModel):
+    start: datetime
+    end: datetime
+    capacity_m2: float
+
+class SlotPublish(BaseModel):
+    slots: List[SlotCreate]
 
 class OrderStatusUpdate(BaseModel):
     status: str
@@ -94,6 +636,55 @@ TURKEY_LOCATIONS = {
     "Kayseri": ["Melikgazi", "Kocasinan", "Talas", "Hacılar", "İncesu"],
 }
 
+# İlçe merkezlerinin yaklaşık (enlem, boylam) değerleri; rota planlamada çevrimdışı geocoding için kullanılır
+DISTRICT_CENTROIDS = {
+    "İstanbul": {
+        "Kadıköy": (40.990, 29.029), "Beşiktaş": (41.043, 29.007), "Üsküdar": (41.023, 29.015), "Fatih": (41.019, 28.940),
+        "Bakırköy": (40.980, 28.872), "Şişli": (41.060, 28.987), "Beyoğlu": (41.037, 28.977), "Maltepe": (40.935, 29.130),
+        "Ataşehir": (40.983, 29.127), "Kartal": (40.889, 29.190), "Pendik": (40.877, 29.235), "Tuzla": (40.816, 29.300),
+        "Sarıyer": (41.167, 29.050), "Beylikdüzü": (40.982, 28.640), "Esenyurt": (41.034, 28.677), "Küçükçekmece": (41.000, 28.780),
+        "Bağcılar": (41.039, 28.857), "Bahçelievler": (41.000, 28.862), "Güngören": (41.020, 28.873), "Esenler": (41.043, 28.876),
+    },
+    "Ankara": {
+        "Çankaya": (39.900, 32.860), "Keçiören": (39.980, 32.867), "Mamak": (39.925, 32.915), "Yenimahalle": (39.970, 32.810),
+        "Etimesgut": (39.947, 32.670), "Sincan": (39.968, 32.582), "Altındağ": (39.945, 32.880), "Pursaklar": (40.037, 32.900),
+        "Gölbaşı": (39.790, 32.805), "Polatlı": (39.584, 32.147),
+    },
+    "İzmir": {
+        "Konak": (38.418, 27.128), "Karşıyaka": (38.460, 27.110), "Bornova": (38.470, 27.215), "Buca": (38.388, 27.175),
+        "Bayraklı": (38.462, 27.165), "Çiğli": (38.494, 27.068), "Gaziemir": (38.322, 27.130), "Balçova": (38.390, 27.050),
+        "Narlıdere": (38.392, 27.000), "Karabağlar": (38.380, 27.115),
+    },
+    "Bursa": {
+        "Osmangazi": (40.195, 29.060), "Nilüfer": (40.215, 28.980), "Yıldırım": (40.190, 29.095), "Gürsu": (40.215, 29.190),
+        "Kestel": (40.198, 29.213), "Mudanya": (40.375, 28.883), "Gemlik": (40.432, 29.155), "İnegöl": (40.078, 29.510),
+    },
+    "Antalya": {
+        "Muratpaşa": (36.885, 30.710), "Kepez": (36.935, 30.710), "Konyaaltı": (36.870, 30.640), "Aksu": (36.950, 30.840),
+        "Döşemealtı": (37.020, 30.600), "Alanya": (36.544, 31.999), "Manavgat": (36.787, 31.443), "Serik": (36.917, 31.100),
+    },
+    "Adana": {
+        "Seyhan": (36.990, 35.320), "Yüreğir": (36.990, 35.360), "Çukurova": (37.040, 35.280), "Sarıçam": (37.050, 35.400),
+        "Ceyhan": (37.025, 35.817), "Kozan": (37.455, 35.815),
+    },
+    "Konya": {
+        "Selçuklu": (37.900, 32.480), "Meram": (37.850, 32.440), "Karatay": (37.875, 32.520), "Çumra": (37.573, 32.775),
+        "Akşehir": (38.357, 31.416), "Ereğli": (37.513, 34.047),
+    },
+    "Gaziantep": {
+        "Şahinbey": (37.060, 37.380), "Şehitkamil": (37.085, 37.360), "Oğuzeli": (36.965, 37.510), "Nizip": (37.010, 37.795),
+        "İslahiye": (37.025, 36.632),
+    },
+    "Mersin": {
+        "Mezitli": (36.750, 34.530), "Yenişehir": (36.790, 34.590), "Toroslar": (36.830, 34.610), "Akdeniz": (36.810, 34.650),
+        "Tarsus": (36.917, 34.895), "Erdemli": (36.605, 34.308),
+    },
+    "Kayseri": {
+        "Melikgazi": (38.720, 35.500), "Kocasinan": (38.740, 35.460), "Talas": (38.690, 35.555), "Hacılar": (38.645, 35.450),
+        "İncesu": (38.622, 35.185),
+    },
+}
+
 CARPET_PRICES = {
     "normal": 100,
     "shaggy": 130,
@@ -104,6 +695,15 @@ CARPET_PRICES = {
 # ============== AUTH HELPERS ==============
 
 async def get_current_user(request: Request) -> dict:
+    # Aynı istek içinde ikinci çağrı oturum ve kullanıcı sorgularını tekrarlamaz
+    cached = getattr(request.state, "current_user", None)
+    if cached is not None:
+        return cached
+    user = await load_session_user(request)
+    request.state.current_user = user
+    return user
+
+async def load_session_user(request: Request) -> dict:
     session_token = request.cookies.get("session_token")
     if not session_token:
         auth_header = request.headers.get("Authorization")
@@ -133,12 +733,829 @@ async def get_current_user(request: Request) -> dict:
     
     return user
 
+def require_role(*roles: str, detail: str = "Access denied"):
+    """Rolü `roles` içinde olmayan kullanıcıyı 403 ile reddeden dependency üretir."""
+    async def dependency(user: dict = Depends(get_current_user)) -> dict:
+        if user["role"] not in roles:
+            raise HTTPException(status_code=403, detail=detail)
+        return user
+    return dependency
+
+require_admin = require_role("admin", detail="Admin access required")
+require_company = require_role("company", detail="Not a company account")
+
+class CompanyProfileCache:
+    """user_id -> firma profili; kısa TTL ile tutulur, onay/red/güncelleme olaylarında silinir."""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, user_id: str) -> Optional[dict]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        expires_at, company = entry
+        if expires_at < time.monotonic():
+            self._entries.pop(user_id, None)
+            return None
+        self._entries.move_to_end(user_id)
+        return company
+
+    def put(self, user_id: str, company: dict, ttl_s: float):
+        if ttl_s <= 0:
+            return
+        self._entries[user_id] = (time.monotonic() + ttl_s, company)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: Optional[str]):
+        if user_id:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+company_cache: Any = ScopedResource("company_cache")
+
+async def get_company_profile_cached(user_id: str) -> Optional[dict]:
+    company = company_cache.get(user_id)
+    if company is None:
+        company = await db.companies.find_one({"user_id": user_id}, {"_id": 0})
+        if company is not None:
+            company_cache.put(user_id, company, app_settings.company_cache_ttl_s if app_settings else 0)
+    # Çağıranlar sonucu değiştirebilir; önbellekteki kopya paylaşılmaz
+    return dict(company) if company is not None else None
+
+async def get_current_company(request: Request, user: dict = Depends(require_company)) -> dict:
+    cached = getattr(request.state, "current_company", None)
+    if cached is not None:
+        return cached
+    company = await get_company_profile_cached(user["user_id"])
+    if not company:
+        raise HTTPException(status_code=404, detail="Company profile not found")
+    request.state.current_company = company
+    return company
+
+async def get_current_company_if_any(request: Request, user: dict = Depends(get_current_user)) -> Optional[dict]:
+    # Birden fazla role açık uç noktalar için: firma hesabında profili döner, diğer rollerde None
+    if user["role"] != "company":
+        return None
+    return await get_current_company(request, user)
+
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
 
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode(), hashed.encode())
 
+# E-posta kimliği: `email` kullanıcının yazdığı biçimde saklanır, aramalar `email_key` üzerinden yapılır.
+# Index büyük/küçük harf duyarsız collation ile unique'tir; henüz anahtarı olmayan eski kayıtlar
+# partial filtre sayesinde index'e girmez ve migration tamamlanana kadar `email` üzerinden aynı
+# collation ile (büyük/küçük harf duyarsız) bulunur.
+EMAIL_MIGRATION_RECHECK_S = 30
+
+def normalize_email(email: str) -> str:
+    return unicodedata.normalize("NFKC", email).strip().lower()
+
+async def find_user_by_email(email: str, projection: Optional[dict] = None) -> Optional[dict]:
+    projection = projection or {"_id": 0}
+    user = await db.users.find_one({"email_key": normalize_email(email)}, projection, collation=EMAIL_COLLATION)
+    if user is None and not await email_keys_migrated():
+        user = await db.users.find_one({"email": email.strip(), "email_key": {"$exists": False}}, projection, collation=EMAIL_COLLATION)
+    return user
+
+async def load_email_migration_state():
+    scope = active_scope()
+    state = await db.migrations.find_one({"_id": "email_keys"})
+    scope.email_keys_migrated = bool(state and state.get("completed_at"))
+    scope.email_migration_checked_at = time.monotonic()
+
+async def email_keys_migrated() -> bool:
+    # Migration başka bir worker'da tamamlanmış olabilir; bayrak kapalıyken durum aralıklarla yeniden okunur
+    scope = active_scope()
+    if not scope.email_keys_migrated and time.monotonic() - scope.email_migration_checked_at >= EMAIL_MIGRATION_RECHECK_S:
+        await load_email_migration_state()
+    return scope.email_keys_migrated
+
+async def run_email_key_migration(batch_size: int) -> dict:
+    """Anahtarı olmayan kullanıcılara `email_key` yazar. Aynı anahtara düşen ikinci ve sonraki
+    hesaplar yazılmaz, birleştirme kararı admin'e bırakılır ve raporda gruplanarak döner.
+    Çakışma olmadan biterse migration tamamlandı işaretlenir ve eski tam eşleşme araması kapanır."""
+    scanned, updated, batches = 0, 0, 0
+    duplicates: dict = {}  # email_key -> [{user_id, email}]
+    last_id = None
+    
+    def add_duplicate(key: str, holder: Optional[dict], user: dict):
+        group = duplicates.setdefault(key, [])
+        for entry in ([holder] if holder else []) + [user]:
+            if not any(e["user_id"] == entry["user_id"] for e in group):
+                group.append({"user_id": entry["user_id"], "email": entry.get("email")})
+    
+    while True:
+        query = {"email_key": {"$exists": False}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        users = await db.users.find(query, {"_id": 1, "user_id": 1, "email": 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not users:
+            break
+        last_id = users[-1]["_id"]
+        scanned += len(users)
+        batches += 1
+        
+        keyed = [(normalize_email(u["email"]), u) for u in users if u.get("email")]
+        holders = {
+            doc["email_key"]: doc
+            async for doc in db.users.find({"email_key": {"$in": [key for key, _ in keyed]}}, {"_id": 0, "user_id": 1, "email": 1, "email_key": 1}, collation=EMAIL_COLLATION)
+        }
+        operations, pending = [], []
+        for key, user in keyed:
+            if key in holders:
+                add_duplicate(key, holders[key], user)
+                continue
+            holders[key] = user
+            operations.append(UpdateOne({"_id": user["_id"], "email_key": {"$exists": False}}, {"$set": {"email_key": key}}))
+            pending.append((key, user))
+        if operations:
+            try:
+                result = await db.users.bulk_write(operations, ordered=False)
+                updated += result.modified_count
+            except BulkWriteError as e:
+                # Bu arada aynı anahtarla kayıt olmuş bir hesap varsa unique index reddeder
+                updated += e.details.get("nModified", 0)
+                for error in e.details.get("writeErrors", []):
+                    key, user = pending[error["index"]]
+                    holder = await db.users.find_one({"email_key": key}, {"_id": 0, "user_id": 1, "email": 1}, collation=EMAIL_COLLATION)
+                    add_duplicate(key, holder, user)
+        await asyncio.sleep(0)
+    
+    report = {
+        "scanned": scanned,
+        "updated": updated,
+        "batches": batches,
+        "duplicate_groups": len(duplicates),
+        "duplicates": [{"email_key": key, "users": users} for key, users in sorted(duplicates.items())],
+    }
+    if not duplicates:
+        await db.migrations.update_one({"_id": "email_keys"}, {"$set": {"completed_at": datetime.now(timezone.utc).isoformat()}}, upsert=True)
+        active_scope().email_keys_migrated = True
+    return report
+
+# ============== RATE LIMITING & LOAD SHEDDING ==============
+
+# policy -> {anahtar türü: (kova kapasitesi, pencere saniyesi)}; kova kapasite/pencere hızında dolar
+RATE_LIMIT_POLICIES = {
+    "login": {"ip": (20, 60), "email": (5, 60)},
+    "register": {"ip": (5, 60), "email": (3, 300)},
+    "pricing": {"ip": (60, 60)},
+    "auth_session": {"ip": (20, 60), "session": (3, 60)},
+}
+
+class InMemoryRateLimiter:
+    """Process içi token bucket; tek worker veya worker başına limit için yeterli."""
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def acquire(self, key: str, capacity: int, window_s: float) -> float:
+        rate = capacity / window_s
+        now = time.monotonic()
+        tokens, ts = self._buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - ts) * rate)
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now)
+        # En eski kovaları at, bellek sınırlı kalsın
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+class MongoRateLimiter:
+    """Birden fazla worker için Mongo'da tutulan token bucket. Kova tek bir atomik
+    pipeline update ile doldurulup tüketilir; `expires_at` TTL index ile temizlenir."""
+
+    async def acquire(self, key: str, capacity: int, window_s: float) -> float:
+        rate = capacity / window_s
+        now = time.time()
+        bucket = await db.rate_limits.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {
+                    "tokens": {"$min": [capacity, {"$add": [
+                        {"$ifNull": ["$tokens", capacity]},
+                        {"$multiply": [{"$max": [0, {"$subtract": [now, {"$ifNull": ["$ts", now]}]}]}, rate]}
+                    ]}]},
+                    "ts": now,
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=window_s * 2),
+                }},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                }},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if bucket["allowed"]:
+            return 0.0
+        return (1 - bucket["tokens"]) / rate
+
+rate_limiter: Any = ScopedResource("rate_limiter")
+
+@lru_cache(maxsize=8)
+def parse_trusted_proxies(proxies: tuple) -> tuple:
+    return tuple(ipaddress.ip_network(proxy, strict=False) for proxy in proxies)
+
+def is_trusted_proxy(address: str, networks: tuple) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in networks)
+
+def client_ip(request: Request) -> str:
+    # X-Forwarded-For istemci tarafından yazılabilir; yalnızca bağlantı güvenilen bir proxy'den geldiyse
+    # okunur ve zincirde sağdan ilk güvenilmeyen adres istemci kabul edilir
+    peer = request.client.host if request.client else "unknown"
+    networks = parse_trusted_proxies(tuple(app_settings.trusted_proxies)) if app_settings else ()
+    if not networks or not is_trusted_proxy(peer, networks):
+        return peer
+    hops = [hop.strip() for value in request.headers.getlist("X-Forwarded-For") for hop in value.split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not is_trusted_proxy(hop, networks):
+            return hop
+    return hops[0] if hops else peer
+
+async def enforce_rate_limit(request: Request, policy: str, **keys: Optional[str]):
+    if not rate_limiter:
+        return
+    keys.setdefault("ip", client_ip(request))
+    for scope, (capacity, window_s) in RATE_LIMIT_POLICIES[policy].items():
+        value = keys.get(scope)
+        if not value:
+            continue
+        retry_after = await rate_limiter.acquire(f"{policy}:{scope}:{value}", capacity, window_s)
+        if retry_after > 0:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests",
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+
+LOAD_SHEDDING_EXEMPT_PATHS = {"/api/health", "/api/health/live", "/api/health/ready"}
+
+class LoadSheddingMiddleware:
+    """Eşzamanlı istek sayısı sınırı aşılırsa event loop doymadan 503 ile reddeder. Saf ASGI
+    olduğundan istek, StreamingResponse/FileResponse gövdesi tamamen gönderilene kadar sayılır."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        app_scope = active_scope()
+        limit = app_settings.max_in_flight_requests if app_settings else 0
+        if limit and app_scope.in_flight_requests >= limit and scope["path"] not in LOAD_SHEDDING_EXEMPT_PATHS:
+            response = JSONResponse(
+                status_code=503,
+                content={"detail": "Server is busy, please retry"},
+                headers={"Retry-After": str(app_settings.load_shed_retry_after_s)}
+            )
+            await response(scope, receive, send)
+            return
+        app_scope.in_flight_requests += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            app_scope.in_flight_requests -= 1
+
+# ============== DEPENDENCY GUARDS ==============
+
+class CircuitBreaker:
+    """Bir bağımlılık için devre kesici.
+    - closed: çağrılar geçer, ardışık hatalar sayılır; eşiğe ulaşınca open olur.
+    - open: çağrılar beklemeden reddedilir; reset süresi dolunca half_open olur.
+    - half_open: tek bir deneme çağrısına izin verilir; başarılıysa closed, değilse tekrar open.
+    Tüm çağrılar event loop thread'inden yapıldığı için kilit gerekmez."""
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout_s: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def retry_after_s(self) -> float:
+        return max(0.0, self.opened_at + self.reset_timeout_s - time.monotonic()) if self.state == "open" else 0.0
+
+    def is_open(self) -> bool:
+        return self.state == "open" and self.retry_after_s() > 0
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if self.retry_after_s() > 0:
+                return False
+            self.state = "half_open"
+            self._probe_in_flight = False
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record_success(self, probe: bool = False):
+        if self.state == "half_open" and probe:
+            logger.info("Circuit %s closed", self.name)
+            self.state = "closed"
+            self._probe_in_flight = False
+        if self.state == "closed":
+            self.failures = 0
+
+    def record_failure(self, probe: bool = False):
+        # Devre açıkken biten eski çağrılar açık kalma süresini uzatmaz
+        if self.state == "open" or (self.state == "half_open" and not probe):
+            return
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            logger.warning("Circuit %s opened after %d failure(s)", self.name, self.failures)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        # Sonuçsuz kalan deneme (iptal edildi, bağımlılığa hiç gitmedi) devreyi kapatmaz; sıradaki çağrı yeniden dener
+        if self.state == "half_open":
+            self._probe_in_flight = False
+
+    def snapshot(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "retry_after_s": round(self.retry_after_s(), 2)}
+
+mongo_breaker: Any = ScopedResource("mongo_breaker")
+oauth_breaker: Any = ScopedResource("oauth_breaker")
+
+# Veritabanına dokunmayan ya da açık devrede kendi önbelleğinden cevap veren yollar
+MONGO_GUARD_EXEMPT_PREFIXES = ("/api/health", "/api/locations", "/api/pricing", "/api/public/settings")
+# Dosya akıtan export'lar istek süresince çok sayıda getMore yapar; istek bütçesi uygulanmaz
+MONGO_DEADLINE_EXEMPT_PREFIXES = ("/api/admin/export/",)
+# Uzun süren analitik sorgular kendi bütçesiyle çalışır; bütçeyi aşmaları Mongo'nun erişilemez olduğunu göstermez
+MONGO_ANALYTICS_PREFIXES = ("/api/admin/forecast", "/api/admin/reports/trend", "/api/company/reports/trend", "/api/admin/orders/search")
+
+def mongo_unavailable(error: Exception) -> bool:
+    # Bağlantı ve sunucu seçimi hataları. Sunucunun cevap verdiği hatalar sayılmaz: DuplicateKey gibi
+    # sorgu hataları ve maxTimeMS aşımı (ExceededTimeLimit, kod 50). İstemci tarafı süre aşımları da
+    # sayılmaz: CSOT bütçesi komut beklenirken (NetworkTimeout) ya da havuz kuyruğunda
+    # (WaitQueueTimeoutError) dolduysa sunucu yavaştır, bütçe komuttan önce dolduğunda pymongo'nun
+    # fırlattığı ExecutionTimeout ile aynı sınıftadır. Sunucu gerçekten kaybolursa izleyici onu
+    # erişilemez işaretler ve sonraki istekler sunucu seçiminde düşerek devreyi açar
+    if isinstance(error, (NetworkTimeout, WaitQueueTimeoutError)):
+        return False
+    return isinstance(error, ConnectionFailure)
+
+def mongo_request_budget():
+    # Guard dışında kalan yolların Mongo okumaları da istek bütçesiyle sınırlanır
+    budget_ms = app_settings.mongo_request_timeout_ms if app_settings else 0
+    return mongo_timeout(budget_ms / 1000 if budget_ms else None)
+
+def circuit_open_response(breaker: CircuitBreaker, detail: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"detail": detail},
+        headers={"Retry-After": str(max(1, math.ceil(breaker.retry_after_s())))}
+    )
+
+class MongoGuardMiddleware:
+    """Her isteğe Mongo için toplam bir süre bütçesi (pymongo CSOT, `timeout`) verir ve isteğin
+    sonucunu Mongo devre kesicisine bildirir. Devre açıkken istek veritabanına hiç gitmeden 503
+    ile döner; erişim hataları 500 yerine Retry-After içeren 503'e, süre aşımları 504'e çevrilir.
+    Yarı açık devrede deneme isteği başarılı olsa da devre ancak Mongo ping'e cevap verirse kapanır."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not mongo_breaker or scope["path"].startswith(MONGO_GUARD_EXEMPT_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+        if not mongo_breaker.allow():
+            await circuit_open_response(mongo_breaker, "Database temporarily unavailable")(scope, receive, send)
+            return
+        probe = mongo_breaker.state == "half_open"
+        response_started = False
+        
+        async def send_wrapper(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+        
+        analytics = scope["path"].startswith(MONGO_ANALYTICS_PREFIXES)
+        if scope["path"].startswith(MONGO_DEADLINE_EXEMPT_PREFIXES):
+            budget_ms = 0
+        else:
+            budget_ms = app_settings.mongo_analytics_timeout_ms if analytics else app_settings.mongo_request_timeout_ms
+        try:
+            with mongo_timeout(budget_ms / 1000 if budget_ms else None):
+                await self.app(scope, receive, send_wrapper)
+        except PyMongoError as e:
+            # Analitik okumalar secondary'ye gider; orada sunucu seçiminin süre aşımı primary'nin
+            # erişilemez olduğunu göstermez
+            if mongo_unavailable(e) and not (analytics and e.timeout):
+                mongo_breaker.record_failure(probe)
+                if response_started:
+                    raise
+                logger.warning("MongoDB unavailable for %s: %s", scope["path"], e)
+                await circuit_open_response(mongo_breaker, "Database temporarily unavailable")(scope, receive, send)
+                return
+            if isinstance(e, OperationFailure):
+                # Sunucu cevap verdi (sorgu hatası ya da ExceededTimeLimit)
+                mongo_breaker.record_success(probe)
+            elif probe:
+                mongo_breaker.release_probe()
+            if not e.timeout or response_started:
+                raise
+            logger.warning("MongoDB time limit exceeded for %s: %s", scope["path"], e)
+            await JSONResponse(status_code=504, content={"detail": "Database query timed out"})(scope, receive, send)
+        except BaseException:
+            # İptal edilen ya da Mongo dışı bir hatayla biten istek devre hakkında bilgi taşımaz
+            if probe:
+                mongo_breaker.release_probe()
+            raise
+        else:
+            if probe:
+                await self._finish_probe()
+            else:
+                mongo_breaker.record_success()
+    
+    async def _finish_probe(self):
+        # Deneme isteği Mongo'ya hiç gitmemiş olabilir; devre Mongo'nun kendisi cevap verince kapanır
+        ping = await mongo_ping(app_settings.ready_ping_timeout_ms / 1000)
+        if ping["ok"]:
+            mongo_breaker.record_success(probe=True)
+        else:
+            mongo_breaker.record_failure(probe=True)
+
+# ============== RESPONSE COMPRESSION ==============
+
+COMPRESSIBLE_CONTENT_TYPES = ("application/json", "text/", "application/javascript")
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    # Accept-Encoding q değerlerine göre br > gzip tercih edilir
+    accepted = {}
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if token:
+            accepted[token.lower()] = q
+    for encoding in ("br", "gzip"):
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+class StreamCompressor:
+    def __init__(self, encoding: str, gzip_level: int, brotli_quality: int):
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=brotli_quality)
+            self._compress, self._finish = self._compressor.process, self._compressor.finish
+        else:
+            self._compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+            self._compress, self._finish = self._compressor.compress, self._compressor.flush
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compress(data)
+
+    def finish(self) -> bytes:
+        return self._finish()
+
+class CompressionMiddleware:
+    """Boyut eşiğine göre gzip/brotli sıkıştırma. Eşiğe kadar gelen gövde tamponlanır;
+    tamamı eşik altındaysa yanıt sıkıştırılmaz, aksi halde tek parça yanıtlar bütün olarak,
+    StreamingResponse/FileResponse parça parça sıkıştırılır. Büyük gövdeler event loop'u
+    bloklamamak için thread'de sıkıştırılır."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        settings = app_settings or Settings.model_construct()
+        if not encoding or settings.compression_min_size <= 0:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, CompressionResponder(send, encoding, settings).send)
+
+class CompressionResponder:
+    def __init__(self, send, encoding: str, settings: Settings):
+        self._send = send
+        self.encoding = encoding
+        self.min_size = settings.compression_min_size
+        self.offload_size = settings.compression_offload_size
+        self.gzip_level = settings.compression_gzip_level
+        self.brotli_quality = settings.compression_brotli_quality
+        self.start_message = None
+        self.buffer: List[bytes] = []
+        self.buffered = 0
+        self.compressor: Optional[StreamCompressor] = None
+        self.passthrough = False
+
+    async def _run(self, func, data: bytes) -> bytes:
+        if len(data) >= self.offload_size:
+            return await asyncio.to_thread(func, data)
+        return func(data)
+
+    def _set_encoding_headers(self, headers: MutableHeaders):
+        headers["Content-Encoding"] = self.encoding
+        headers.add_vary_header("Accept-Encoding")
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            content_type = headers.get("content-type", "")
+            self.passthrough = (
+                "content-encoding" in headers
+                or not content_type.startswith(COMPRESSIBLE_CONTENT_TYPES)
+                or content_type.startswith("text/event-stream")
+            )
+            if self.passthrough:
+                await self._send(message)
+            else:
+                self.start_message = message
+            return
+        
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+        
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        
+        if self.start_message is not None:
+            # Eşik aşılana ya da gövde bitene kadar ilk parçaları biriktir
+            self.buffer.append(body)
+            self.buffered += len(body)
+            if more_body and self.buffered < self.min_size:
+                return
+            start, self.start_message = self.start_message, None
+            body, self.buffer = b"".join(self.buffer), []
+            headers = MutableHeaders(raw=start["headers"])
+            if not more_body:
+                # Gövde tamamen bilindi: eşik altındaysa olduğu gibi gönder
+                if len(body) < self.min_size:
+                    self.passthrough = True
+                    await self._send(start)
+                    await self._send({"type": "http.response.body", "body": body})
+                    return
+                compressor = StreamCompressor(self.encoding, self.gzip_level, self.brotli_quality)
+                compressed = await self._run(lambda data: compressor.compress(data) + compressor.finish(), body)
+                self._set_encoding_headers(headers)
+                headers["Content-Length"] = str(len(compressed))
+                await self._send(start)
+                await self._send({"type": "http.response.body", "body": compressed})
+                return
+            # Akış halinde yanıt: uzunluk bilinmez, parça parça sıkıştır
+            self.compressor = StreamCompressor(self.encoding, self.gzip_level, self.brotli_quality)
+            self._set_encoding_headers(headers)
+            del headers["Content-Length"]
+            await self._send(start)
+        
+        chunk = await self._run(self.compressor.compress, body) if body else b""
+        if not more_body:
+            chunk += self.compressor.finish()
+        if chunk or not more_body:
+            await self._send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+# ============== REQUEST PROFILING ==============
+
+# Admin'in açıkça istediği isteklerde aktif profil; Motor komutları executor'da context kopyasıyla çalıştırdığı için
+# Mongo listener'ı da aynı profili görür
+active_profile: ContextVar[Optional["RequestProfile"]] = ContextVar("active_profile", default=None)
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_QUERY_FLAG = "_profile"
+PROFILE_MAX_COMMANDS = 500
+
+class RequestProfile:
+    """Tek isteğin örneklenmiş Python yığınları ve Mongo komut süreleri.
+    Örnekleyici event loop thread'ini okur; o anda başka bir isteğin coroutine'i çalışıyorsa
+    onun yığını da görünebilir, bu yüzden sonuç sakin bir anda alınan profil kadar temizdir."""
+
+    def __init__(self, label: str, thread_id: int, interval_s: float):
+        self.label = label
+        self.thread_id = thread_id
+        self.interval_s = interval_s
+        self.stacks: dict = {}
+        self.samples = 0
+        self.idle_samples = 0
+        self.commands: List[dict] = []
+        self._pending: dict = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample_loop, name="request-profiler", daemon=True)
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.wall_ms = (time.perf_counter() - self.started_at) * 1000
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval_s):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            # Loop select() içinde bekliyorsa Python işi yoktur; bekleme Mongo komut süreleriyle gösterilir
+            if frame.f_code.co_name == "select" and "selectors" in frame.f_code.co_filename:
+                self.idle_samples += 1
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def command_started(self, event):
+        collection = event.command.get(event.command_name)
+        self._pending[event.request_id] = (event.command_name, collection if isinstance(collection, str) else None)
+
+    def command_finished(self, event, ok: bool):
+        name, collection = self._pending.pop(event.request_id, (event.command_name, None))
+        if len(self.commands) < PROFILE_MAX_COMMANDS:
+            self.commands.append({"command": name, "collection": collection, "duration_ms": event.duration_micros / 1000, "ok": ok})
+
+    def folded(self) -> str:
+        # flamegraph.pl / speedscope ile açılabilen "çerçeve;çerçeve sayı" satırları;
+        # Mongo süreleri örnekleme aralığı cinsinden sentetik çerçeveler olarak eklenir
+        root = self.label.replace(";", ":")
+        lines = [f"{root};python;{stack} {count}" for stack, count in self.stacks.items()]
+        mongo: dict = {}
+        for cmd in self.commands:
+            key = f"{root};mongo;{cmd['command']} {cmd['collection'] or '-'}"
+            mongo[key] = mongo.get(key, 0) + cmd["duration_ms"]
+        interval_ms = self.interval_s * 1000
+        lines.extend(f"{key} {max(1, round(ms / interval_ms))}" for key, ms in mongo.items())
+        return "\n".join(lines)
+
+    def to_document(self, profile_id: str, status_code: Optional[int], user_id: str) -> dict:
+        now = datetime.now(timezone.utc)
+        return {
+            "profile_id": profile_id,
+            "label": self.label,
+            "status_code": status_code,
+            "user_id": user_id,
+            "wall_ms": round(self.wall_ms, 3),
+            "mongo_ms": round(sum(cmd["duration_ms"] for cmd in self.commands), 3),
+            "mongo_command_count": len(self.commands),
+            "sample_interval_ms": self.interval_s * 1000,
+            "samples": self.samples,
+            "idle_samples": self.idle_samples,
+            "mongo_commands": self.commands,
+            "folded": self.folded(),
+            "created_at": now.isoformat(),
+            "expires_at": now + timedelta(seconds=app_settings.profile_ttl_s),
+        }
+
+class ProfilingCommandListener(monitoring.CommandListener):
+    # Profil yoksa tek bir ContextVar okumasıyla döner
+    def started(self, event):
+        profile = active_profile.get()
+        if profile is not None:
+            profile.command_started(event)
+
+    def succeeded(self, event):
+        profile = active_profile.get()
+        if profile is not None:
+            profile.command_finished(event, ok=True)
+
+    def failed(self, event):
+        profile = active_profile.get()
+        if profile is not None:
+            profile.command_finished(event, ok=False)
+
+def profiling_requested(scope) -> bool:
+    for name, value in scope["headers"]:
+        if name == PROFILE_HEADER:
+            return value.strip() not in (b"", b"0", b"false")
+    return f"{PROFILE_QUERY_FLAG}=1".encode() in scope.get("query_string", b"")
+
+class ProfilingMiddleware:
+    """`X-Profile: 1` başlığı veya `?_profile=1` ile gelen admin isteklerini örnekler,
+    sonucu `profiles` koleksiyonuna yazar ve kimliğini `X-Profile-Id` başlığında döner.
+    Bayrak yoksa istek doğrudan uygulamaya geçer."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not app_settings or not app_settings.profiling_enabled or not profiling_requested(scope):
+            await self.app(scope, receive, send)
+            return
+        try:
+            user = await get_current_user(Request(scope, receive))
+        except HTTPException as e:
+            await JSONResponse(status_code=e.status_code, content={"detail": e.detail})(scope, receive, send)
+            return
+        if user["role"] != "admin":
+            await JSONResponse(status_code=403, content={"detail": "Profiling requires admin access"})(scope, receive, send)
+            return
+        
+        label = f"{scope['method']} {scope['path']}"
+        profile = RequestProfile(label, threading.get_ident(), app_settings.profiling_interval_ms / 1000)
+        profile_id = f"prof_{uuid.uuid4().hex[:12]}"
+        status_code = None
+
+        async def send_with_profile_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(raw=message["headers"])["X-Profile-Id"] = profile_id
+            await send(message)
+
+        token = active_profile.set(profile)
+        profile.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profile.stop()
+            active_profile.reset(token)
+            try:
+                await db.profiles.insert_one(profile.to_document(profile_id, status_code, user["user_id"]))
+            except PyMongoError as e:
+                logger.warning("Profile %s could not be stored: %s", profile_id, e)
+
+@api_router.get("/admin/profiles")
+async def list_profiles(admin: dict = Depends(require_admin)):
+    profiles = await db.profiles.find({}, {"_id": 0, "folded": 0, "mongo_commands": 0, "expires_at": 0}).sort("created_at", -1).to_list(100)
+    return {"profiles": profiles}
+
+@api_router.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, format: str = "json", admin: dict = Depends(require_admin)):
+    profile = await db.profiles.find_one({"profile_id": profile_id}, {"_id": 0, "expires_at": 0})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "folded":
+        return PlainTextResponse(profile["folded"] + "\n")
+    if format != "json":
+        raise HTTPException(status_code=400, detail="format must be json or folded")
+    return profile
+
+# ============== CONDITIONAL REQUESTS ==============
+
+# Önbellek doğrulaması için okunan en küçük alan kümesi
+ORDER_VERSION_PROJECTION = {"_id": 0, "order_id": 1, "customer_id": 1, "version": 1, "created_at": 1}
+
+# ETag'ler zayıftır (W/): aynı sürüm CompressionMiddleware'de farklı kodlamalarla gönderildiğinde
+# gövde bayt bayt aynı değildir, anlamsal eşitlik iddia edilir
+def document_etag(kind: str, doc_id: str, version: Optional[int]) -> str:
+    # Her mutasyon `version` değerini artırır; version alanı olmayan eski dokümanlar 0 sayılır
+    return f'W/"{kind}-{doc_id}-v{version or 0}"'
+
+def list_etag(kind: str, scope: str, *pages: List[dict]) -> str:
+    digest = hashlib.sha1(scope.encode())
+    for page in pages:
+        for doc in page:
+            digest.update(f"|{doc['order_id']}:{doc.get('version') or 0}".encode())
+        digest.update(b"#")
+    return f'W/"{kind}-{digest.hexdigest()[:24]}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match zayıf karşılaştırma kullanır; W/ öneki iki tarafta da yok sayılır
+    return etag.removeprefix("W/") in (candidate.strip().removeprefix("W/") for candidate in header.split(","))
+
+def set_etag(response: Response, etag: str):
+    response.headers["ETag"] = etag
+    # Tarayıcı saklayabilir ama her kullanımda doğrulamalıdır
+    response.headers["Cache-Control"] = "private, no-cache"
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
 # ============== AUTH ROUTES ==============
 
 @api_router.post("/auth/session")
@@ -147,20 +1564,36 @@ async def process_session(request: Request, response: Response):
     session_id = body.get("session_id")
     if not session_id:
         raise HTTPException(status_code=400, detail="session_id required")
-    
-    async with httpx.AsyncClient() as client_http:
-        resp = await client_http.get(
-            "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-            headers={"X-Session-ID": session_id}
-        )
-        if resp.status_code != 200:
-            raise HTTPException(status_code=401, detail="Invalid session_id")
-        oauth_data = resp.json()
+    await enforce_rate_limit(request, "auth_session", session=session_id)
+    
+    # OAuth sağlayıcısı yavaşlarsa istek süre sınırıyla kesilir; art arda hatalarda devre açılır
+    # ve giriş denemeleri sağlayıcıyı beklemeden reddedilir
+    if not oauth_breaker.allow():
+        raise HTTPException(status_code=503, detail="Login provider temporarily unavailable", headers={"Retry-After": str(max(1, math.ceil(oauth_breaker.retry_after_s())))})
+    probe = oauth_breaker.state == "half_open"
+    try:
+        async with httpx.AsyncClient(timeout=app_settings.oauth_timeout_s) as client_http:
+            resp = await client_http.get(app_settings.oauth_session_url, headers={"X-Session-ID": session_id})
+    except httpx.HTTPError as e:
+        oauth_breaker.record_failure(probe)
+        logger.warning("OAuth session-data request failed: %r", e)
+        raise HTTPException(status_code=503, detail="Login provider temporarily unavailable")
+    except BaseException:
+        if probe:
+            oauth_breaker.release_probe()
+        raise
+    if resp.status_code >= 500:
+        oauth_breaker.record_failure(probe)
+        raise HTTPException(status_code=503, detail="Login provider temporarily unavailable")
+    oauth_breaker.record_success(probe)
+    if resp.status_code != 200:
+        raise HTTPException(status_code=401, detail="Invalid session_id")
+    oauth_data = resp.json()
     
     user_id = f"user_{uuid.uuid4().hex[:12]}"
     session_token = oauth_data.get("session_token", f"sess_{uuid.uuid4().hex}")
     
-    existing_user = await db.users.find_one({"email": oauth_data["email"]}, {"_id": 0})
+    existing_user = await find_user_by_email(oauth_data["email"])
     
     if existing_user:
         if existing_user.get("is_banned"):
@@ -171,8 +1604,15 @@ async def process_session(request: Request, response: Response):
             {"$set": {"name": oauth_data.get("name", existing_user.get("name")), "picture": oauth_data.get("picture", existing_user.get("picture"))}}
         )
     else:
-        new_user = {"user_id": user_id, "email": oauth_data["email"], "name": oauth_data.get("name", "User"), "picture": oauth_data.get("picture"), "role": "customer", "is_banned": False, "created_at": datetime.now(timezone.utc).isoformat()}
-        await db.users.insert_one(new_user)
+        new_user = {"user_id": user_id, "email": oauth_data["email"], "email_key": normalize_email(oauth_data["email"]), "name": oauth_data.get("name", "User"), "picture": oauth_data.get("picture"), "role": "customer", "is_banned": False, "created_at": datetime.now(timezone.utc).isoformat()}
+        try:
+            await db.users.insert_one(new_user)
+        except DuplicateKeyError:
+            # Aynı e-posta ile eşzamanlı ilk giriş; diğer istek hesabı oluşturdu
+            existing_user = await find_user_by_email(oauth_data["email"])
+            if not existing_user:
+                raise
+            user_id = existing_user["user_id"]
     
     expires_at = datetime.now(timezone.utc) + timedelta(days=7)
     await db.user_sessions.insert_one({"user_id": user_id, "session_token": session_token, "expires_at": expires_at.isoformat(), "created_at": datetime.now(timezone.utc).isoformat()})
@@ -182,16 +1622,20 @@ async def process_session(request: Request, response: Response):
     return {"user": user, "session_token": session_token}
 
 @api_router.post("/auth/register")
-async def register(user_data: UserCreate, response: Response):
-    existing = await db.users.find_one({"email": user_data.email}, {"_id": 0})
+async def register(user_data: UserCreate, request: Request, response: Response):
+    await enforce_rate_limit(request, "register", email=normalize_email(user_data.email))
+    existing = await find_user_by_email(user_data.email)
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
     
     user_id = f"user_{uuid.uuid4().hex[:12]}"
     hashed_pw = hash_password(user_data.password)
     
-    new_user = {"user_id": user_id, "email": user_data.email, "name": user_data.name, "password_hash": hashed_pw, "role": user_data.role, "phone": user_data.phone, "city": user_data.city, "district": user_data.district, "address": user_data.address, "is_banned": False, "created_at": datetime.now(timezone.utc).isoformat()}
-    await db.users.insert_one(new_user)
+    new_user = {"user_id": user_id, "email": user_data.email, "email_key": normalize_email(user_data.email), "name": user_data.name, "password_hash": hashed_pw, "role": user_data.role, "phone": user_data.phone, "city": user_data.city, "district": user_data.district, "address": user_data.address, "is_banned": False, "created_at": datetime.now(timezone.utc).isoformat()}
+    try:
+        await db.users.insert_one(new_user)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     new_user.pop("_id", None)
     
     if user_data.role == "company" and user_data.company_name:
@@ -207,8 +1651,9 @@ async def register(user_data: UserCreate, response: Response):
     return {"user": user_response, "session_token": session_token}
 
 @api_router.post("/auth/login")
-async def login(credentials: UserLogin, response: Response):
-    user = await db.users.find_one({"email": credentials.email}, {"_id": 0})
+async def login(credentials: UserLogin, request: Request, response: Response):
+    await enforce_rate_limit(request, "login", email=normalize_email(credentials.email))
+    user = await find_user_by_email(credentials.email)
     if not user or "password_hash" not in user:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     if user.get("is_banned"):
@@ -232,8 +1677,7 @@ async def login(credentials: UserLogin, response: Response):
     return {"user": user_response, "session_token": session_token}
 
 @api_router.get("/auth/me")
-async def get_me(request: Request):
-    user = await get_current_user(request)
+async def get_me(user: dict = Depends(get_current_user)):
     return {k: v for k, v in user.items() if k != "password_hash"}
 
 @api_router.post("/auth/logout")
@@ -267,7 +1711,18 @@ async def get_pricing():
     return {"prices": CARPET_PRICES}
 
 @api_router.post("/pricing/calculate")
-async def calculate_price(data: dict):
+async def calculate_price(data: dict, request: Request):
+    # Fiyat hesabı veritabanı gerektirmez; Mongo'daki hız sınırı okunamazsa istek sınırsız geçer
+    if not mongo_breaker.is_open():
+        try:
+            with mongo_request_budget():
+                await enforce_rate_limit(request, "pricing")
+        except PyMongoError as e:
+            if not (mongo_unavailable(e) or e.timeout):
+                raise
+            if mongo_unavailable(e):
+                mongo_breaker.record_failure()
+            logger.warning("Pricing rate limit skipped, MongoDB unavailable: %s", e)
     carpets = data.get("carpets", [])
     total_area = 0
     total_price = 0
@@ -285,19 +1740,461 @@ async def calculate_price(data: dict):
     
     return {"details": details, "total_area": total_area, "total_price": total_price}
 
+# ============== ORDER SCHEMA ==============
+
+# v1: boş alanlar null olarak yazılır, firma bildirim ve red listeleri dokümandaki dizilerde büyür.
+# v2: null alanlar hiç yazılmaz (okuyucular .get ile eksik alanı None sayar); bildirim ve redler
+# sipariş+firma başına bir satır olarak `order_fanout` koleksiyonunda tutulur.
+ORDER_SCHEMA_VERSION = 2
+# v1 dizi alanı -> order_fanout satırındaki zaman alanı
+ORDER_FANOUT_FIELDS = {"notified_companies": "notified_at", "rejected_by": "rejected_at"}
+ORDER_READ_PROJECTION = {"_id": 0, "notified_companies": 0, "rejected_by": 0}
+
+def compact_order(order: dict) -> List[dict]:
+    """Siparişi yerinde v2 biçimine çevirir, dokümandan çıkarılan fan-out satırlarını döndürür."""
+    stamps = {
+        "notified_at": order.get("created_at") or datetime.now(timezone.utc).isoformat(),
+        "rejected_at": order.get("updated_at") or order.get("created_at") or datetime.now(timezone.utc).isoformat(),
+    }
+    rows = {}
+    for field, stamp_field in ORDER_FANOUT_FIELDS.items():
+        for company_id in order.pop(field, None) or []:
+            rows.setdefault(company_id, {"order_id": order.get("order_id"), "company_id": company_id})[stamp_field] = stamps[stamp_field]
+    for key in [key for key, value in order.items() if value is None]:
+        del order[key]
+    order["schema_version"] = ORDER_SCHEMA_VERSION
+    return list(rows.values())
+
+def upgrade_order(order: Optional[dict]) -> Optional[dict]:
+    # Okuma yolu: v1 doküman bellekte v2 görünümüne çevrilir, kalıcı dönüşüm rewrite_orders ile yapılır
+    if not order or order.get("schema_version") == ORDER_SCHEMA_VERSION:
+        return order
+    return {key: value for key, value in order.items() if value is not None and key not in ORDER_FANOUT_FIELDS}
+
+async def rewrite_orders(collection: Any, orders: List[dict]) -> dict:
+    """v1 siparişleri v2 biçiminde yeniden yazar. Fan-out satırları önce yazılır ki diziler
+    kaybolmasın; değiştirme `version` koşuluyla yapılır, arada güncellenen doküman atlanır ve
+    sonraki çalıştırmada yeniden ele alınır. İçerik değişmediği için version artırılmaz."""
+    replacements, fanout_ops = [], []
+    bytes_before = bytes_after = 0
+    for order in orders:
+        compact = dict(order)
+        rows = compact_order(compact)
+        bytes_before += len(bson.encode(order))
+        bytes_after += len(bson.encode(compact))
+        replacements.append(ReplaceOne({"_id": order["_id"], "version": order.get("version"), "schema_version": {"$ne": ORDER_SCHEMA_VERSION}}, compact))
+        # $min: aynı satır daha önce yazılmışsa en erken zaman korunur
+        fanout_ops.extend(
+            UpdateOne({"order_id": row["order_id"], "company_id": row["company_id"]}, {"$min": {k: v for k, v in row.items() if k.endswith("_at")}}, upsert=True)
+            for row in rows
+        )
+    if fanout_ops:
+        await db.order_fanout.bulk_write(fanout_ops, ordered=False)
+    rewritten = (await collection.bulk_write(replacements, ordered=False)).modified_count if replacements else 0
+    return {"rewritten": rewritten, "skipped": len(orders) - rewritten, "fanout_rows": len(fanout_ops), "bytes_before": bytes_before, "bytes_after": bytes_after}
+
+async def run_order_compaction(batch_size: int) -> dict:
+    """Ana ve arşiv koleksiyonlarındaki v1 siparişleri _id sırasıyla parça parça v2'ye çevirir
+    ve yeniden yazılan dokümanlar için boyut farkını raporlar."""
+    report = {}
+    for name in ("orders", "orders_archive"):
+        collection = db[name]
+        totals = {"rewritten": 0, "skipped": 0, "fanout_rows": 0, "bytes_before": 0, "bytes_after": 0, "batches": 0}
+        last_id = None
+        while True:
+            query = {"schema_version": {"$ne": ORDER_SCHEMA_VERSION}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            orders = await collection.find(query).sort("_id", 1).limit(batch_size).to_list(batch_size)
+            if not orders:
+                break
+            last_id = orders[-1]["_id"]
+            for key, value in (await rewrite_orders(collection, orders)).items():
+                totals[key] += value
+            totals["batches"] += 1
+            await asyncio.sleep(0)
+        scanned = totals["rewritten"] + totals["skipped"]
+        totals["avg_bytes_before"] = round(totals["bytes_before"] / scanned) if scanned else 0
+        totals["avg_bytes_after"] = round(totals["bytes_after"] / scanned) if scanned else 0
+        totals["reduction_pct"] = round(100 * (1 - totals["bytes_after"] / totals["bytes_before"]), 1) if totals["bytes_before"] else 0.0
+        report[name] = totals
+    return report
+
+# ============== ORDER POOL ==============
+
+class OrderPool:
+    """Bekleyen (pending) siparişlerin şehir bazlı bellek içi görünümü ve firma bazlı red kümeleri.
+    Havuz sorgusu `order_fanout` red satırlarını birleştiren bir sorgu yapmak yerine buradan cevaplanır.
+    Sipariş mutasyonları havuzu anında günceller; diğer worker'ların yaptığı değişiklikler
+    periyodik yeniden yükleme ile yakalanır. Yükleme sürerken gelen mutasyonlar kaydedilir ve
+    yeni görünüme yeniden uygulanır, böylece yükleme onları silmez."""
+
+    def __init__(self):
+        self._by_city: dict = {}  # city -> {order_id: created_at}
+        self._city_of: dict = {}  # order_id -> city
+        self._rejected: dict = {}  # company user_id -> {order_id}
+        self._rejectors: dict = {}  # order_id -> {company user_id}
+        self._journal: Optional[list] = None  # yükleme sırasında gelen (metot, argümanlar)
+        self._load_lock = asyncio.Lock()
+
+    async def load(self):
+        async with self._load_lock:
+            self._journal = []
+            try:
+                maps = await self._read()
+            except BaseException:
+                self._journal = None
+                raise
+            journal, self._journal = self._journal, None
+            self._by_city, self._city_of, self._rejected, self._rejectors = maps
+            for method, args in journal:
+                method(*args)
+
+    async def _read(self) -> tuple:
+        by_city, city_of, rejected, rejectors = {}, {}, {}, {}
+        
+        def add_rejection(order_id: str, company_id: str):
+            rejected.setdefault(company_id, set()).add(order_id)
+            rejectors.setdefault(order_id, set()).add(company_id)
+        
+        # rejected_by yalnızca henüz v2'ye çevrilmemiş dokümanlarda bulunur
+        async for order in db.orders.find({"status": "pending"}, {"_id": 0, "order_id": 1, "city": 1, "created_at": 1, "rejected_by": 1}):
+            by_city.setdefault(order.get("city"), {})[order["order_id"]] = order.get("created_at", "")
+            city_of[order["order_id"]] = order.get("city")
+            for company_id in order.get("rejected_by") or []:
+                add_rejection(order["order_id"], company_id)
+        pending_ids = list(city_of)
+        for i in range(0, len(pending_ids), 1000):
+            async for row in db.order_fanout.find({"order_id": {"$in": pending_ids[i:i + 1000]}, "rejected_at": {"$exists": True}}, {"_id": 0, "order_id": 1, "company_id": 1}):
+                add_rejection(row["order_id"], row["company_id"])
+        return by_city, city_of, rejected, rejectors
+
+    def add(self, order: dict):
+        if self._journal is not None:
+            self._journal.append((self.add, (order,)))
+        self._by_city.setdefault(order.get("city"), {})[order["order_id"]] = order.get("created_at", "")
+        self._city_of[order["order_id"]] = order.get("city")
+        for company_id in order.get("rejected_by") or []:
+            self.reject(order["order_id"], company_id)
+
+    def remove(self, order_id: str):
+        if self._journal is not None:
+            self._journal.append((self.remove, (order_id,)))
+        city = self._city_of.pop(order_id, None)
+        self._by_city.get(city, {}).pop(order_id, None)
+        for company_id in self._rejectors.pop(order_id, set()):
+            self._rejected.get(company_id, set()).discard(order_id)
+
+    def sync(self, order: Optional[dict]):
+        # Sipariş güncellendikten sonra son durumuna göre havuza ekle/çıkar
+        if not order:
+            return
+        if order.get("status") == "pending":
+            self.add(order)
+        else:
+            self.remove(order["order_id"])
+
+    def reject(self, order_id: str, company_id: str):
+        if self._journal is not None:
+            self._journal.append((self.reject, (order_id, company_id)))
+        if order_id not in self._city_of:
+            return
+        self._rejected.setdefault(company_id, set()).add(order_id)
+        self._rejectors.setdefault(order_id, set()).add(company_id)
+
+    def order_ids(self, city: Optional[str], company_id: str, limit: Optional[int] = None) -> List[str]:
+        pending = self._by_city.get(city, {})
+        rejected = self._rejected.get(company_id, set())
+        ids = sorted((oid for oid in pending if oid not in rejected), key=pending.get, reverse=True)
+        return ids[:limit] if limit else ids
+
+    def count(self, city: Optional[str], company_id: str) -> int:
+        pending = self._by_city.get(city, {})
+        rejected = self._rejected.get(company_id, set())
+        return len(pending) - sum(1 for oid in rejected if oid in pending)
+
+    async def fetch(self, city: Optional[str], company_id: str, limit: int = 100, projection: Optional[dict] = None, repair: bool = True) -> List[dict]:
+        # repair=False yalnızca okur (ör. ETag hesabı); bellek düzeltilmese de `seen` sayesinde aynı liste döner
+        projection = {**projection, "created_at": 1} if projection else ORDER_READ_PROJECTION
+        orders: List[dict] = []
+        seen: set = set()
+        while len(orders) < limit:
+            ids = [oid for oid in self.order_ids(city, company_id) if oid not in seen][:limit - len(orders)]
+            if not ids:
+                break
+            seen.update(ids)
+            # order_id index'i ile nokta okuma; durum koşulu eski (stale) girdileri, red koşulları da başka
+            # worker'da verilmiş ve bu process'e henüz yansımamış redleri eler
+            found = await db.orders.find({"order_id": {"$in": ids}, "status": "pending", "rejected_by": {"$ne": company_id}}, projection).to_list(len(ids))
+            rejected = {
+                row["order_id"]
+                async for row in db.order_fanout.find({"order_id": {"$in": ids}, "company_id": company_id, "rejected_at": {"$exists": True}}, {"_id": 0, "order_id": 1})
+            }
+            found = [order for order in found if order["order_id"] not in rejected]
+            # Elenen girdiler bellekte de düzeltilir: hâlâ bekleyenler (eski rejected_by) red, diğerleri havuzdan çıkar
+            found_ids = {order["order_id"] for order in found}
+            missing = [oid for oid in ids if oid not in rejected and oid not in found_ids]
+            if missing:
+                rejected |= {
+                    order["order_id"]
+                    async for order in db.orders.find({"order_id": {"$in": missing}, "status": "pending"}, {"_id": 0, "order_id": 1})
+                }
+            for order_id in ids if repair else ():
+                if order_id in rejected:
+                    self.reject(order_id, company_id)
+                elif order_id in missing:
+                    self.remove(order_id)
+            orders.extend(upgrade_order(order) for order in found)
+        orders.sort(key=lambda o: o.get("created_at", ""), reverse=True)
+        return orders
+
+    async def resync_forever(self, interval_s: float):
+        while True:
+            await asyncio.sleep(interval_s)
+            try:
+                await self.load()
+            except PyMongoError as e:
+                logger.warning("Order pool resync failed: %s", e)
+
+order_pool: Any = ScopedResource("order_pool")
+
+# ============== ORDER IDS ==============
+
+ORDER_ID_MASK = 0xFFFFFFFF
+
+def scramble_order_number(n: int) -> int:
+    # 32 bit üzerinde birebir (bijective) karıştırma: tek sayı ile çarpma ve xorshift tersinirdir,
+    # böylece ardışık sayılar çakışmadan tahmin edilmesi zor ORD-XXXXXXXX değerlerine dönüşür
+    x = (n * 0x9E3779B1) & ORDER_ID_MASK
+    x ^= x >> 16
+    x = (x * 0x85EBCA6B) & ORDER_ID_MASK
+    x ^= x >> 13
+    return x
+
+class OrderIdAllocator:
+    """Mongo `counters` koleksiyonundan tek bir atomik $inc ile ardışık sayı blokları ayırır ve
+    bunları bellekte dağıtır. Her worker kendi bloğunu kullandığı için ID'ler çakışmaz;
+    process yeniden başlarsa kalan blok kullanılmadan atlanır."""
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self._next = 1
+        self._end = 0
+        self._lock = asyncio.Lock()
+
+    async def _reserve_block(self):
+        counter = await db.counters.find_one_and_update(
+            {"_id": "order_id"},
+            {"$inc": {"value": self.block_size}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        # Blok (value - block_size, value] aralığıdır; numaralar 1'den başlar
+        self._end = counter["value"]
+        self._next = self._end - self.block_size + 1
+
+    async def allocate(self) -> str:
+        async with self._lock:
+            if self._next > self._end:
+                await self._reserve_block()
+            number = self._next
+            self._next += 1
+        if number > ORDER_ID_MASK:
+            raise RuntimeError("Order id space exhausted")
+        return f"ORD-{scramble_order_number(number):08X}"
+
+order_id_allocator: Any = ScopedResource("order_id_allocator")
+
+async def insert_order(order: dict, attempts: int = 5, outbox=None):
+    # Eski rastgele üretilmiş bir ID ile çakışma olursa unique index (ya da arşiv kontrolü) reddeder, sıradaki ID denenir.
+    # outbox(order) sipariş numarası atandıktan sonra mesajları üretir; sipariş ile birlikte yazılır
+    order.setdefault("version", 1)
+    fanout = compact_order(order)
+    for _ in range(attempts):
+        order["order_id"] = await order_id_allocator.allocate()
+        # Arşivdeki eski bir siparişin numarası unique index'e takılmaz (ayrı koleksiyon), ayrıca kontrol edilir
+        if await db.orders_archive.find_one({"order_id": order["order_id"]}, {"_id": 1}):
+            logger.warning("Order id %s already used by an archived order, allocating another", order["order_id"])
+            continue
+        rows = [{**row, "order_id": order["order_id"]} for row in fanout]
+        
+        async def write(s):
+            await db.orders.insert_one(order, session=s)
+            if rows:
+                await db.order_fanout.insert_many(rows, ordered=False, session=s)
+        
+        try:
+            await write_with_outbox(write, outbox(order) if outbox else [])
+            return
+        except DuplicateKeyError:
+            order.pop("_id", None)
+            logger.warning("Order id %s already taken, allocating another", order["order_id"])
+    raise HTTPException(status_code=500, detail="Could not allocate an order id")
+
+async def find_duplicate_order_ids(collection: Any) -> List[dict]:
+    # Her grupta en eski sipariş numarasını korur, kalanlar yeniden numaralandırılır
+    return await collection.aggregate([
+        {"$sort": {"created_at": 1, "_id": 1}},
+        {"$group": {"_id": "$order_id", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$sort": {"_id": 1}},
+    ], allowDiskUse=True).to_list(None)
+
+async def run_order_id_dedupe(dry_run: bool) -> dict:
+    """Eski rastgele ID'lerden kalan, aynı `order_id`'yi taşıyan siparişleri bulur (ana ve arşiv
+    koleksiyonu ayrı ayrı). dry_run değilse her grubun en eski siparişi numarasını korur, diğerlerine
+    sayaçtan yeni numara verilir; eski numara `previous_order_id` alanında saklanır. Numaranın
+    fan-out satırları hangi siparişe ait olduğu bilinemediği için yeni numaraya kopyalanır.
+    Sonunda unique index'ler yeniden kurulur ve hâlâ eksik olanlar raporlanır."""
+    report = {"dry_run": dry_run}
+    for name in ("orders", "orders_archive"):
+        collection = db[name]
+        groups = await find_duplicate_order_ids(collection)
+        reassigned = []
+        if not dry_run:
+            for group in groups:
+                fanout = await db.order_fanout.find({"order_id": group["_id"]}, {"_id": 0}).to_list(None)
+                for doc_id in group["ids"][1:]:
+                    new_id = await order_id_allocator.allocate()
+                    while await db.orders.find_one({"order_id": new_id}, {"_id": 1}) or await db.orders_archive.find_one({"order_id": new_id}, {"_id": 1}):
+                        new_id = await order_id_allocator.allocate()
+                    if fanout:
+                        await db.order_fanout.insert_many([{**row, "order_id": new_id} for row in fanout], ordered=False)
+                    result = await collection.update_one(
+                        {"_id": doc_id, "order_id": group["_id"]},
+                        {"$set": {"order_id": new_id, "previous_order_id": group["_id"], "updated_at": datetime.now(timezone.utc).isoformat()}, "$inc": {"version": 1}}
+                    )
+                    if result.modified_count:
+                        reassigned.append({"previous_order_id": group["_id"], "order_id": new_id})
+        report[name] = {"duplicate_groups": len(groups), "duplicate_orders": sum(group["count"] - 1 for group in groups), "reassigned": reassigned}
+    if not dry_run:
+        await ensure_indexes([spec for spec in INDEX_SPECS if spec[1] == "order_id" and spec[2].get("unique")])
+    report["missing_unique_indexes"] = list(active_scope().missing_unique_indexes)
+    return report
+
+# ============== PICKUP SLOTS ==============
+
+# Her slot kendi sayaç dokümanıdır; rezervasyon tek bir koşullu $inc ile yapılır,
+# kapasite kontrolü ve artış aynı atomik güncellemede gerçekleşir
+SLOT_PUBLIC_PROJECTION = {"_id": 0, "slot_id": 1, "company_id": 1, "city": 1, "districts": 1, "start": 1, "end": 1, "capacity_m2": 1, "reserved_m2": 1}
+
+def slot_timestamp(value: datetime) -> str:
+    # Saat dilimi verilmemişse İstanbul saati kabul edilir; string karşılaştırma için UTC ve saniye hassasiyeti
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=ZoneInfo(REPORT_TIMEZONE))
+    return value.astimezone(timezone.utc).replace(microsecond=0).isoformat()
+
+def resolve_slot_week(week_start: Optional[str]):
+    tz = ZoneInfo(REPORT_TIMEZONE)
+    if week_start:
+        try:
+            day = datetime.strptime(week_start, "%Y-%m-%d")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="week_start must be YYYY-MM-DD")
+    else:
+        today = datetime.now(tz).replace(tzinfo=None)
+        day = today - timedelta(days=today.weekday())
+    start = day.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=tz)
+    return slot_timestamp(start), slot_timestamp(start + timedelta(days=7))
+
+def with_availability(slot: dict) -> dict:
+    slot["available_m2"] = round(max(0.0, slot["capacity_m2"] - slot["reserved_m2"]), 2)
+    return slot
+
+async def reserve_slot(slot_id: str, city: str, district: str, area_m2: float) -> Optional[dict]:
+    # Slot yalnızca firmanın hizmet verdiği ilçelerden rezerve edilebilir (listelemedeki filtreyle aynı)
+    now = slot_timestamp(datetime.now(timezone.utc))
+    return await db.slots.find_one_and_update(
+        {
+            "slot_id": slot_id,
+            "city": city,
+            "districts": district,
+            "start": {"$gt": now},
+            "$expr": {"$lte": [{"$add": ["$reserved_m2", area_m2]}, "$capacity_m2"]},
+        },
+        {"$inc": {"reserved_m2": area_m2}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+
+async def release_slot(order: dict):
+    # Siparişteki bayrak önce koşullu çevrilir; iptal ve yeniden atama aynı rezervasyonu iki kez geri veremez
+    pickup_slot = order.get("pickup_slot")
+    if not pickup_slot or pickup_slot.get("released"):
+        return
+    result = await db.orders.update_one(
+        {"order_id": order["order_id"], "pickup_slot.slot_id": pickup_slot["slot_id"], "pickup_slot.released": False},
+        {"$set": {"pickup_slot.released": True, "updated_at": datetime.now(timezone.utc).isoformat()}, "$inc": {"version": 1}}
+    )
+    if result.modified_count:
+        await db.slots.update_one(
+            {"slot_id": pickup_slot["slot_id"]},
+            {"$inc": {"reserved_m2": -pickup_slot["area_m2"]}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+        )
+
+@api_router.get("/slots")
+async def get_available_slots(city: str, week_start: Optional[str] = None, district: Optional[str] = None):
+    start, end = resolve_slot_week(week_start)
+    query = {"city": city, "start": {"$gte": start, "$lt": end}, "$expr": {"$gt": ["$capacity_m2", "$reserved_m2"]}}
+    if district:
+        query["districts"] = district
+    slots = await db.slots.find(query, SLOT_PUBLIC_PROJECTION).sort("start", 1).to_list(1000)
+    return {"week_start": start, "week_end": end, "slots": [with_availability(slot) for slot in slots]}
+
+@api_router.get("/company/slots")
+async def get_company_slots(week_start: Optional[str] = None, user: dict = Depends(require_company)):
+    start, end = resolve_slot_week(week_start)
+    slots = await db.slots.find({"company_id": user["user_id"], "start": {"$gte": start, "$lt": end}}, {"_id": 0}).sort("start", 1).to_list(1000)
+    return {"week_start": start, "week_end": end, "slots": [with_availability(slot) for slot in slots]}
+
+@api_router.post("/company/slots")
+async def publish_company_slots(data: SlotPublish, company: dict = Depends(get_current_company)):
+    if not company.get("is_active"):
+        raise HTTPException(status_code=403, detail="Company is not active")
+    now = slot_timestamp(datetime.now(timezone.utc))
+    published, conflicts = [], []
+    for item in data.slots:
+        start, end = slot_timestamp(item.start), slot_timestamp(item.end)
+        if end <= start or item.capacity_m2 <= 0 or start <= now:
+            raise HTTPException(status_code=400, detail="Slots must be in the future with end after start and positive capacity")
+        # Kapasite ayrılmış alanın altına indirilemez: koşul tutmazsa upsert unique index'e takılır
+        try:
+            slot = await db.slots.find_one_and_update(
+                {"company_id": company["user_id"], "start": start, "reserved_m2": {"$lte": item.capacity_m2}},
+                {
+                    "$set": {"end": end, "capacity_m2": item.capacity_m2, "city": company.get("city"), "districts": company.get("districts") or [], "updated_at": datetime.now(timezone.utc).isoformat()},
+                    "$setOnInsert": {"slot_id": f"slot_{uuid.uuid4().hex[:12]}", "reserved_m2": 0.0, "created_at": datetime.now(timezone.utc).isoformat()},
+                },
+                projection={"_id": 0},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            conflicts.append(start)
+            continue
+        published.append(with_availability(slot))
+    return {"slots": published, "conflicts": conflicts}
+
+@api_router.delete("/company/slots/{slot_id}")
+async def delete_company_slot(slot_id: str, user: dict = Depends(require_company)):
+    result = await db.slots.delete_one({"slot_id": slot_id, "company_id": user["user_id"], "reserved_m2": {"$lte": 1e-6}})
+    if result.deleted_count == 0:
+        if await db.slots.find_one({"slot_id": slot_id, "company_id": user["user_id"]}, {"_id": 1}):
+            raise HTTPException(status_code=409, detail="Slot has reservations")
+        raise HTTPException(status_code=404, detail="Slot not found")
+    return {"message": "Slot deleted"}
+
 # ============== ORDER ROUTES ==============
 
 @api_router.post("/orders")
-async def create_order(order_data: OrderCreate, request: Request):
-    user = await get_current_user(request)
-    
+async def create_order(order_data: OrderCreate, user: dict = Depends(get_current_user)):
     carpet_details = []
     for carpet in order_data.carpets:
         area = carpet.width * carpet.length
         carpet_details.append({"carpet_type": carpet.carpet_type, "width": carpet.width, "length": carpet.length, "area": area})
     
     order = {
-        "order_id": f"ORD-{uuid.uuid4().hex[:8].upper()}",
+        "order_id": None,  # insert_order tarafından atanır
         "customer_id": user["user_id"],
         "customer_name": user.get("name", ""),
         "customer_phone": order_data.phone,
@@ -320,6 +2217,7 @@ async def create_order(order_data: OrderCreate, request: Request):
         "notified_companies": [],
         "rejected_by": [],
         "created_at": datetime.now(timezone.utc).isoformat(),
+        "updated_at": datetime.now(timezone.utc).isoformat(),
         "assigned_at": None,
         "pickup_date": None,
         "washing_date": None,
@@ -328,104 +2226,160 @@ async def create_order(order_data: OrderCreate, request: Request):
         "cancel_reason": None
     }
     
-    await db.orders.insert_one(order)
-    order.pop("_id", None)
+    if order_data.slot_id:
+        await book_order_slot(order, order_data.slot_id)
+        return order
     
     companies = await db.companies.find({"city": order_data.city, "is_active": True}, {"_id": 0}).to_list(100)
-    if companies:
-        notified = [c["user_id"] for c in companies]
-        await db.orders.update_one({"order_id": order["order_id"]}, {"$set": {"notified_companies": notified}})
-        order["notified_companies"] = notified
+    order["notified_companies"] = [c["user_id"] for c in companies]
+    area = round(sum(c["area"] for c in carpet_details), 1)
+    
+    def notifications(o: dict) -> List[Optional[dict]]:
+        messages = [outbox_message(o["customer_phone"], o["order_id"], "order_created", f"HALIYOL: {o['order_id']} numaralı siparişiniz alındı, firmalara iletildi.")]
+        messages.extend(
+            outbox_message(c.get("phone"), o["order_id"], "order_available", f"HALIYOL: {o['district']} bölgesinde yeni sipariş ({area} m²) havuzda.")
+            for c in companies
+        )
+        return messages
+    
+    await insert_order(order, outbox=notifications)
+    order.pop("_id", None)
+    order_pool.add(order)
     
     return order
 
-@api_router.get("/orders")
-async def get_orders(request: Request):
-    user = await get_current_user(request)
-    
+async def book_order_slot(order: dict, slot_id: str):
+    # Önce kapasite ayrılır, sonra sipariş yazılır; sipariş yazılamazsa ayrılan alan geri verilir
+    area = round(sum(c["area"] for c in order["carpets"]), 2)
+    slot = await reserve_slot(slot_id, order["city"], order["district"], area)
+    if not slot:
+        raise HTTPException(status_code=409, detail="Selected pickup slot is full or no longer available")
+    
+    async def undo():
+        await db.slots.update_one({"slot_id": slot_id}, {"$inc": {"reserved_m2": -area}})
+    
+    company = await get_company_profile_cached(slot["company_id"])
+    if not company or not company.get("is_active"):
+        await undo()
+        raise HTTPException(status_code=409, detail="Selected pickup slot is no longer available")
+    
+    now = datetime.now(timezone.utc).isoformat()
+    order.update({
+        "status": "assigned",
+        "company_id": slot["company_id"],
+        "company_name": company.get("company_name"),
+        "assigned_at": now,
+        "pickup_slot": {"slot_id": slot_id, "start": slot["start"], "end": slot["end"], "area_m2": area, "released": False},
+    })
+    pickup_at = datetime.fromisoformat(slot["start"]).astimezone(ZoneInfo(REPORT_TIMEZONE)).strftime("%d.%m.%Y %H:%M")
+    
+    def notifications(o: dict) -> List[Optional[dict]]:
+        return [
+            outbox_message(o["customer_phone"], o["order_id"], "order_assigned", f"HALIYOL: {o['order_id']} numaralı siparişiniz {o['company_name']} firmasına atandı. Alım: {pickup_at}."),
+            outbox_message(company.get("phone"), o["order_id"], "slot_booked", f"HALIYOL: {pickup_at} slotunuza {o['district']} bölgesinden {area} m² rezervasyon yapıldı ({o['order_id']})."),
+        ]
+    
+    try:
+        await insert_order(order, outbox=notifications)
+    except BaseException:
+        await undo()
+        raise
+    order.pop("_id", None)
+
+@api_router.get("/orders")
+async def get_orders(request: Request, response: Response, user: dict = Depends(get_current_user), company: Optional[dict] = Depends(get_current_company_if_any)):
+    city = None
     if user["role"] == "customer":
-        orders = await db.orders.find({"customer_id": user["user_id"]}, {"_id": 0}).sort("created_at", -1).to_list(100)
+        query, limit = {"customer_id": user["user_id"]}, 100
     elif user["role"] == "company":
-        company = await db.companies.find_one({"user_id": user["user_id"]}, {"_id": 0})
-        if company:
-            orders = await db.orders.find(
-                {"$or": [{"company_id": user["user_id"]}, {"status": "pending", "city": company.get("city"), "rejected_by": {"$ne": user["user_id"]}}]},
-                {"_id": 0}
-            ).sort("created_at", -1).to_list(100)
-        else:
-            orders = []
+        query, limit, city = {"company_id": user["user_id"]}, 100, company.get("city")
     elif user["role"] == "admin":
-        orders = await db.orders.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
+        query, limit = {}, 1000
     else:
-        orders = []
+        return {"orders": []}
+    scope = f"{user['role']}:{user['user_id']}"
+    
+    if request.headers.get("if-none-match"):
+        # Yalnızca order_id ve version okunur; liste değişmemişse dokümanların tamamı hiç çekilmez
+        heads = await find_orders_page(query, ORDER_VERSION_PROJECTION, ["created_at"], limit)
+        pool_heads = await order_pool.fetch(city, user["user_id"], 100, ORDER_VERSION_PROJECTION, repair=False) if city is not None else []
+        etag = list_etag("orders", scope, heads, pool_heads)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+    
+    orders = [upgrade_order(order) for order in await find_orders_page(query, ORDER_READ_PROJECTION, ["created_at"], limit)]
+    pool_orders = await order_pool.fetch(city, user["user_id"], 100) if city is not None else []
+    set_etag(response, list_etag("orders", scope, orders, pool_orders))
+    if user["role"] == "company":
+        orders = sorted(orders + pool_orders, key=lambda o: o.get("created_at", ""), reverse=True)[:100]
     
     return {"orders": orders}
 
 @api_router.get("/orders/pool")
-async def get_order_pool(request: Request):
-    user = await get_current_user(request)
-    if user["role"] not in ["company", "admin"]:
-        raise HTTPException(status_code=403, detail="Access denied")
-    
+async def get_order_pool(user: dict = Depends(require_role("company", "admin")), company: Optional[dict] = Depends(get_current_company_if_any)):
     if user["role"] == "company":
-        company = await db.companies.find_one({"user_id": user["user_id"]}, {"_id": 0})
-        if not company:
-            return {"orders": []}
-        orders = await db.orders.find({"status": "pending", "city": company.get("city"), "rejected_by": {"$ne": user["user_id"]}}, {"_id": 0}).sort("created_at", -1).to_list(100)
+        orders = await order_pool.fetch(company.get("city"), user["user_id"], 100)
     else:
-        orders = await db.orders.find({"status": "pending"}, {"_id": 0}).sort("created_at", -1).to_list(100)
+        orders = [upgrade_order(order) for order in await db.orders.find({"status": "pending"}, ORDER_READ_PROJECTION).sort("created_at", -1).to_list(100)]
     
     return {"orders": orders}
 
 @api_router.get("/orders/{order_id}")
-async def get_order(order_id: str, request: Request):
-    user = await get_current_user(request)
-    order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
+async def get_order(order_id: str, request: Request, response: Response, user: dict = Depends(get_current_user)):
+    if request.headers.get("if-none-match"):
+        head = await find_order_by_id(order_id, ORDER_VERSION_PROJECTION)
+        if not head:
+            raise HTTPException(status_code=404, detail="Order not found")
+        if user["role"] == "customer" and head["customer_id"] != user["user_id"]:
+            raise HTTPException(status_code=403, detail="Access denied")
+        etag = document_etag("order", order_id, head.get("version"))
+        if etag_matches(request, etag):
+            return not_modified(etag)
+    
+    order = await find_order_by_id(order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     if user["role"] == "customer" and order["customer_id"] != user["user_id"]:
         raise HTTPException(status_code=403, detail="Access denied")
+    set_etag(response, document_etag("order", order_id, order.get("version")))
     return order
 
 @api_router.post("/orders/{order_id}/accept")
-async def accept_order(order_id: str, request: Request):
-    user = await get_current_user(request)
-    if user["role"] != "company":
-        raise HTTPException(status_code=403, detail="Only companies can accept orders")
-    
+async def accept_order(order_id: str, user: dict = Depends(require_role("company", detail="Only companies can accept orders")), company: dict = Depends(get_current_company)):
     order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     if order["status"] != "pending":
         raise HTTPException(status_code=400, detail="Order already assigned")
     
-    company = await db.companies.find_one({"user_id": user["user_id"]}, {"_id": 0})
-    if not company:
-        raise HTTPException(status_code=404, detail="Company profile not found")
-    
-    await db.orders.update_one(
-        {"order_id": order_id},
-        {"$set": {"company_id": user["user_id"], "company_name": company["company_name"], "status": "assigned", "assigned_at": datetime.now(timezone.utc).isoformat()}}
+    await write_with_outbox(
+        lambda s: db.orders.update_one(
+            {"order_id": order_id},
+            {"$set": {"company_id": user["user_id"], "company_name": company["company_name"], "status": "assigned", "assigned_at": datetime.now(timezone.utc).isoformat(), "updated_at": datetime.now(timezone.utc).isoformat()}, "$inc": {"version": 1}},
+            session=s
+        ),
+        [outbox_message(order.get("customer_phone"), order_id, "order_assigned", f"HALIYOL: {order_id} numaralı siparişiniz {company['company_name']} firmasına atandı.")]
     )
+    audit(user, "order.accept", "order", order_id)
     
-    return await db.orders.find_one({"order_id": order_id}, {"_id": 0})
+    updated = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
+    order_pool.sync(updated)
+    return updated
 
 @api_router.post("/orders/{order_id}/reject")
-async def reject_order(order_id: str, request: Request):
-    user = await get_current_user(request)
-    if user["role"] != "company":
-        raise HTTPException(status_code=403, detail="Only companies can reject orders")
-    
+async def reject_order(order_id: str, user: dict = Depends(require_role("company", detail="Only companies can reject orders"))):
     order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
-    await db.orders.update_one({"order_id": order_id}, {"$addToSet": {"rejected_by": user["user_id"]}})
+    now = datetime.now(timezone.utc).isoformat()
+    await db.order_fanout.update_one({"order_id": order_id, "company_id": user["user_id"]}, {"$set": {"rejected_at": now}}, upsert=True)
+    await db.orders.update_one({"order_id": order_id}, {"$set": {"updated_at": now}, "$inc": {"version": 1}})
+    order_pool.reject(order_id, user["user_id"])
     return {"message": "Order rejected"}
 
 @api_router.post("/orders/{order_id}/cancel")
-async def cancel_order(order_id: str, request: Request):
-    user = await get_current_user(request)
+async def cancel_order(order_id: str, request: Request, user: dict = Depends(get_current_user)):
     body = await request.json()
     reason = body.get("reason", "")
     
@@ -446,16 +2400,30 @@ async def cancel_order(order_id: str, request: Request):
     if order["status"] in ["delivered", "cancelled"]:
         raise HTTPException(status_code=400, detail="Cannot cancel this order")
     
-    await db.orders.update_one(
-        {"order_id": order_id},
-        {"$set": {"status": "cancelled", "cancelled_at": datetime.now(timezone.utc).isoformat(), "cancel_reason": reason}}
+    messages = []
+    if user["role"] == "admin":
+        messages.append(order_status_message(order, "cancelled"))
+    if order.get("company_id"):
+        company = await get_company_profile_cached(order["company_id"])
+        if company:
+            messages.append(outbox_message(company.get("phone"), order_id, "order_cancelled", f"HALIYOL: {order_id} numaralı sipariş iptal edildi."))
+    await write_with_outbox(
+        lambda s: db.orders.update_one(
+            {"order_id": order_id},
+            {"$set": {"status": "cancelled", "cancelled_at": datetime.now(timezone.utc).isoformat(), "cancel_reason": reason, "updated_at": datetime.now(timezone.utc).isoformat()}, "$inc": {"version": 1}},
+            session=s
+        ),
+        messages
     )
+    await release_slot(order)
+    audit(user, "order.cancel", "order", order_id, previous_status=order["status"], reason=reason)
     
-    return await db.orders.find_one({"order_id": order_id}, {"_id": 0})
+    updated = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
+    order_pool.sync(updated)
+    return updated
 
 @api_router.patch("/orders/{order_id}/status")
-async def update_order_status(order_id: str, status_update: OrderStatusUpdate, request: Request):
-    user = await get_current_user(request)
+async def update_order_status(order_id: str, status_update: OrderStatusUpdate, user: dict = Depends(get_current_user)):
     order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
     
     if not order:
@@ -465,7 +2433,7 @@ async def update_order_status(order_id: str, status_update: OrderStatusUpdate, r
     if user["role"] not in ["company", "admin"]:
         raise HTTPException(status_code=403, detail="Only companies or admins can update status")
     
-    update_data = {"status": status_update.status}
+    update_data = {"status": status_update.status, "updated_at": datetime.now(timezone.utc).isoformat()}
     
     if status_update.status == "picked_up":
         update_data["pickup_date"] = datetime.now(timezone.utc).isoformat()
@@ -474,15 +2442,15 @@ async def update_order_status(order_id: str, status_update: OrderStatusUpdate, r
     elif status_update.status == "delivered":
         update_data["delivery_date"] = datetime.now(timezone.utc).isoformat()
     
-    await db.orders.update_one({"order_id": order_id}, {"$set": update_data})
-    return await db.orders.find_one({"order_id": order_id}, {"_id": 0})
+    messages = [order_status_message(order, status_update.status)] if status_update.status != order["status"] else []
+    await write_with_outbox(lambda s: db.orders.update_one({"order_id": order_id}, {"$set": update_data, "$inc": {"version": 1}}, session=s), messages)
+    audit(user, "order.status", "order", order_id, previous_status=order["status"], status=status_update.status)
+    updated = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
+    order_pool.sync(updated)
+    return updated
 
 @api_router.post("/orders/{order_id}/assign")
-async def admin_assign_order(order_id: str, assign_data: OrderAssign, request: Request):
-    user = await get_current_user(request)
-    if user["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
+async def admin_assign_order(order_id: str, assign_data: OrderAssign, user: dict = Depends(require_admin)):
     order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
@@ -491,20 +2459,26 @@ async def admin_assign_order(order_id: str, assign_data: OrderAssign, request: R
     if not company:
         raise HTTPException(status_code=404, detail="Company not found")
     
-    await db.orders.update_one(
-        {"order_id": order_id},
-        {"$set": {"company_id": assign_data.company_id, "company_name": company["company_name"], "status": "assigned", "assigned_at": datetime.now(timezone.utc).isoformat()}}
+    await write_with_outbox(
+        lambda s: db.orders.update_one(
+            {"order_id": order_id},
+            {"$set": {"company_id": assign_data.company_id, "company_name": company["company_name"], "status": "assigned", "assigned_at": datetime.now(timezone.utc).isoformat(), "updated_at": datetime.now(timezone.utc).isoformat()}, "$inc": {"version": 1}},
+            session=s
+        ),
+        assignment_messages(order, company)
     )
-    
-    return await db.orders.find_one({"order_id": order_id}, {"_id": 0})
+    audit(user, "order.assign", "order", order_id, previous_company_id=order.get("company_id"), company_id=assign_data.company_id)
+    # Başka firmaya atanan siparişin eski slot rezervasyonu serbest kalır
+    if order.get("company_id") != assign_data.company_id:
+        await release_slot(order)
+    
+    updated = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
+    order_pool.sync(updated)
+    return updated
 
 @api_router.post("/orders/{order_id}/update-carpets")
-async def update_order_carpets(order_id: str, carpet_data: CompanyUpdateOrder, request: Request):
+async def update_order_carpets(order_id: str, carpet_data: CompanyUpdateOrder, user: dict = Depends(require_role("company", "admin"))):
     """Firma tarafından gerçek halı bilgilerini girme"""
-    user = await get_current_user(request)
-    
-    if user["role"] not in ["company", "admin"]:
-        raise HTTPException(status_code=403, detail="Access denied")
     
     order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
     if not order:
@@ -550,53 +2524,62 @@ async def update_order_carpets(order_id: str, carpet_data: CompanyUpdateOrder, r
                 discount_amount = total_price * 0.10
                 final_price = total_price - discount_amount
     
-    await db.orders.update_one(
-        {"order_id": order_id},
-        {"$set": {
-            "actual_carpets": actual_carpets,
-            "actual_total_area": total_area,
-            "actual_total_price": total_price,
-            "discount_percentage": discount_percentage,
-            "discount_amount": discount_amount,
-            "final_price": final_price
-        }}
+    await write_with_outbox(
+        lambda s: db.orders.update_one(
+            {"order_id": order_id},
+            {"$set": {
+                "actual_carpets": actual_carpets,
+                "actual_total_area": total_area,
+                "actual_total_price": total_price,
+                "discount_percentage": discount_percentage,
+                "discount_amount": discount_amount,
+                "final_price": final_price,
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            }, "$inc": {"version": 1}},
+            session=s
+        ),
+        [outbox_message(order.get("customer_phone"), order_id, "order_measured", f"HALIYOL: {order_id} numaralı siparişinizdeki halılar ölçüldü: {round(total_area, 1)} m², tutar {round(final_price, 2)} TL.")]
     )
+    audit(user, "order.carpets", "order", order_id, actual_total_area=total_area, final_price=final_price)
     
     # Firma istatistiklerini güncelle
     if order.get("company_id"):
         await db.companies.update_one(
             {"user_id": order["company_id"]},
-            {"$inc": {"total_area_washed": total_area}}
+            {"$inc": {"total_area_washed": total_area, "version": 1}}
         )
+        company_cache.invalidate(order["company_id"])
     
     return await db.orders.find_one({"order_id": order_id}, {"_id": 0})
 
 # ============== COMPANY ROUTES ==============
 
 @api_router.get("/company/profile")
-async def get_company_profile(request: Request):
-    user = await get_current_user(request)
-    if user["role"] != "company":
-        raise HTTPException(status_code=403, detail="Not a company account")
-    company = await db.companies.find_one({"user_id": user["user_id"]}, {"_id": 0})
-    if not company:
-        raise HTTPException(status_code=404, detail="Company profile not found")
+async def get_company_profile(request: Request, response: Response, company: dict = Depends(get_current_company)):
+    # Profil süreç içi önbellekten gelir; başka bir worker'daki güncelleme burada henüz görünmeyebilir.
+    # Doğrulama isteğinde sürüm Mongo'dan küçük bir projeksiyonla okunur, değişmişse profil tazelenir
+    if request.headers.get("if-none-match"):
+        head = await db.companies.find_one({"user_id": company["user_id"]}, {"_id": 0, "version": 1})
+        if head is None:
+            raise HTTPException(status_code=404, detail="Company profile not found")
+        etag = document_etag("company", company["user_id"], head.get("version"))
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        if (head.get("version") or 0) != (company.get("version") or 0):
+            company_cache.invalidate(company["user_id"])
+            company = await get_company_profile_cached(company["user_id"]) or company
+    set_etag(response, document_etag("company", company["user_id"], company.get("version")))
     return company
 
 @api_router.get("/company/stats")
-async def get_company_stats(request: Request):
-    user = await get_current_user(request)
-    if user["role"] != "company":
-        raise HTTPException(status_code=403, detail="Not a company account")
-    
-    company = await db.companies.find_one({"user_id": user["user_id"]}, {"_id": 0})
-    if not company:
-        raise HTTPException(status_code=404, detail="Company profile not found")
-    
-    total_orders = await db.orders.count_documents({"company_id": user["user_id"]})
+async def get_company_stats(user: dict = Depends(require_company), company: dict = Depends(get_current_company)):
+    # Arşive taşınan teslim/iptal siparişleri de toplamlara dahil edilir (admin istatistikleri gibi)
+    archived_completed = await db.orders_archive.count_documents({"company_id": user["user_id"], "status": "delivered"})
+    archived_cancelled = await db.orders_archive.count_documents({"company_id": user["user_id"], "status": "cancelled"})
+    total_orders = await db.orders.count_documents({"company_id": user["user_id"]}) + archived_completed + archived_cancelled
     pending_orders = await db.orders.count_documents({"company_id": user["user_id"], "status": {"$in": ["assigned", "picked_up", "washing", "ready"]}})
-    completed_orders = await db.orders.count_documents({"company_id": user["user_id"], "status": "delivered"})
-    pool_orders = await db.orders.count_documents({"status": "pending", "city": company.get("city"), "rejected_by": {"$ne": user["user_id"]}})
+    completed_orders = await db.orders.count_documents({"company_id": user["user_id"], "status": "delivered"}) + archived_completed
+    pool_orders = order_pool.count(company.get("city"), user["user_id"])
     
     return {
         "total_orders": total_orders,
@@ -606,13 +2589,7 @@ async def get_company_stats(request: Request):
         "total_area_washed": company.get("total_area_washed", 0)
     }
 
-@api_router.get("/company/reports")
-async def get_company_reports(request: Request, period: str = "daily", start: Optional[str] = None, end: Optional[str] = None):
-    """Firma raporları - günlük/haftalık/aylık/yıllık veya tarih aralığı"""
-    user = await get_current_user(request)
-    if user["role"] != "company":
-        raise HTTPException(status_code=403, detail="Not a company account")
-    
+def resolve_report_range(period: str, start: Optional[str], end: Optional[str]):
     now = datetime.now(timezone.utc)
     
     # Tarih aralığı verilmişse onu kullan
@@ -636,13 +2613,21 @@ async def get_company_reports(request: Request, period: str = "daily", start: Op
         else:
             start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
         end_date = now
+    return start_date, end_date
+
+@api_router.get("/company/reports")
+async def get_company_reports(period: str = "daily", start: Optional[str] = None, end: Optional[str] = None, user: dict = Depends(require_company)):
+    """Firma raporları - günlük/haftalık/aylık/yıllık veya tarih aralığı"""
+    
+    start_date, end_date = resolve_report_range(period, start, end)
     
     # Tamamlanan siparişleri getir
-    orders = await db.orders.find({
+    include_archive = await range_needs_archive(start_date)
+    orders = [order async for order in find_orders_across({
         "company_id": user["user_id"],
         "status": "delivered",
         "delivery_date": {"$gte": start_date.isoformat(), "$lte": end_date.isoformat()}
-    }, {"_id": 0}).to_list(1000)
+    }, {"_id": 0}, include_archive, limit=1000)]
     
     # Halı türüne göre m2 ve fiyat hesapla
     carpet_stats = {"normal": {"area": 0, "price": 0}, "shaggy": {"area": 0, "price": 0}, "silk": {"area": 0, "price": 0}, "antique": {"area": 0, "price": 0}}
@@ -683,21 +2668,557 @@ async def get_company_reports(request: Request, period: str = "daily", start: Op
         "carpet_stats": carpet_stats
     }
 
+# Rapor trendleri - tek bir gruplanmış aggregation ile gün/hafta/ay kovaları
+REPORT_TIMEZONE = "Europe/Istanbul"
+TREND_UNITS = ("day", "week", "month")
+MAX_TREND_BUCKETS = 1000
+
+def truncate_to_bucket(value: datetime, unit: str) -> datetime:
+    value = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if unit == "week":
+        value -= timedelta(days=value.weekday())
+    elif unit == "month":
+        value = value.replace(day=1)
+    return value
+
+def next_bucket(value: datetime, unit: str) -> datetime:
+    if unit == "day":
+        return value + timedelta(days=1)
+    if unit == "week":
+        return value + timedelta(days=7)
+    return value.replace(year=value.year + (value.month == 12), month=value.month % 12 + 1)
+
+def resolve_trend_range(start: Optional[str], end: Optional[str]):
+    tz = ZoneInfo(REPORT_TIMEZONE)
+    try:
+        end_date = datetime.fromisoformat(end.replace('Z', '+00:00')) if end else datetime.now(tz)
+        start_date = datetime.fromisoformat(start.replace('Z', '+00:00')) if start else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date range")
+    # Saat dilimi verilmemiş tarihler İstanbul saati kabul edilir
+    if end_date.tzinfo is None:
+        end_date = end_date.replace(tzinfo=tz)
+    if start_date is None:
+        # Varsayılan: bitiş ayı dahil son 12 ay
+        month_start = truncate_to_bucket(end_date.astimezone(tz), "month")
+        months = month_start.year * 12 + month_start.month - 1 - 11
+        start_date = month_start.replace(year=months // 12, month=months % 12 + 1)
+    elif start_date.tzinfo is None:
+        start_date = start_date.replace(tzinfo=tz)
+    if start_date > end_date:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    return start_date, end_date
+
+# Siparişin geliri: indirimli son fiyat, yoksa ölçülen toplam fiyat; trendin tüm kırılımları bunu kullanır
+ORDER_REVENUE = {"$ifNull": ["$final_price", {"$ifNull": ["$actual_total_price", 0]}]}
+
+async def build_report_trend(unit: str, start_date: datetime, end_date: datetime, company_id: Optional[str] = None, by_carpet_type: bool = False, by_company: bool = False) -> dict:
+    if unit not in TREND_UNITS:
+        raise HTTPException(status_code=400, detail="unit must be one of day, week, month")
+    tz = ZoneInfo(REPORT_TIMEZONE)
+    
+    bucket_starts = []
+    cursor_date = truncate_to_bucket(start_date.astimezone(tz), unit)
+    while cursor_date <= end_date:
+        bucket_starts.append(cursor_date)
+        cursor_date = next_bucket(cursor_date, unit)
+        if len(bucket_starts) > MAX_TREND_BUCKETS:
+            raise HTTPException(status_code=400, detail="Too many buckets for this range")
+    
+    # delivery_date UTC isoformat string olarak saklanıyor; saniye hassasiyetinde tarihe çevrilir
+    match = {"status": "delivered", "delivery_date": {"$gte": start_date.astimezone(timezone.utc).isoformat(), "$lte": end_date.astimezone(timezone.utc).isoformat()}}
+    if company_id:
+        match["company_id"] = company_id
+    date_trunc = {"date": {"$dateFromString": {"dateString": {"$substrCP": ["$delivery_date", 0, 19]}, "format": "%Y-%m-%dT%H:%M:%S", "timezone": "UTC"}}, "unit": unit, "timezone": REPORT_TIMEZONE}
+    if unit == "week":
+        date_trunc["startOfWeek"] = "monday"
+    
+    group_id = {"bucket": "$bucket"}
+    if by_company:
+        group_id["company_id"] = "$company_id"
+    pipeline = [{"$match": match}, {"$set": {"bucket": {"$dateTrunc": date_trunc}}}]
+    
+    if by_carpet_type:
+        # Halı bazında kırılımda sipariş seviyesindeki gelir ve indirim halının fiyat payına göre
+        # (fiyatlar sıfırsa eşit) dağıtılır; kırılımların toplamı kırılımsız seriyle aynı olur
+        group_id["carpet_type"] = "$actual_carpets.carpet_type"
+        share = {"$cond": [
+            {"$gt": ["$carpets_price", 0]},
+            {"$divide": [{"$ifNull": ["$actual_carpets.price", 0]}, "$carpets_price"]},
+            {"$divide": [1, {"$max": ["$carpets_count", 1]}]},
+        ]}
+        pipeline += [
+            {"$set": {
+                "carpets_price": {"$sum": "$actual_carpets.price"},
+                "carpets_count": {"$size": {"$ifNull": ["$actual_carpets", []]}},
+            }},
+            # Halı girilmemiş siparişler de gelire girer (carpet_type boş)
+            {"$unwind": {"path": "$actual_carpets", "preserveNullAndEmptyArrays": True}},
+            {"$group": {
+                "_id": group_id,
+                "company_name": {"$last": "$company_name"},
+                "order_ids": {"$addToSet": "$order_id"},
+                "total_area": {"$sum": "$actual_carpets.area"},
+                "total_price": {"$sum": "$actual_carpets.price"},
+                "total_discount": {"$sum": {"$multiply": [{"$ifNull": ["$discount_amount", 0]}, share]}},
+                "total_final_price": {"$sum": {"$multiply": [ORDER_REVENUE, share]}},
+            }},
+            {"$set": {"total_orders": {"$size": "$order_ids"}}},
+            {"$unset": "order_ids"},
+        ]
+    else:
+        pipeline.append({"$group": {
+            "_id": group_id,
+            "company_name": {"$last": "$company_name"},
+            "total_orders": {"$sum": 1},
+            "total_area": {"$sum": {"$sum": "$actual_carpets.area"}},
+            "total_price": {"$sum": {"$sum": "$actual_carpets.price"}},
+            "total_discount": {"$sum": {"$ifNull": ["$discount_amount", 0]}},
+            "total_final_price": {"$sum": ORDER_REVENUE},
+        }})
+    
+    if await range_needs_archive(start_date):
+        pipeline.insert(1, {"$unionWith": {"coll": "orders_archive", "pipeline": [{"$match": match}]}})
+    
+    series = {}
+    async for row in analytics_db.orders.aggregate(pipeline):
+        key = row["_id"]
+        bucket = key["bucket"].replace(tzinfo=timezone.utc).astimezone(tz).isoformat()
+        entry = {
+            "bucket": bucket,
+            "total_orders": row["total_orders"],
+            "total_area": row["total_area"],
+            "total_price": row["total_price"],
+            "total_discount": row["total_discount"],
+            "total_final_price": row["total_final_price"],
+        }
+        if by_company:
+            entry["company_id"] = key.get("company_id")
+            entry["company_name"] = row.get("company_name")
+        if by_carpet_type:
+            entry["carpet_type"] = key.get("carpet_type")
+        series[(bucket, entry.get("company_id"), entry.get("carpet_type"))] = entry
+    
+    if by_company or by_carpet_type:
+        buckets = sorted(series.values(), key=lambda e: (e["bucket"], e.get("company_id") or "", e.get("carpet_type") or ""))
+    else:
+        # Kırılımsız seride boş kovalar sıfırla doldurulur, grafik için sürekli seri döner
+        empty = {"total_orders": 0, "total_area": 0, "total_price": 0, "total_discount": 0, "total_final_price": 0}
+        buckets = [series.get((b.isoformat(), None, None), {"bucket": b.isoformat(), **empty}) for b in bucket_starts]
+    
+    return {
+        "unit": unit,
+        "timezone": REPORT_TIMEZONE,
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+        "buckets": buckets
+    }
+
+@api_router.get("/company/reports/trend")
+async def get_company_report_trend(unit: str = "month", start: Optional[str] = None, end: Optional[str] = None, by_carpet_type: bool = False, user: dict = Depends(require_company)):
+    """Firma rapor trendi - gün/hafta/ay kovalarında alan, fiyat, indirim ve sipariş sayısı"""
+    
+    start_date, end_date = resolve_trend_range(start, end)
+    return await build_report_trend(unit, start_date, end_date, company_id=user["user_id"], by_carpet_type=by_carpet_type)
+
+# ============== ROUTE PLANNING ==============
+
+# Firmanın açık işleri: atanmış siparişler alınacak, hazır siparişler teslim edilecek
+ROUTE_STOP_TYPES = {"assigned": "pickup", "ready": "delivery"}
+ROUTE_MAX_STOPS = 2000
+# 2-opt iyileştirmesi için plan başına süre bütçesi; süre dolunca o ana kadarki en iyi sıra kullanılır
+ROUTE_TWO_OPT_BUDGET_S = 2.0
+EARTH_RADIUS_KM = 6371.0
+
+ROUTE_ORDER_PROJECTION = {
+    "_id": 0, "order_id": 1, "status": 1, "city": 1, "district": 1, "customer_name": 1, "customer_phone": 1,
+    "customer_address": 1, "carpets": 1, "actual_total_area": 1, "pickup_slot": 1,
+}
+
+def geocode_district(city: Optional[str], district: Optional[str]) -> Optional[tuple]:
+    return DISTRICT_CENTROIDS.get(city or "", {}).get(district or "")
+
+def city_centroid(city: Optional[str]) -> Optional[tuple]:
+    points = list(DISTRICT_CENTROIDS.get(city or "", {}).values())
+    if not points:
+        return None
+    return (sum(p[0] for p in points) / len(points), sum(p[1] for p in points) / len(points))
+
+def order_route_area(order: dict) -> float:
+    # Teslimatta firmanın ölçtüğü gerçek alan, alımda müşterinin tahmini kullanılır
+    if order.get("status") == "ready" and order.get("actual_total_area"):
+        return float(order["actual_total_area"])
+    return float(sum(c.get("area", 0) for c in order.get("carpets") or []))
+
+def distance_matrix_km(coords: np.ndarray) -> np.ndarray:
+    # Haversine ile tüm nokta çiftleri arasındaki kuş uçuşu mesafe
+    lat = np.radians(coords[:, 0])
+    lon = np.radians(coords[:, 1])
+    dlat = lat[:, None] - lat[None, :]
+    dlon = lon[:, None] - lon[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+def nearest_neighbour_routes(dist: np.ndarray, areas: np.ndarray, vehicles: int, capacity: float):
+    """Depodan (0. indeks) çıkan her araç için en yakın komşu rotası. Araç, kalan kapasitesine
+    sığan en yakın durağa gider; hiçbir durak sığmayınca sıradaki araca geçilir."""
+    unvisited = np.ones(len(areas), dtype=bool)
+    unvisited[0] = False
+    routes = []
+    for _ in range(vehicles):
+        route, load, current = [], 0.0, 0
+        while True:
+            candidates = unvisited & (areas <= capacity - load + 1e-9)
+            if not candidates.any():
+                break
+            current = int(np.where(candidates, dist[current], np.inf).argmin())
+            route.append(current)
+            unvisited[current] = False
+            load += areas[current]
+        if not route:
+            break
+        routes.append(route)
+    return routes, np.flatnonzero(unvisited).tolist()
+
+def two_opt(route: List[int], dist: np.ndarray, max_iterations: int = 5000, deadline: Optional[float] = None) -> List[int]:
+    """Depo iki uçta sabitken, her adımda en çok kısaltan segment ters çevirmesini uygular.
+    Tüm kenar çiftlerinin kazancı tek seferde matris olarak hesaplanır; deadline (time.monotonic)
+    geçince iyileştirme durur."""
+    path = np.array([0] + route + [0])
+    edges = len(path) - 1
+    if edges < 4:
+        return route
+    # k1 < k2 - 1: (p[k1], p[k1+1]) ve (p[k2], p[k2+1]) kenarları komşu olmamalı
+    allowed = np.triu(np.ones((edges, edges), dtype=bool), k=2)
+    for _ in range(max_iterations):
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        a, b = path[:-1], path[1:]
+        edge = dist[a, b]
+        gain = dist[np.ix_(a, a)] + dist[np.ix_(b, b)] - edge[:, None] - edge[None, :]
+        gain = np.where(allowed, gain, np.inf)
+        k1, k2 = np.unravel_index(int(gain.argmin()), gain.shape)
+        if gain[k1, k2] >= -1e-9:
+            break
+        path[k1 + 1:k2 + 1] = path[k1 + 1:k2 + 1][::-1].copy()
+    return path[1:-1].tolist()
+
+def plan_routes(stops: List[dict], depot: tuple, vehicles: int, capacity_m2: float, time_budget_s: float = ROUTE_TWO_OPT_BUDGET_S) -> dict:
+    """Durakları araçlara bölüp sıralar. Kapasite, araca yüklenen tüm alım ve teslimat
+    alanlarının toplamı olarak tutulur; bu yük profilinin zirvesinden daha temkinlidir.
+    CPU yoğun olduğu için event loop dışında (asyncio.to_thread) çağrılmalıdır."""
+    deadline = time.monotonic() + time_budget_s
+    coords = np.array([depot] + [stop["location"] for stop in stops], dtype=float)
+    areas = np.array([0.0] + [stop["area_m2"] for stop in stops], dtype=float)
+    dist = distance_matrix_km(coords)
+    routes, unassigned = nearest_neighbour_routes(dist, areas, vehicles, capacity_m2)
+    
+    plans = []
+    for number, route in enumerate(routes, start=1):
+        route = two_opt(route, dist, deadline=deadline)
+        legs = dist[[0] + route, route + [0]]
+        plans.append({
+            "vehicle": number,
+            "load_m2": round(float(areas[route].sum()), 2),
+            "distance_km": round(float(legs.sum()), 2),
+            "stops": [
+                {**{k: v for k, v in stops[i - 1].items() if k != "location"}, "sequence": seq, "leg_km": round(float(leg), 2)}
+                for seq, (i, leg) in enumerate(zip(route, legs[:-1]), start=1)
+            ],
+            "return_km": round(float(legs[-1]), 2),
+        })
+    return {
+        "vehicles": plans,
+        "total_distance_km": round(sum(p["distance_km"] for p in plans), 2),
+        "unassigned": [stops[i - 1]["order_id"] for i in unassigned],
+    }
+
+def resolve_route_day(date: Optional[str]):
+    # Plan günü İstanbul saatine göre; slot başlangıçlarıyla karşılaştırmak için UTC string aralığı
+    tz = ZoneInfo(REPORT_TIMEZONE)
+    if date:
+        try:
+            day = datetime.strptime(date, "%Y-%m-%d")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="date must be YYYY-MM-DD")
+    else:
+        day = datetime.now(tz).replace(tzinfo=None)
+    start = day.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=tz)
+    return start.date().isoformat(), slot_timestamp(start), slot_timestamp(start + timedelta(days=1))
+
+@api_router.get("/company/routes")
+async def get_company_routes(vehicles: int = 1, capacity_m2: float = 60.0, depot_district: Optional[str] = None, date: Optional[str] = None, company: dict = Depends(get_current_company)):
+    if not 1 <= vehicles <= 50:
+        raise HTTPException(status_code=400, detail="vehicles must be between 1 and 50")
+    if capacity_m2 <= 0:
+        raise HTTPException(status_code=400, detail="capacity_m2 must be positive")
+    
+    city = company.get("city")
+    if depot_district:
+        depot = geocode_district(city, depot_district)
+        if depot is None:
+            raise HTTPException(status_code=400, detail="Unknown depot district")
+    else:
+        # Depo adresi tutulmadığı için ilk hizmet ilçesi, o da yoksa şehir merkezi kullanılır
+        depot = next((geocode_district(city, d) for d in company.get("districts") or [] if geocode_district(city, d)), None) or city_centroid(city)
+        if depot is None:
+            raise HTTPException(status_code=400, detail="No location data for company city")
+    
+    # Alım slotu plan gününe düşen ya da slotsuz alımlar ile hazır teslimatlar; başka güne
+    # ayrılmış alımlar o günün rotasına girmez
+    day, day_start, day_end = resolve_route_day(date)
+    orders = await db.orders.find(
+        {
+            "company_id": company["user_id"],
+            "$or": [
+                {"status": "assigned", "pickup_slot.start": {"$gte": day_start, "$lt": day_end}},
+                {"status": "assigned", "pickup_slot": None},
+                {"status": "ready"},
+            ],
+        },
+        ROUTE_ORDER_PROJECTION,
+    ).sort("created_at", 1).to_list(ROUTE_MAX_STOPS)
+    stops, ungeocoded = [], []
+    for order in orders:
+        location = geocode_district(order.get("city"), order.get("district"))
+        if location is None:
+            ungeocoded.append(order["order_id"])
+            continue
+        stops.append({
+            "order_id": order["order_id"],
+            "type": ROUTE_STOP_TYPES[order["status"]],
+            "district": order.get("district"),
+            "customer_name": order.get("customer_name"),
+            "customer_phone": order.get("customer_phone"),
+            "customer_address": order.get("customer_address"),
+            "area_m2": round(order_route_area(order), 2),
+            "slot_start": (order.get("pickup_slot") or {}).get("start") if order["status"] == "assigned" else None,
+            "location": location,
+        })
+    
+    plan = await asyncio.to_thread(plan_routes, stops, depot, vehicles, capacity_m2) if stops else {"vehicles": [], "total_distance_km": 0, "unassigned": []}
+    plan.update({"date": day, "depot": {"lat": depot[0], "lon": depot[1]}, "capacity_m2": capacity_m2, "ungeocoded": ungeocoded})
+    return plan
+
+# ============== DEMAND FORECASTING ==============
+
+# Günlük talep serisi: (şehir, ilçe, halı türü) başına müşteri tahmini m² toplamı. Tüm seriler tek bir
+# (seri x gün) matrisinde tutulur; modeller ve backtest'ler matris üzerinde birlikte hesaplanır.
+FORECAST_SEASON = 7
+FORECAST_MIN_TRAIN_DAYS = 28
+FORECAST_BACKTEST_FOLDS = 3
+FORECAST_SES_ALPHAS = (0.1, 0.3, 0.6)
+FORECAST_MODELS = ("seasonal_naive",) + tuple(f"seasonal_ses_{a}" for a in FORECAST_SES_ALPHAS)
+FORECAST_DEFAULT_MODEL = "seasonal_ses_0.3"
+FORECAST_SERIES_KEYS = ["city", "district", "carpet_type"]
+
+def forecast_history_range(history_days: int):
+    # Bugün henüz bitmediği için seri dünden geriye doğru `history_days` gündür
+    tz = ZoneInfo(REPORT_TIMEZONE)
+    end_day = datetime.now(tz).date()
+    start_day = end_day - timedelta(days=history_days)
+    return start_day, end_day
+
+async def load_demand_matrix(history_days: int):
+    """Siparişlerden günlük talep matrisini kurar. Gruplama veritabanında yapılır; uygulamaya
+    yalnızca (gün, şehir, ilçe, halı türü) başına tek satır gelir."""
+    tz = ZoneInfo(REPORT_TIMEZONE)
+    start_day, end_day = forecast_history_range(history_days)
+    start = datetime.combine(start_day, datetime.min.time(), tz)
+    end = datetime.combine(end_day, datetime.min.time(), tz)
+    match = {
+        "created_at": {"$gte": start.astimezone(timezone.utc).isoformat(), "$lt": end.astimezone(timezone.utc).isoformat()},
+        "status": {"$ne": "cancelled"},
+    }
+    day = {"$dateToString": {
+        "date": {"$dateFromString": {"dateString": {"$substrCP": ["$created_at", 0, 19]}, "format": "%Y-%m-%dT%H:%M:%S", "timezone": "UTC"}},
+        "format": "%Y-%m-%d",
+        "timezone": REPORT_TIMEZONE,
+    }}
+    pipeline = [
+        {"$match": match},
+        {"$project": {"_id": 0, "city": 1, "district": 1, "carpets": 1, "day": day}},
+        {"$unwind": "$carpets"},
+        {"$group": {
+            "_id": {"day": "$day", "city": "$city", "district": "$district", "carpet_type": "$carpets.carpet_type"},
+            "area": {"$sum": "$carpets.area"},
+        }},
+    ]
+    if await range_needs_archive(start):
+        pipeline.insert(1, {"$unionWith": {"coll": "orders_archive", "pipeline": [{"$match": match}]}})
+    
+    rows = [{**row["_id"], "area": row["area"]} async for row in analytics_db.orders.aggregate(pipeline)]
+    days = pd.date_range(start_day, end_day - timedelta(days=1), freq="D").strftime("%Y-%m-%d")
+    if not rows:
+        return pd.DataFrame(columns=FORECAST_SERIES_KEYS), np.zeros((0, len(days))), list(days)
+    frame = pd.DataFrame(rows)
+    frame[FORECAST_SERIES_KEYS] = frame[FORECAST_SERIES_KEYS].fillna("")
+    matrix = frame.pivot_table(index=FORECAST_SERIES_KEYS, columns="day", values="area", aggfunc="sum", fill_value=0.0).reindex(columns=days, fill_value=0.0)
+    return matrix.index.to_frame(index=False), matrix.to_numpy(dtype="float64"), list(days)
+
+def forecast_models(history: np.ndarray, horizon: int) -> np.ndarray:
+    """Tüm aday modellerin tahminleri, (model, seri, gün) biçiminde. history (seri, gün) matrisidir.
+    - seasonal_naive: geçen haftanın aynı günü
+    - seasonal_ses_a: haftalık toplamsal mevsimsellik + üstel düzeltilmiş seviye (alpha = a)"""
+    if history.shape[1] < FORECAST_SEASON:
+        # Bir haftadan kısa geçmişte eksik günler, pivot'taki boş günler gibi sıfır talep sayılır
+        history = np.pad(history, ((0, 0), (FORECAST_SEASON - history.shape[1], 0)))
+    series_count, days = history.shape
+    weeks = days // FORECAST_SEASON
+    offset = days - weeks * FORECAST_SEASON
+    future_phase = (np.arange(days, days + horizon) - offset) % FORECAST_SEASON
+    
+    naive = history[:, days - FORECAST_SEASON:][:, (np.arange(horizon)) % FORECAST_SEASON]
+    
+    # Haftanın günü etkisi son tam haftalardan; seviye mevsimsellikten arındırılmış seri üzerinde
+    full_weeks = history[:, offset:].reshape(series_count, weeks, FORECAST_SEASON)
+    season = full_weeks.mean(axis=1) - full_weeks.mean(axis=(1, 2))[:, None]
+    deseasonalized = history - season[:, (np.arange(days) - offset) % FORECAST_SEASON]
+    # Üstel düzeltme kapalı formda ağırlıklı toplamdır: tüm alpha değerleri tek matris çarpımı
+    alphas = np.array(FORECAST_SES_ALPHAS)
+    ages = np.arange(days - 1, -1, -1)[:, None]
+    weights = alphas * (1 - alphas) ** ages
+    weights[0] = (1 - alphas) ** (days - 1)
+    levels = deseasonalized @ weights  # (seri, alpha)
+    ses = levels.T[:, :, None] + season[None, :, future_phase]
+    
+    return np.clip(np.concatenate([naive[None], ses]), 0.0, None)
+
+def backtest_models(history: np.ndarray, horizon: int):
+    """Kayan başlangıçlı backtest: son `folds` adet `horizon` günlük dilim sırayla saklanıp önceki
+    veriyle tahmin edilir. (model, seri) başına mutlak hata toplamı ve gerçekleşen toplam döner."""
+    days = history.shape[1]
+    folds = min(FORECAST_BACKTEST_FOLDS, max(0, (days - FORECAST_MIN_TRAIN_DAYS) // horizon))
+    abs_error = np.zeros((len(FORECAST_MODELS), history.shape[0]))
+    actual = np.zeros(history.shape[0])
+    for fold in range(folds, 0, -1):
+        cut = days - fold * horizon
+        predicted = forecast_models(history[:, :cut], horizon)
+        observed = history[:, cut:cut + horizon]
+        abs_error += np.abs(predicted - observed[None]).sum(axis=2)
+        actual += observed.sum(axis=1)
+    return folds, abs_error, actual
+
+def fit_demand_forecast(history: np.ndarray, horizon: int) -> dict:
+    folds, abs_error, actual = backtest_models(history, horizon)
+    series_index = np.arange(history.shape[0])
+    if folds:
+        # Her seri için backtest'te en az hata yapan model seçilir
+        choice = abs_error.argmin(axis=0)
+    else:
+        choice = np.full(history.shape[0], FORECAST_MODELS.index(FORECAST_DEFAULT_MODEL))
+    forecast = forecast_models(history, horizon)[choice, series_index]
+    chosen_error = abs_error[choice, series_index]
+    
+    def wape(error, total):
+        return round(float(error / total), 4) if total > 0 else None
+    
+    return {
+        "forecast": forecast,
+        "choice": choice,
+        "series_wape": [wape(e, a) if folds else None for e, a in zip(chosen_error, actual)],
+        "backtest": {
+            "folds": folds,
+            "horizon_days": horizon,
+            "wape": wape(chosen_error.sum(), actual.sum()) if folds else None,
+            "models": {
+                name: {"wape": wape(abs_error[i].sum(), actual.sum()) if folds else None, "selected": int((choice == i).sum())}
+                for i, name in enumerate(FORECAST_MODELS)
+            },
+        },
+    }
+
+async def build_demand_forecast(history_days: int, horizon: int) -> dict:
+    keys, history, days = await load_demand_matrix(history_days)
+    fit = await asyncio.to_thread(fit_demand_forecast, history, horizon)
+    start_day, end_day = forecast_history_range(history_days)
+    future_days = [(end_day + timedelta(days=i)).isoformat() for i in range(horizon)]
+    series = []
+    for i, key in enumerate(keys.to_dict("records")):
+        values = np.round(fit["forecast"][i], 2)
+        series.append({
+            **key,
+            "model": FORECAST_MODELS[fit["choice"][i]],
+            "wape": fit["series_wape"][i],
+            "history_avg_daily_m2": round(float(history[i].mean()), 2) if days else 0.0,
+            "forecast_total_m2": round(float(values.sum()), 2),
+            "daily": [{"date": d, "area_m2": float(v)} for d, v in zip(future_days, values)],
+            "weekly_m2": [round(float(values[w:w + FORECAST_SEASON].sum()), 2) for w in range(0, horizon, FORECAST_SEASON)],
+        })
+    series.sort(key=lambda s: s["forecast_total_m2"], reverse=True)
+    return {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "timezone": REPORT_TIMEZONE,
+        "history_start": start_day.isoformat(),
+        "history_end": (end_day - timedelta(days=1)).isoformat(),
+        "horizon_days": horizon,
+        "metric": "area_m2",
+        "backtest": fit["backtest"],
+        "series": series,
+    }
+
+class DemandForecaster:
+    """Tahminler tüm seriler için birlikte hesaplanıp (geçmiş, ufuk) anahtarıyla bellekte tutulur.
+    Eşzamanlı istekler aynı hesaplamayı tekrar başlatmaz; süresi dolan sonuç ilk istekte yenilenir."""
+
+    def __init__(self, ttl_s: float):
+        self.ttl_s = ttl_s
+        self._entries: dict = {}  # (history_days, horizon) -> (expires_at, forecast)
+        self._lock = asyncio.Lock()
+
+    async def get(self, history_days: int, horizon: int, refresh: bool = False) -> dict:
+        key = (history_days, horizon)
+        entry = self._entries.get(key)
+        if entry and not refresh and entry[0] > time.monotonic():
+            return entry[1]
+        async with self._lock:
+            entry = self._entries.get(key)
+            if entry and not refresh and entry[0] > time.monotonic():
+                return entry[1]
+            forecast = await build_demand_forecast(history_days, horizon)
+            self._entries[key] = (time.monotonic() + self.ttl_s, forecast)
+            return forecast
+
+demand_forecaster: Any = ScopedResource("demand_forecaster")
+
+@api_router.get("/admin/forecast")
+async def get_demand_forecast(
+    city: Optional[str] = None,
+    district: Optional[str] = None,
+    carpet_type: Optional[str] = None,
+    horizon_days: int = 28,
+    history_days: Optional[int] = None,
+    refresh: bool = False,
+    user: dict = Depends(require_admin)
+):
+    """İlçe ve halı türü bazında önümüzdeki günlerin m² talep tahmini ve backtest doğruluğu (WAPE)"""
+    history_days = history_days or app_settings.forecast_history_days
+    if not 7 <= horizon_days <= 90:
+        raise HTTPException(status_code=400, detail="horizon_days must be between 7 and 90")
+    if not 56 <= history_days <= 730:
+        raise HTTPException(status_code=400, detail="history_days must be between 56 and 730")
+    
+    forecast = await demand_forecaster.get(history_days, horizon_days, refresh)
+    series = [
+        s for s in forecast["series"]
+        if (city is None or s["city"] == city) and (district is None or s["district"] == district) and (carpet_type is None or s["carpet_type"] == carpet_type)
+    ]
+    return {**forecast, "series": series}
+
 # ============== ADMIN ROUTES ==============
 
 @api_router.get("/admin/stats")
-async def get_admin_stats(request: Request):
-    user = await get_current_user(request)
-    if user["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
-    total_orders = await db.orders.count_documents({})
-    pending_orders = await db.orders.count_documents({"status": "pending"})
-    active_orders = await db.orders.count_documents({"status": {"$in": ["assigned", "picked_up", "washing", "ready"]}})
-    completed_orders = await db.orders.count_documents({"status": "delivered"})
-    cancelled_orders = await db.orders.count_documents({"status": "cancelled"})
-    total_customers = await db.users.count_documents({"role": "customer"})
-    total_companies = await db.companies.count_documents({})
+async def get_admin_stats(user: dict = Depends(require_admin)):
+    # Arşivde yalnızca teslim edilmiş ve iptal edilmiş siparişler bulunur
+    archived_completed = await analytics_db.orders_archive.count_documents({"status": "delivered"})
+    archived_cancelled = await analytics_db.orders_archive.count_documents({"status": "cancelled"})
+    total_orders = await analytics_db.orders.count_documents({}) + archived_completed + archived_cancelled
+    pending_orders = await analytics_db.orders.count_documents({"status": "pending"})
+    active_orders = await analytics_db.orders.count_documents({"status": {"$in": ["assigned", "picked_up", "washing", "ready"]}})
+    completed_orders = await analytics_db.orders.count_documents({"status": "delivered"}) + archived_completed
+    cancelled_orders = await analytics_db.orders.count_documents({"status": "cancelled"}) + archived_cancelled
+    total_customers = await analytics_db.users.count_documents({"role": "customer"})
+    total_companies = await analytics_db.companies.count_documents({})
     
     return {
         "total_orders": total_orders,
@@ -709,43 +3230,17 @@ async def get_admin_stats(request: Request):
         "total_companies": total_companies
     }
 
-@api_router.get("/admin/reports")
-async def get_admin_reports(request: Request, period: str = "daily", company_id: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None):
-    """Admin raporları - günlük/haftalık/aylık/yıllık veya tarih aralığı, firma bazlı filtreleme"""
-    user = await get_current_user(request)
-    if user["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
-    now = datetime.now(timezone.utc)
-    
-    # Tarih aralığı verilmişse onu kullan
-    if start and end:
-        try:
-            start_date = datetime.fromisoformat(start.replace('Z', '+00:00'))
-            end_date = datetime.fromisoformat(end.replace('Z', '+00:00'))
-        except:
-            start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            end_date = now
-    else:
-        if period == "daily":
-            start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        elif period == "weekly":
-            start_date = now - timedelta(days=now.weekday())
-            start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
-        elif period == "monthly":
-            start_date = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        elif period == "yearly":
-            start_date = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
-        else:
-            start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        end_date = now
-    
+async def build_admin_report(period: str, start_date: datetime, end_date: datetime, company_id: Optional[str] = None, limit: Optional[int] = None) -> dict:
+    """`limit` verilirse en fazla o kadar sipariş toplanır; daha fazlası varsa rapor `truncated`
+    olarak işaretlenir. Export ve arka plan işi limitsiz çağırır, cursor sonuna kadar akıtılır."""
     # Query oluştur
     query = {"status": "delivered", "delivery_date": {"$gte": start_date.isoformat(), "$lte": end_date.isoformat()}}
     if company_id:
         query["company_id"] = company_id
     
-    orders = await db.orders.find(query, {"_id": 0}).to_list(1000)
+    # Kesilip kesilmediğini anlamak için bir fazlası okunur
+    cursor = find_orders_across(query, {"_id": 0}, await range_needs_archive(start_date), limit=limit + 1 if limit else None)
+    truncated = False
     
     # Halı türüne göre m2 ve fiyat hesapla
     carpet_stats = {"normal": {"area": 0, "price": 0}, "shaggy": {"area": 0, "price": 0}, "silk": {"area": 0, "price": 0}, "antique": {"area": 0, "price": 0}}
@@ -753,12 +3248,16 @@ async def get_admin_reports(request: Request, period: str = "daily", company_id:
     total_price = 0
     total_discount = 0
     total_final_price = 0
-    total_orders = len(orders)
+    total_orders = 0
     
     # Firma bazlı istatistikler
     company_stats = {}
     
-    for order in orders:
+    async for order in cursor:
+        if limit and total_orders == limit:
+            truncated = True
+            break
+        total_orders += 1
         company_id_order = order.get("company_id")
         company_name = order.get("company_name", "Bilinmeyen")
         
@@ -814,31 +3313,37 @@ async def get_admin_reports(request: Request, period: str = "daily", company_id:
         "total_discount": total_discount,
         "total_final_price": total_final_price,
         "carpet_stats": carpet_stats,
-        "company_stats": list(company_stats.values())
+        "company_stats": list(company_stats.values()),
+        "truncated": truncated,
     }
 
+@api_router.get("/admin/reports")
+async def get_admin_reports(period: str = "daily", company_id: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None, user: dict = Depends(require_admin)):
+    """Admin raporları - günlük/haftalık/aylık/yıllık veya tarih aralığı, firma bazlı filtreleme"""
+    
+    start_date, end_date = resolve_report_range(period, start, end)
+    # Büyük aralıklar için /admin/jobs üzerinden "admin_report" işi kullanılmalı
+    return await build_admin_report(period, start_date, end_date, company_id, limit=1000)
+
+@api_router.get("/admin/reports/trend")
+async def get_admin_report_trend(unit: str = "month", start: Optional[str] = None, end: Optional[str] = None, company_id: Optional[str] = None, by_carpet_type: bool = False, by_company: bool = False, user: dict = Depends(require_admin)):
+    """Admin rapor trendi - isteğe bağlı halı türü ve firma kırılımı"""
+    
+    start_date, end_date = resolve_trend_range(start, end)
+    return await build_report_trend(unit, start_date, end_date, company_id=company_id, by_carpet_type=by_carpet_type, by_company=by_company)
+
 @api_router.get("/admin/companies")
-async def get_all_companies(request: Request):
-    user = await get_current_user(request)
-    if user["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
+async def get_all_companies(user: dict = Depends(require_admin)):
     companies = await db.companies.find({}, {"_id": 0}).to_list(1000)
     return {"companies": companies}
 
 @api_router.get("/admin/users")
-async def get_all_users(request: Request):
-    user = await get_current_user(request)
-    if user["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
+async def get_all_users(user: dict = Depends(require_admin)):
     users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
     return {"users": users}
 
 @api_router.patch("/admin/users/{user_id}")
-async def update_user(user_id: str, user_update: UserUpdate, request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
+async def update_user(user_id: str, user_update: UserUpdate, admin: dict = Depends(require_admin)):
     user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -847,14 +3352,20 @@ async def update_user(user_id: str, user_update: UserUpdate, request: Request):
     if update_data:
         await db.users.update_one({"user_id": user_id}, {"$set": update_data})
     
+    # Müşteri adı/telefonu siparişlere kopyalandığı için arka planda yayılır
+    order_fields = {}
+    if "name" in update_data and update_data["name"] != user.get("name"):
+        order_fields["customer_name"] = update_data["name"]
+    if "phone" in update_data and update_data["phone"] != user.get("phone"):
+        order_fields["customer_phone"] = update_data["phone"]
+    if order_fields and user.get("role") == "customer":
+        await propagation_worker.enqueue("customer_contact", {"customer_id": user_id}, order_fields)
+    audit(admin, "user.update", "user", user_id, changes=update_data)
+    
     return await db.users.find_one({"user_id": user_id}, {"_id": 0, "password_hash": 0})
 
 @api_router.delete("/admin/users/{user_id}")
-async def delete_user(user_id: str, request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
+async def delete_user(user_id: str, admin: dict = Depends(require_admin)):
     user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -865,16 +3376,14 @@ async def delete_user(user_id: str, request: Request):
     await db.user_sessions.delete_many({"user_id": user_id})
     if user.get("role") == "company":
         await db.companies.delete_one({"user_id": user_id})
+        company_cache.invalidate(user_id)
+    audit(admin, "user.delete", "user", user_id, email=user.get("email"), role=user.get("role"), name=user.get("name"))
     
     return {"message": "User deleted successfully"}
 
 # Admin: Sistem Ayarları
 @api_router.get("/admin/settings")
-async def get_settings(request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
+async def get_settings(admin: dict = Depends(require_admin)):
     settings = await db.settings.find_one({"_id": "system_settings"}, {"_id": 0})
     if not settings:
         # Varsayılan ayarlar
@@ -890,11 +3399,7 @@ async def get_settings(request: Request):
     return {"settings": settings}
 
 @api_router.post("/admin/settings")
-async def update_settings(settings_data: dict, request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
+async def update_settings(settings_data: dict, admin: dict = Depends(require_admin)):
     settings_data["updated_at"] = datetime.now(timezone.utc).isoformat()
     
     await db.settings.update_one(
@@ -902,75 +3407,84 @@ async def update_settings(settings_data: dict, request: Request):
         {"$set": settings_data},
         upsert=True
     )
+    audit(admin, "settings.update", "settings", "system_settings", changes=settings_data)
+    public_settings_cache.clear()
     
     return {"message": "Settings updated successfully"}
 
+# Public ayarlar her sayfada okunur; kısa süre bellekte tutulur, Mongo devresi açıkken veya
+# okuma başarısız olursa son bilinen değer (o da yoksa varsayılanlar) döner
+PUBLIC_SETTINGS_DEFAULTS = {
+    "whatsapp_number": "905551234567",
+    "whatsapp_message": "Merhaba, halı yıkama hizmeti hakkında bilgi almak istiyorum."
+}
+public_settings_cache: Any = ScopedResource("public_settings_cache")  # value, expires_at
+
 # Public: Sistem Ayarlarını Getir (WhatsApp için)
 @api_router.get("/public/settings")
 async def get_public_settings():
-    settings = await db.settings.find_one({"_id": "system_settings"}, {"_id": 0})
-    if not settings:
-        settings = {
-            "whatsapp_number": "905551234567",
-            "whatsapp_message": "Merhaba, halı yıkama hizmeti hakkında bilgi almak istiyorum."
-        }
+    cached = public_settings_cache.get("value")
+    if cached and public_settings_cache["expires_at"] > time.monotonic():
+        return cached
+    if mongo_breaker.is_open():
+        return cached or dict(PUBLIC_SETTINGS_DEFAULTS)
+    
+    try:
+        with mongo_request_budget():
+            settings = await db.settings.find_one({"_id": "system_settings"}, {"_id": 0})
+    except PyMongoError as e:
+        if not (mongo_unavailable(e) or e.timeout):
+            raise
+        if mongo_unavailable(e):
+            mongo_breaker.record_failure()
+        logger.warning("Serving cached public settings, MongoDB unavailable: %s", e)
+        return cached or dict(PUBLIC_SETTINGS_DEFAULTS)
+    mongo_breaker.record_success()
+    settings = settings or {}
     
     # Sadece public bilgileri döndür
-    return {
-        "whatsapp_number": settings.get("whatsapp_number", "905551234567"),
-        "whatsapp_message": settings.get("whatsapp_message", "Merhaba, halı yıkama hizmeti hakkında bilgi almak istiyorum.")
-    }
+    value = {key: settings.get(key, default) for key, default in PUBLIC_SETTINGS_DEFAULTS.items()}
+    public_settings_cache.update(value=value, expires_at=time.monotonic() + app_settings.public_settings_ttl_s)
+    return value
 
 # Admin: Firma Onay Sistemi
 @api_router.get("/admin/companies/pending")
-async def get_pending_companies(request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
+async def get_pending_companies(admin: dict = Depends(require_admin)):
     companies = await db.companies.find({"is_approved": False}, {"_id": 0}).to_list(1000)
     return {"companies": companies}
 
 @api_router.post("/admin/companies/{user_id}/approve")
-async def approve_company(user_id: str, request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
+async def approve_company(user_id: str, admin: dict = Depends(require_admin)):
     result = await db.companies.update_one(
         {"user_id": user_id},
-        {"$set": {"is_approved": True, "is_active": True, "approved_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {"is_approved": True, "is_active": True, "approved_at": datetime.now(timezone.utc).isoformat()}, "$inc": {"version": 1}}
     )
+    company_cache.invalidate(user_id)
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Company not found")
+    audit(admin, "company.approve", "company", user_id)
     
     return {"message": "Company approved successfully"}
 
 @api_router.post("/admin/companies/{user_id}/reject")
-async def reject_company(user_id: str, request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
-    # Firmayı ve kullanıcıyı sil
-    await db.companies.delete_one({"user_id": user_id})
+async def reject_company(user_id: str, admin: dict = Depends(require_admin)):
+    # Firmayı ve kullanıcıyı sil; silinen firma denetim kaydında saklanır
+    company = await db.companies.find_one_and_delete({"user_id": user_id}, projection={"_id": 0})
+    company_cache.invalidate(user_id)
     await db.users.delete_one({"user_id": user_id})
     await db.user_sessions.delete_many({"user_id": user_id})
+    audit(admin, "company.reject", "company", user_id, company=company)
     
     return {"message": "Company rejected and deleted"}
 
 # Admin: Müşteri Oluşturma
 @api_router.post("/admin/customers/create")
-async def admin_create_customer(customer_data: dict, request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
+async def admin_create_customer(customer_data: dict, admin: dict = Depends(require_admin)):
     # Email kontrolü (varsa)
     email = customer_data.get("email", f"customer_{uuid.uuid4().hex[:8]}@noemail.local")
     if customer_data.get("email"):
-        existing = await db.users.find_one({"email": email}, {"_id": 0})
+        existing = await find_user_by_email(email)
         if existing:
             raise HTTPException(status_code=400, detail="Email already registered")
     
@@ -980,6 +3494,7 @@ async def admin_create_customer(customer_data: dict, request: Request):
     new_user = {
         "user_id": user_id,
         "email": email,
+        "email_key": normalize_email(email),
         "name": customer_data["name"],
         "password_hash": hashed_pw,
         "role": "customer",
@@ -992,23 +3507,23 @@ async def admin_create_customer(customer_data: dict, request: Request):
         "created_by_admin": True
     }
     
-    await db.users.insert_one(new_user)
+    try:
+        await db.users.insert_one(new_user)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     new_user.pop("_id", None)
     new_user.pop("password_hash", None)
+    audit(admin, "customer.create", "user", user_id, email=email)
     
     return {"message": "Customer created successfully", "user": new_user}
 
 # Admin: Firma Oluşturma
 @api_router.post("/admin/companies/create")
-async def admin_create_company(company_data: dict, request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
+async def admin_create_company(company_data: dict, admin: dict = Depends(require_admin)):
     # Email kontrolü (varsa)
     email = company_data.get("email", f"company_{uuid.uuid4().hex[:8]}@noemail.local")
     if company_data.get("email"):
-        existing = await db.users.find_one({"email": email}, {"_id": 0})
+        existing = await find_user_by_email(email)
         if existing:
             raise HTTPException(status_code=400, detail="Email already registered")
     
@@ -1017,7 +3532,8 @@ async def admin_create_company(company_data: dict, request: Request):
     
     new_user = {
         "user_id": user_id,
-        "email": company_data["email"],
+        "email": email,
+        "email_key": normalize_email(email),
         "name": company_data["company_name"],
         "password_hash": hashed_pw,
         "role": "company",
@@ -1030,12 +3546,15 @@ async def admin_create_company(company_data: dict, request: Request):
         "created_by_admin": True
     }
     
-    await db.users.insert_one(new_user)
+    try:
+        await db.users.insert_one(new_user)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     company_profile = {
         "user_id": user_id,
         "company_name": company_data["company_name"],
-        "email": company_data["email"],
+        "email": email,
         "phone": company_data["phone"],
         "city": company_data.get("city", ""),
         "districts": company_data.get("districts", []),
@@ -1052,16 +3571,101 @@ async def admin_create_company(company_data: dict, request: Request):
     
     new_user.pop("_id", None)
     new_user.pop("password_hash", None)
+    audit(admin, "company.create", "company", user_id, company_name=company_profile["company_name"])
     
     return {"message": "Company created successfully", "user": new_user}
 
+# Anahtar kümesi (keyset) sayfalama: skip yerine son kaydın sıralama anahtarları imleç olarak döner,
+# her sayfa index üzerinde doğrudan kaldığı yerden okunur
+def encode_page_cursor(*values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode().rstrip("=")
+
+def decode_page_cursor(cursor: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def keyset_after(fields: List[str], values: list) -> dict:
+    # Tüm alanlarda azalan sıralamada verilen anahtardan sonra gelen kayıtlar
+    return {"$or": [
+        {**dict(zip(fields[:i], values[:i])), field: {"$lt": values[i]}}
+        for i, field in enumerate(fields)
+    ]}
+
+# Admin: Sipariş Arama (sunucu tarafı, index destekli)
+ORDER_SEARCH_SORT = ["created_at", "order_id"]
+ORDER_LIST_PROJECTION = {
+    "_id": 0, "order_id": 1, "customer_name": 1, "customer_phone": 1, "city": 1, "district": 1,
+    "status": 1, "company_id": 1, "company_name": 1, "carpet_count": 1, "actual_total_area": 1,
+    "final_price": 1, "created_at": 1, "delivery_date": 1
+}
+
+@api_router.get("/admin/orders/search")
+async def search_orders(
+    q: Optional[str] = None,
+    order_id: Optional[str] = None,
+    phone: Optional[str] = None,
+    name: Optional[str] = None,
+    city: Optional[str] = None,
+    district: Optional[str] = None,
+    status: Optional[str] = None,
+    company_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    page_size: int = 50,
+    include_archive: bool = True,
+    admin: dict = Depends(require_admin)
+):
+    if q and name:
+        raise HTTPException(status_code=400, detail="q and name cannot be combined")
+    
+    page_size = min(max(page_size, 1), 200)
+    
+    query = {}
+    if q:
+        # Müşteri adı, adres ve notlar üzerindeki Türkçe text index
+        query["$text"] = {"$search": q}
+    if order_id:
+        prefix = order_id.strip().upper()
+        if not prefix.startswith("ORD-"):
+            prefix = f"ORD-{prefix}"
+        # Sabit önekli regex order_id index'i üzerinde aralık taraması yapar
+        query["order_id"] = {"$regex": f"^{re.escape(prefix)}"}
+    if phone:
+        query["customer_phone"] = phone.strip()
+    if name:
+        # Baştan eşleşme collation ile aralık olarak sorgulanır (regex collation kullanmaz). ICU'da U+FFFF
+        # en yüksek birincil ağırlıklı karakterdir; aralık önekle başlayan tüm adları kapsar
+        prefix = name.strip()
+        query["customer_name"] = {"$gte": prefix, "$lt": prefix + "\uffff"}
+    if city:
+        query["city"] = city
+    if district:
+        query["district"] = district
+    if status:
+        query["status"] = status
+    if company_id:
+        query["company_id"] = company_id
+    
+    if cursor:
+        query.setdefault("$and", []).append(keyset_after(ORDER_SEARCH_SORT, decode_page_cursor(cursor, len(ORDER_SEARCH_SORT))))
+    
+    # İsim araması büyük/küçük harf duyarsız Türkçe karşılaştırma kullanır; customer_name index'i aynı collation ile kurulu
+    collation = TURKISH_CI_COLLATION if name else None
+    orders = await find_orders_page(query, ORDER_LIST_PROJECTION, ORDER_SEARCH_SORT, page_size + 1, include_archive=include_archive, collation=collation)
+    
+    next_cursor = None
+    if len(orders) > page_size:
+        orders = orders[:page_size]
+        next_cursor = encode_page_cursor(*(orders[-1].get(field) for field in ORDER_SEARCH_SORT))
+    return {"orders": orders, "page_size": page_size, "next_cursor": next_cursor}
+
 # Admin: Sipariş Oluşturma
 @api_router.post("/admin/orders/create")
-async def admin_create_order(order_data: dict, request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
+async def admin_create_order(order_data: dict, admin: dict = Depends(require_admin)):
     carpet_details = []
     for carpet in order_data["carpets"]:
         area = carpet["width"] * carpet["length"]
@@ -1072,13 +3676,11 @@ async def admin_create_order(order_data: dict, request: Request):
             "area": area
         })
     
-    order_id = f"ORD-{uuid.uuid4().hex[:8].upper()}"
-    
     # Email yoksa otomatik oluştur
     customer_email = order_data.get("email", f"order_{uuid.uuid4().hex[:8]}@noemail.local")
     
     order = {
-        "order_id": order_id,
+        "order_id": None,  # insert_order tarafından atanır
         "customer_id": None,  # Admin tarafından oluşturulan siparişlerde customer_id yok
         "customer_name": order_data["customer_name"],
         "customer_phone": order_data["phone"],
@@ -1101,6 +3703,7 @@ async def admin_create_order(order_data: dict, request: Request):
         "notified_companies": [],
         "rejected_by": [],
         "created_at": datetime.now(timezone.utc).isoformat(),
+        "updated_at": datetime.now(timezone.utc).isoformat(),
         "created_by_admin": True,
         "assigned_at": None,
         "pickup_date": None,
@@ -1110,18 +3713,16 @@ async def admin_create_order(order_data: dict, request: Request):
         "cancel_reason": None
     }
     
-    await db.orders.insert_one(order)
+    await insert_order(order)
     order.pop("_id", None)
+    order_pool.add(order)
+    audit(admin, "order.create", "order", order["order_id"])
     
     return {"message": "Order created successfully", "order": order}
 
 # Admin: Firmaya Sipariş Atama
 @api_router.post("/admin/orders/{order_id}/assign")
-async def admin_assign_order(order_id: str, assignment_data: dict, request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
+async def admin_assign_order(order_id: str, assignment_data: dict, admin: dict = Depends(require_admin)):
     order = await db.orders.find_one({"order_id": order_id}, {"_id": 0})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
@@ -1131,99 +3732,175 @@ async def admin_assign_order(order_id: str, assignment_data: dict, request: Requ
     if not company:
         raise HTTPException(status_code=404, detail="Company not found")
     
-    await db.orders.update_one(
-        {"order_id": order_id},
-        {"$set": {
-            "company_id": company_id,
-            "company_name": company["company_name"],
-            "status": "assigned",
-            "assigned_at": datetime.now(timezone.utc).isoformat()
-        }}
+    await write_with_outbox(
+        lambda s: db.orders.update_one(
+            {"order_id": order_id},
+            {"$set": {
+                "company_id": company_id,
+                "company_name": company["company_name"],
+                "status": "assigned",
+                "assigned_at": datetime.now(timezone.utc).isoformat(),
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            }, "$inc": {"version": 1}},
+            session=s
+        ),
+        assignment_messages(order, company)
     )
+    audit(admin, "order.assign", "order", order_id, previous_company_id=order.get("company_id"), company_id=company_id)
+    if order.get("company_id") != company_id:
+        await release_slot(order)
+    order_pool.remove(order_id)
     
     return {"message": "Order assigned successfully"}
 
-# Admin: Excel Export - Müşteriler
-@api_router.get("/admin/export/customers")
-async def export_customers(request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
-    customers = await db.users.find({"role": "customer"}, {"_id": 0, "password_hash": 0}).to_list(10000)
-    
-    # CSV formatında döndür
-    import io
-    output = io.StringIO()
-    output.write("User ID,Name,Email,Phone,City,District,Address,Created At,Is Banned\n")
-    
-    for customer in customers:
-        output.write(f'{customer.get("user_id","")},{customer.get("name","")},{customer.get("email","")},{customer.get("phone","")},{customer.get("city","")},{customer.get("district","")},{customer.get("address","")},{customer.get("created_at","")},{customer.get("is_banned","")}\n')
-    
-    from fastapi.responses import StreamingResponse
-    output.seek(0)
+# Admin: Excel Export - kolon tanımları (CSV, XLSX ve arka plan işleri ortak kullanır)
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+EXPORT_FORMATS = {
+    "csv": ("csv", "text/csv"),
+    "xlsx": ("xlsx", XLSX_MEDIA_TYPE),
+    "json": ("json", "application/json"),
+}
+
+CUSTOMER_EXPORT_COLUMNS = [
+    ("User ID", "user_id"), ("Name", "name"), ("Email", "email"), ("Phone", "phone"), ("City", "city"),
+    ("District", "district"), ("Address", "address"), ("Created At", "created_at"), ("Is Banned", "is_banned")
+]
+COMPANY_EXPORT_COLUMNS = [
+    ("User ID", "user_id"), ("Company Name", "company_name"), ("Email", "email"), ("Phone", "phone"), ("City", "city"),
+    ("Districts", "districts"), ("Address", "address"), ("Is Active", "is_active"), ("Is Approved", "is_approved"),
+    ("Total Area Washed", "total_area_washed"), ("Created At", "created_at")
+]
+ORDER_EXPORT_COLUMNS = [
+    ("Order ID", "order_id"), ("Customer Name", "customer_name"), ("Customer Email", "customer_email"),
+    ("Customer Phone", "customer_phone"), ("City", "city"), ("District", "district"), ("Address", "customer_address"),
+    ("Company Name", "company_name"), ("Status", "status"), ("Carpet Count", "carpet_count"),
+    ("Total Area", "actual_total_area"), ("Total Price", "actual_total_price"), ("Discount", "discount_amount"),
+    ("Final Price", "final_price"), ("Created At", "created_at"), ("Delivery Date", "delivery_date")
+]
+
+def export_cursor(entity: str):
+    if entity == "customers":
+        return analytics_db.users.find({"role": "customer"}, {"_id": 0, "password_hash": 0}), CUSTOMER_EXPORT_COLUMNS
+    if entity == "companies":
+        return analytics_db.companies.find({}, {"_id": 0}), COMPANY_EXPORT_COLUMNS
+    # Sipariş export'u arşivlenmiş siparişleri de kapsar
+    return find_orders_across({}, {"_id": 0}, include_archive=True), ORDER_EXPORT_COLUMNS
+
+def export_row(doc: dict, columns) -> list:
+    values = []
+    for _, field in columns:
+        value = doc.get(field, "")
+        if isinstance(value, list):
+            value = ";".join(str(v) for v in value)
+        values.append(value)
+    return values
+
+async def export_value_rows(entity: str):
+    cursor, columns = export_cursor(entity)
+    async for doc in cursor:
+        yield export_row(doc, columns)
+
+async def export_csv_rows(entity: str):
+    _, columns = export_cursor(entity)
+    yield ",".join(header for header, _ in columns) + "\n"
+    async for values in export_value_rows(entity):
+        yield ",".join(str(value) for value in values) + "\n"
+
+def _write_xlsx_rows(worksheet, first_row: int, rows: List[list]):
+    for offset, values in enumerate(rows):
+        worksheet.write_row(first_row + offset, 0, values)
+
+async def iterate_rows(rows):
+    for row in rows:
+        yield row
+
+async def write_xlsx(path: Path, sheets, batch_size: int = 1000):
+    """Sabit bellekli XLSX yazımı - her satır diske akıtılır, satırlar cursor'dan gruplar
+    halinde okunur ve yazım event loop dışında yapılır. `sheets`: (ad, başlıklar, async satırlar)."""
+    workbook = xlsxwriter.Workbook(str(path), {"constant_memory": True, "strings_to_numbers": False, "strings_to_urls": False})
+    try:
+        for name, headers, rows in sheets:
+            worksheet = workbook.add_worksheet(name)
+            worksheet.write_row(0, 0, headers)
+            next_row, batch = 1, []
+            async for values in rows:
+                batch.append(values)
+                if len(batch) >= batch_size:
+                    await asyncio.to_thread(_write_xlsx_rows, worksheet, next_row, batch)
+                    next_row, batch = next_row + len(batch), []
+            if batch:
+                await asyncio.to_thread(_write_xlsx_rows, worksheet, next_row, batch)
+    finally:
+        await asyncio.to_thread(workbook.close)
+
+async def write_entity_xlsx(entity: str, path: Path):
+    _, columns = export_cursor(entity)
+    await write_xlsx(path, [(entity.capitalize(), [header for header, _ in columns], export_value_rows(entity))])
+
+async def write_report_xlsx(report: dict, path: Path):
+    summary = [
+        ["Period", report["period"]], ["Start Date", report["start_date"]], ["End Date", report["end_date"]],
+        ["Total Orders", report["total_orders"]], ["Total Area", report["total_area"]], ["Total Price", report["total_price"]],
+        ["Total Discount", report["total_discount"]], ["Total Final Price", report["total_final_price"]]
+    ]
+    carpets = [[carpet_type, stats["area"], stats["price"]] for carpet_type, stats in report["carpet_stats"].items()]
+    companies = [
+        [c["name"], c["order_count"], c["total_area"], c["total_price"], c["total_discount"], c["total_final_price"]]
+        for c in report.get("company_stats", [])
+    ]
+    await write_xlsx(path, [
+        ("Summary", ["Metric", "Value"], iterate_rows(summary)),
+        ("Carpet Types", ["Carpet Type", "Area", "Price"], iterate_rows(carpets)),
+        ("Companies", ["Company", "Orders", "Area", "Price", "Discount", "Final Price"], iterate_rows(companies)),
+    ])
+
+async def xlsx_file_response(writer, filename: str) -> FileResponse:
+    # Geçici dosyaya yaz, yanıt gönderildikten sonra sil
+    fd, tmp_path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        await writer(Path(tmp_path))
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return FileResponse(tmp_path, media_type=XLSX_MEDIA_TYPE, filename=filename, background=BackgroundTask(os.unlink, tmp_path))
+
+async def export_response(entity: str, format: str):
+    if format == "xlsx":
+        return await xlsx_file_response(lambda path: write_entity_xlsx(entity, path), f"{entity}.xlsx")
+    if format != "csv":
+        raise HTTPException(status_code=400, detail="format must be csv or xlsx")
     return StreamingResponse(
-        iter([output.getvalue()]),
+        export_csv_rows(entity),
         media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=customers.csv"}
+        headers={"Content-Disposition": f"attachment; filename={entity}.csv"}
     )
 
+# Admin: Excel Export - Müşteriler
+@api_router.get("/admin/export/customers")
+async def export_customers(format: str = "csv", admin: dict = Depends(require_admin)):
+    return await export_response("customers", format)
+
 # Admin: Excel Export - Firmalar
 @api_router.get("/admin/export/companies")
-async def export_companies(request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
-    companies = await db.companies.find({}, {"_id": 0}).to_list(10000)
-    
-    import io
-    output = io.StringIO()
-    output.write("User ID,Company Name,Email,Phone,City,Districts,Address,Is Active,Is Approved,Total Area Washed,Created At\n")
-    
-    for company in companies:
-        districts = ";".join(company.get("districts", []))
-        output.write(f'{company.get("user_id","")},{company.get("company_name","")},{company.get("email","")},{company.get("phone","")},{company.get("city","")},{districts},{company.get("address","")},{company.get("is_active","")},{company.get("is_approved","")},{company.get("total_area_washed","")},{company.get("created_at","")}\n')
-    
-    from fastapi.responses import StreamingResponse
-    output.seek(0)
-    return StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=companies.csv"}
-    )
+async def export_companies(format: str = "csv", admin: dict = Depends(require_admin)):
+    return await export_response("companies", format)
 
 # Admin: Excel Export - Siparişler
 @api_router.get("/admin/export/orders")
-async def export_orders(request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
-    orders = await db.orders.find({}, {"_id": 0}).to_list(10000)
-    
-    import io
-    output = io.StringIO()
-    output.write("Order ID,Customer Name,Customer Email,Customer Phone,City,District,Address,Company Name,Status,Carpet Count,Total Area,Total Price,Discount,Final Price,Created At,Delivery Date\n")
-    
-    for order in orders:
-        output.write(f'{order.get("order_id","")},{order.get("customer_name","")},{order.get("customer_email","")},{order.get("customer_phone","")},{order.get("city","")},{order.get("district","")},{order.get("customer_address","")},{order.get("company_name","")},{order.get("status","")},{order.get("carpet_count","")},{order.get("actual_total_area","")},{order.get("actual_total_price","")},{order.get("discount_amount","")},{order.get("final_price","")},{order.get("created_at","")},{order.get("delivery_date","")}\n')
-    
-    from fastapi.responses import StreamingResponse
-    output.seek(0)
-    return StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=orders.csv"}
-    )
+async def export_orders(format: str = "csv", admin: dict = Depends(require_admin)):
+    return await export_response("orders", format)
+
+# Admin: Excel Export - Rapor Özeti
+@api_router.get("/admin/export/reports")
+async def export_reports(period: str = "daily", company_id: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None, admin: dict = Depends(require_admin)):
+    start_date, end_date = resolve_report_range(period, start, end)
+    report = await build_admin_report(period, start_date, end_date, company_id)
+    return await xlsx_file_response(lambda path: write_report_xlsx(report, path), f"report_{period}.xlsx")
 
 
 @api_router.post("/admin/users/{user_id}/ban")
-async def ban_user(user_id: str, request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
+async def ban_user(user_id: str, admin: dict = Depends(require_admin)):
     user = await db.users.find_one({"user_id": user_id}, {"_id": 0})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -1232,22 +3909,17 @@ async def ban_user(user_id: str, request: Request):
     
     await db.users.update_one({"user_id": user_id}, {"$set": {"is_banned": True}})
     await db.user_sessions.delete_many({"user_id": user_id})
+    audit(admin, "user.ban", "user", user_id)
     return {"message": "User banned successfully"}
 
 @api_router.post("/admin/users/{user_id}/unban")
-async def unban_user(user_id: str, request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
+async def unban_user(user_id: str, admin: dict = Depends(require_admin)):
     await db.users.update_one({"user_id": user_id}, {"$set": {"is_banned": False}})
+    audit(admin, "user.unban", "user", user_id)
     return {"message": "User unbanned successfully"}
 
 @api_router.patch("/admin/companies/{user_id}")
-async def update_company(user_id: str, request: Request):
-    admin = await get_current_user(request)
-    if admin["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Admin access required")
-    
+async def update_company(user_id: str, request: Request, admin: dict = Depends(require_admin)):
     body = await request.json()
     company = await db.companies.find_one({"user_id": user_id}, {"_id": 0})
     if not company:
@@ -1260,30 +3932,1288 @@ async def update_company(user_id: str, request: Request):
         update_data["company_name"] = body["company_name"]
     
     if update_data:
-        await db.companies.update_one({"user_id": user_id}, {"$set": update_data})
+        await db.companies.update_one({"user_id": user_id}, {"$set": update_data, "$inc": {"version": 1}})
+        company_cache.invalidate(user_id)
+        audit(admin, "company.update", "company", user_id, changes=update_data, previous={k: company.get(k) for k in update_data})
+    
+    # Firma adı siparişlere kopyalandığı için arka planda yayılır, admin isteği beklemez
+    if "company_name" in update_data and update_data["company_name"] != company.get("company_name"):
+        await propagation_worker.enqueue("company_name", {"company_id": user_id}, {"company_name": update_data["company_name"]})
     
     return await db.companies.find_one({"user_id": user_id}, {"_id": 0})
 
-# ============== ROOT ROUTES ==============
+# ============== CHANGE PROPAGATION ==============
 
-@api_router.get("/")
-async def root():
-    return {"message": "HALIYOL API - Halı Yıkama Platformu"}
+# kind -> (kaynak koleksiyon, sipariş alanı -> kaynak alanı); kaynak kayıt `user_id` ile bulunur
+PROPAGATION_SOURCES = {
+    "company_name": ("companies", {"company_name": "company_name"}),
+    "customer_contact": ("users", {"customer_name": "name", "customer_phone": "phone"}),
+}
+
+class PropagationWorker:
+    """Siparişlere kopyalanan (denormalize) alanları arka planda günceller. Görevler
+    `propagations` koleksiyonunda tutulur; worker bunları lease ile talep eder ve sınırlı
+    boyutlu `update_many` parçalarıyla işler. Filtre yalnızca hâlâ eski değeri taşıyan
+    siparişleri seçtiği için görev idempotenttir ve yarıda kalırsa kaldığı yerden devam eder.
+    Yazılacak değerler görevdeki kopyadan değil çalışma anında kaynak kayıttan okunur; görevler
+    farklı worker'larda sırasız çalışsa da siparişler kaynağın son değerinde kalır."""
+
+    def __init__(self, chunk_size: int, pause_s: float, lease_s: int, poll_interval_s: float):
+        self.chunk_size = chunk_size
+        self.pause_s = pause_s
+        self.lease_s = lease_s
+        self.poll_interval_s = poll_interval_s
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def enqueue(self, kind: str, match: dict, fields: dict) -> str:
+        now = datetime.now(timezone.utc).isoformat()
+        # Aynı varlık için henüz başlamamış bir görev varsa yalnızca hedef değerleri güncellenir
+        queued = await db.propagations.find_one_and_update(
+            {"kind": kind, "match": match, "status": "queued"},
+            {"$set": {"fields": fields, "updated_at": now}},
+            projection={"_id": 0, "task_id": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if queued:
+            return queued["task_id"]
+        
+        task_id = f"prop_{uuid.uuid4().hex[:12]}"
+        await db.propagations.insert_one({
+            "task_id": task_id,
+            "kind": kind,
+            "match": match,
+            "fields": fields,
+            "status": "queued",
+            "processed": 0,
+            "chunks": 0,
+            "created_at": now,
+            "updated_at": now,
+            "started_at": None,
+            "finished_at": None,
+            "lease_expires_at": None,
+            "error": None
+        })
+        self._wakeup.set()
+        return task_id
+
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        return await db.propagations.find_one_and_update(
+            {"$or": [{"status": "queued"}, {"status": "running", "lease_expires_at": {"$lt": now.isoformat()}}]},
+            {"$set": {"status": "running", "started_at": now.isoformat(), "lease_expires_at": (now + timedelta(seconds=self.lease_s)).isoformat()}},
+            projection={"_id": 0},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _loop(self):
+        while True:
+            try:
+                task = await self._claim()
+            except PyMongoError as e:
+                logger.warning("Propagation worker could not claim a task: %s", e)
+                task = None
+            if task is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval_s)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run(task)
+            except Exception as e:
+                logger.exception("Propagation task %s failed", task["task_id"])
+                await db.propagations.update_one(
+                    {"task_id": task["task_id"]},
+                    {"$set": {"status": "failed", "error": str(e), "finished_at": datetime.now(timezone.utc).isoformat()}}
+                )
+
+    async def current_fields(self, task: dict) -> dict:
+        collection, mapping = PROPAGATION_SOURCES[task["kind"]]
+        source = await db[collection].find_one({"user_id": next(iter(task["match"].values()))}, {"_id": 0})
+        if source is None:
+            return task["fields"]
+        return {field: source.get(mapping[field]) for field in task["fields"]}
+
+    async def _run(self, task: dict):
+        fields = await self.current_fields(task)
+        stale = {**task["match"], "$or": [{field: {"$ne": value}} for field, value in fields.items()]}
+        # Arşivlenmiş siparişler de aynı değeri taşır
+        for collection in (db.orders, db.orders_archive):
+            while True:
+                ids = [doc["_id"] async for doc in collection.find(stale, {"_id": 1}).limit(self.chunk_size)]
+                if not ids:
+                    break
+                now = datetime.now(timezone.utc)
+                result = await collection.update_many({"_id": {"$in": ids}, **stale}, {"$set": {**fields, "updated_at": now.isoformat()}, "$inc": {"version": 1}})
+                await db.propagations.update_one(
+                    {"task_id": task["task_id"]},
+                    {"$inc": {"processed": result.modified_count, "chunks": 1}, "$set": {"lease_expires_at": (now + timedelta(seconds=self.lease_s)).isoformat()}}
+                )
+                # Parçalar arasında kısa bekleme, primary üzerindeki yazma yükünü yayar
+                await asyncio.sleep(self.pause_s)
+        await db.propagations.update_one(
+            {"task_id": task["task_id"]},
+            {"$set": {"status": "completed", "finished_at": datetime.now(timezone.utc).isoformat()}}
+        )
+
+propagation_worker: Any = ScopedResource("propagation_worker")
+
+@api_router.get("/admin/propagations")
+async def list_propagations(status: Optional[str] = None, admin: dict = Depends(require_admin)):
+    query = {"status": status} if status else {}
+    tasks = await db.propagations.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
+    return {"propagations": tasks}
+
+@api_router.get("/admin/propagations/{task_id}")
+async def get_propagation(task_id: str, admin: dict = Depends(require_admin)):
+    task = await db.propagations.find_one({"task_id": task_id}, {"_id": 0})
+    if not task:
+        raise HTTPException(status_code=404, detail="Propagation task not found")
+    return task
+
+# ============== NOTIFICATION OUTBOX ==============
+
+ORDER_STATUS_LABELS = {
+    "assigned": "firmaya atandı",
+    "picked_up": "teslim alındı",
+    "washing": "yıkanıyor",
+    "ready": "teslime hazır",
+    "delivered": "teslim edildi",
+    "cancelled": "iptal edildi",
+}
+
+# Gönderimde takılan parti bu süreden sonra başka bir worker tarafından yeniden talep edilir
+OUTBOX_LEASE_S = 60
+
+def outbox_message(recipient: Optional[str], order_id: Optional[str], event: str, text: str) -> Optional[dict]:
+    """Gönderilecek tek bir mesaj. `coalesce_key` aynı alıcıya aynı sipariş için biriken
+    mesajlardan yalnızca en yenisinin gönderilmesini sağlar."""
+    if not recipient:
+        return None
+    now = datetime.now(timezone.utc)
+    settings = app_settings or Settings.model_construct()
+    return {
+        "message_id": f"msg_{uuid.uuid4().hex[:12]}",
+        "channel": settings.notification_channel,
+        "recipient": recipient,
+        "order_id": order_id,
+        "event": event,
+        "text": text,
+        "coalesce_key": f"{recipient}:{order_id}",
+        "status": "pending",
+        "attempts": 0,
+        # Birleştirme penceresi: kısa sürede gelen durum değişiklikleri tek mesaja indirgenir
+        "next_attempt_at": (now + timedelta(seconds=settings.outbox_coalesce_window_s)).isoformat(),
+        "created_at": now.isoformat(),
+        "sent_at": None,
+        "error": None,
+    }
+
+def assignment_messages(order: dict, company: dict) -> List[Optional[dict]]:
+    order_id = order["order_id"]
+    return [
+        outbox_message(order.get("customer_phone"), order_id, "order_assigned", f"HALIYOL: {order_id} numaralı siparişiniz {company['company_name']} firmasına atandı."),
+        outbox_message(company.get("phone"), order_id, "order_assigned", f"HALIYOL: {order.get('district')} bölgesinden {order_id} numaralı sipariş size atandı."),
+    ]
+
+def order_status_message(order: dict, status: str) -> Optional[dict]:
+    label = ORDER_STATUS_LABELS.get(status, status)
+    return outbox_message(order.get("customer_phone"), order["order_id"], f"order_{status}", f"HALIYOL: {order['order_id']} numaralı siparişiniz {label}.")
+
+async def write_with_outbox(write, messages: List[Optional[dict]]):
+    """`write(session)` sipariş yazımını yapar; outbox mesajları mümkünse aynı transaction'da eklenir,
+    böylece sipariş değişikliği ile bildirimi birlikte kaydedilir ya da hiçbiri kaydedilmez."""
+    scope = active_scope()
+    messages = [m for m in messages if m]
+    if messages and scope.client is not None and scope.outbox_transactions_supported:
+        try:
+            async with await scope.client.start_session() as session:
+                async def callback(s):
+                    result = await write(s)
+                    await db.outbox.insert_many(messages, session=s)
+                    return result
+                return await session.with_transaction(callback)
+        except OperationFailure as e:
+            # Replica set değilse (standalone) transaction desteklenmez; ilk hatada sıralı yazmaya düşülür.
+            # 20 = IllegalOperation: "Transaction numbers are only allowed on a replica set member or mongos"
+            if e.code != 20:
+                raise
+            logger.warning("MongoDB does not support transactions; outbox messages are written after the order")
+            scope.outbox_transactions_supported = False
+    result = await write(None)
+    if messages:
+        await db.outbox.insert_many(messages)
+    return result
+
+class NotificationSender(ABC):
+    """Kanal başına gönderici; `send` hata fırlatırsa mesaj geri çekilip tekrar denenir."""
+
+    @abstractmethod
+    async def send(self, recipient: str, text: str):
+        ...
+
+    async def close(self):
+        pass
+
+class StubSender(NotificationSender):
+    """Yerel geliştirme ve testler için: mesajları gönderilmiş sayar ve bellekte tutar."""
+
+    def __init__(self, keep: int = 1000):
+        self.sent: deque = deque(maxlen=keep)
+
+    async def send(self, recipient: str, text: str):
+        self.sent.append((recipient, text))
+        logger.info("Stub notification to %s: %s", recipient, text)
+
+class SmsSender(NotificationSender):
+    """JSON kabul eden genel bir SMS sağlayıcısı: POST {to, from, message}, Bearer anahtar."""
+
+    def __init__(self, url: str, api_key: str, sender_id: Optional[str]):
+        self.url = url
+        self.sender_id = sender_id
+        self._http = httpx.AsyncClient(timeout=10, headers={"Authorization": f"Bearer {api_key}"})
+
+    async def send(self, recipient: str, text: str):
+        resp = await self._http.post(self.url, json={"to": recipient, "from": self.sender_id, "message": text})
+        resp.raise_for_status()
+
+    async def close(self):
+        await self._http.aclose()
+
+class WhatsAppSender(NotificationSender):
+    """WhatsApp Cloud API metin mesajı."""
+
+    def __init__(self, phone_number_id: str, access_token: str, api_version: str = "v19.0"):
+        self.url = f"https://graph.facebook.com/{api_version}/{phone_number_id}/messages"
+        self._http = httpx.AsyncClient(timeout=10, headers={"Authorization": f"Bearer {access_token}"})
+
+    async def send(self, recipient: str, text: str):
+        resp = await self._http.post(self.url, json={"messaging_product": "whatsapp", "to": recipient, "type": "text", "text": {"body": text}})
+        resp.raise_for_status()
+
+    async def close(self):
+        await self._http.aclose()
+
+def build_notification_senders(settings: Settings) -> dict:
+    senders = {"stub": StubSender()}
+    if settings.sms_api_url and settings.sms_api_key:
+        senders["sms"] = SmsSender(settings.sms_api_url, settings.sms_api_key, settings.sms_sender_id)
+    if settings.whatsapp_phone_number_id and settings.whatsapp_access_token:
+        senders["whatsapp"] = WhatsAppSender(settings.whatsapp_phone_number_id, settings.whatsapp_access_token)
+    return senders
+
+class OutboxDispatcher:
+    """`outbox` koleksiyonunu partiler halinde boşaltır. Vadesi gelen mesajlar claim_id ile
+    talep edilir; aynı alıcı ve sipariş için pencerede bekleyen mesajlar da partiye çekilir.
+    Aynı alıcıya giden mesajlar tek mesajda birleştirilir, aynı siparişin eski durum mesajları
+    atlanır. Başarısız gönderimler üstel bekleme ile tekrar denenir."""
+
+    def __init__(self, senders: dict, batch_size: int, poll_interval_s: float, max_attempts: int, backoff_base_s: float, lease_s: int, concurrency: int = 8):
+        self.senders = senders
+        self.batch_size = batch_size
+        self.poll_interval_s = poll_interval_s
+        self.max_attempts = max_attempts
+        self.backoff_base_s = backoff_base_s
+        self.lease_s = lease_s
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for sender in self.senders.values():
+            await sender.close()
+
+    async def _claim(self) -> List[dict]:
+        now = datetime.now(timezone.utc)
+        due = {"$or": [
+            {"status": "pending", "next_attempt_at": {"$lte": now.isoformat()}},
+            {"status": "sending", "lease_expires_at": {"$lt": now.isoformat()}},
+        ]}
+        ids = [doc["_id"] async for doc in db.outbox.find(due, {"_id": 1}).sort("next_attempt_at", 1).limit(self.batch_size)]
+        if not ids:
+            return []
+        claim_id = uuid.uuid4().hex
+        claim = {"$set": {"status": "sending", "claim_id": claim_id, "lease_expires_at": (now + timedelta(seconds=self.lease_s)).isoformat()}}
+        await db.outbox.update_many({"_id": {"$in": ids}, **due}, claim)
+        keys = await db.outbox.distinct("coalesce_key", {"claim_id": claim_id})
+        if keys:
+            # Aynı alıcı+sipariş için birleştirme penceresi henüz dolmamış mesajlar; birleştirme
+            # parti sınırına bağlı kalmaz, eski durum mesajı yenisinden önce ayrıca gönderilmez
+            await db.outbox.update_many({"coalesce_key": {"$in": keys}, "status": "pending"}, claim)
+        return await db.outbox.find({"claim_id": claim_id}).to_list(None)
+
+    async def _loop(self):
+        while True:
+            try:
+                batch = await self._claim()
+                if batch:
+                    await self.dispatch(batch)
+                    continue
+            except PyMongoError as e:
+                logger.warning("Outbox dispatcher could not claim messages: %s", e)
+            except Exception:
+                logger.exception("Outbox dispatch failed")
+            await asyncio.sleep(self.poll_interval_s)
+
+    async def dispatch(self, batch: List[dict]):
+        groups: dict = {}
+        for message in sorted(batch, key=lambda m: m["created_at"]):
+            groups.setdefault((message["channel"], message["recipient"]), []).append(message)
+        await asyncio.gather(*[self._send_group(channel, recipient, messages) for (channel, recipient), messages in groups.items()])
+
+    async def _send_group(self, channel: str, recipient: str, messages: List[dict]):
+        latest: dict = {}
+        for message in messages:
+            latest[message["coalesce_key"]] = message
+        keep = list(latest.values())
+        superseded = [m["_id"] for m in messages if latest[m["coalesce_key"]] is not m]
+        if superseded:
+            # Yerine geçen mesajla birlikte kapanır; sent_at TTL'i birleştirilen satırları da siler
+            await db.outbox.update_many({"_id": {"$in": superseded}}, {"$set": {"status": "coalesced", "sent_at": datetime.now(timezone.utc), "claim_id": None}})
+        
+        ids = [m["_id"] for m in keep]
+        sender = self.senders.get(channel)
+        try:
+            if sender is None:
+                raise RuntimeError(f"No sender configured for channel {channel}")
+            async with self._semaphore:
+                await sender.send(recipient, "\n".join(m["text"] for m in keep))
+        except Exception as e:
+            attempts = max(m["attempts"] for m in keep) + 1
+            if attempts >= self.max_attempts:
+                update = {"status": "failed", "attempts": attempts, "error": str(e), "claim_id": None}
+            else:
+                # Üstel bekleme + küçük rastgele sapma; sağlayıcı toparlanınca mesajlar aynı anda yığılmaz
+                delay = self.backoff_base_s * (2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+                next_attempt = datetime.now(timezone.utc) + timedelta(seconds=delay)
+                update = {"status": "pending", "attempts": attempts, "error": str(e), "claim_id": None, "next_attempt_at": next_attempt.isoformat()}
+            await db.outbox.update_many({"_id": {"$in": ids}}, {"$set": update})
+            logger.warning("Notification to %s via %s failed (attempt %d): %s", recipient, channel, attempts, e)
+            return
+        await db.outbox.update_many(
+            {"_id": {"$in": ids}},
+            {"$set": {"status": "sent", "sent_at": datetime.now(timezone.utc), "claim_id": None, "error": None}, "$inc": {"attempts": 1}}
+        )
+
+outbox_dispatcher: Any = ScopedResource("outbox_dispatcher")
+
+@api_router.get("/admin/outbox")
+async def list_outbox(status: Optional[str] = None, order_id: Optional[str] = None, admin: dict = Depends(require_admin)):
+    query = {}
+    if status:
+        query["status"] = status
+    if order_id:
+        query["order_id"] = order_id
+    messages = await db.outbox.find(query, {"_id": 0, "claim_id": 0}).sort("created_at", -1).to_list(200)
+    return {"messages": messages}
+
+# ============== AUDIT LOG ==============
+
+class AuditLog:
+    """Yalnızca eklemeli denetim kaydı. `record` isteği bekletmez: kayıtlar bellekte biriktirilir,
+    parti dolduğunda veya belirli aralıklarla tek `insert_many` ile yazılır, kapanışta kalanlar
+    boşaltılır. Mongo geçici olarak yazamazsa parti kuyruğun başına geri konur; kuyruk sınırı
+    aşılırsa en eski kayıtlar düşürülür ve loglanır."""
+
+    def __init__(self, batch_size: int, flush_interval_s: float, max_queue: int):
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._buffer: deque = deque()
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        if self._buffer:
+            logger.warning("Audit log shut down with %d unwritten entries", len(self._buffer))
+
+    def record(self, entry: dict):
+        self._buffer.append(entry)
+        overflow = len(self._buffer) - self.max_queue
+        for _ in range(max(0, overflow)):
+            self._buffer.popleft()
+            self.dropped += 1
+        if overflow > 0:
+            logger.warning("Audit queue full, %d entries dropped so far", self.dropped)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._lock:
+            while self._buffer:
+                batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+                try:
+                    await db.audit_log.insert_many(batch, ordered=False)
+                except BulkWriteError as e:
+                    # Yeniden denenen partide zaten yazılmış kayıtlar audit_id unique index'ine takılır
+                    failed = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+                    if failed:
+                        logger.warning("Audit log dropped %d entries: %s", len(failed), failed[0].get("errmsg"))
+                except PyMongoError as e:
+                    # Yazılamayan kayıtlar sırasını koruyarak geri konur; bir sonraki turda denenir
+                    for entry in reversed(batch):
+                        entry.pop("_id", None)
+                        self._buffer.appendleft(entry)
+                    logger.warning("Audit log flush failed, %d entries kept in memory: %s", len(self._buffer), e)
+                    return
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval_s)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+audit_log: Any = ScopedResource("audit_log")
+
+def audit(actor: dict, action: str, target_type: str, target_id: Optional[str], **details):
+    if not audit_log:
+        return
+    audit_log.record({
+        "audit_id": f"aud_{uuid.uuid4().hex[:12]}",
+        "at": datetime.now(timezone.utc).isoformat(),
+        "actor_id": actor.get("user_id"),
+        "actor_role": actor.get("role"),
+        "actor_email": actor.get("email"),
+        "action": action,
+        "target_type": target_type,
+        "target_id": target_id,
+        "details": details,
+    })
+
+AUDIT_SORT = ["at", "audit_id"]
+
+def parse_audit_time(value: Optional[str], name: str) -> Optional[str]:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be an ISO datetime")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).isoformat()
+
+@api_router.get("/admin/audit")
+async def query_audit_log(
+    actor_id: Optional[str] = None,
+    target_type: Optional[str] = None,
+    target_id: Optional[str] = None,
+    action: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    admin: dict = Depends(require_admin)
+):
+    if target_id and not target_type:
+        raise HTTPException(status_code=400, detail="target_id requires target_type")
+    query = {}
+    if actor_id:
+        query["actor_id"] = actor_id
+    if target_type:
+        query["target_type"] = target_type
+    if target_id:
+        query["target_id"] = target_id
+    if action:
+        query["action"] = action
+    at = {}
+    if start:
+        at["$gte"] = parse_audit_time(start, "start")
+    if end:
+        at["$lt"] = parse_audit_time(end, "end")
+    if at:
+        query["at"] = at
+    if cursor:
+        query.setdefault("$and", []).append(keyset_after(AUDIT_SORT, decode_page_cursor(cursor, len(AUDIT_SORT))))
+    limit = max(1, min(limit, 1000))
+    entries = await db.audit_log.find(query, {"_id": 0}).sort([(field, -1) for field in AUDIT_SORT]).limit(limit).to_list(limit)
+    # Aynı milisaniyedeki kayıtlar audit_id ile ayrışır; sayfa sınırında kayıt atlanmaz ya da tekrarlanmaz
+    next_cursor = encode_page_cursor(*(entries[-1][field] for field in AUDIT_SORT)) if len(entries) == limit else None
+    return {"entries": entries, "next_cursor": next_cursor}
+
+# ============== ORDER ARCHIVE ==============
+
+# Kapanmış (teslim edilmiş/iptal) eski siparişler `orders_archive` koleksiyonuna taşınır;
+# okuma yolları istenen aralık arşive uzanıyorsa iki koleksiyonu birlikte okur.
+
+def archivable_orders_query(cutoff: str) -> dict:
+    return {"$or": [
+        {"status": "delivered", "delivery_date": {"$lt": cutoff}},
+        {"status": "cancelled", "cancelled_at": {"$lt": cutoff}},
+    ]}
+
+async def get_archive_cutoff() -> Optional[str]:
+    # Arşivdeki tüm siparişlerin kapanış tarihi bu değerden öncedir
+    state = await db.archive_state.find_one({"_id": "orders"}, {"cutoff": 1})
+    return state.get("cutoff") if state else None
+
+async def range_needs_archive(start_date: Optional[datetime]) -> bool:
+    cutoff = await get_archive_cutoff()
+    if cutoff is None:
+        return False
+    return start_date is None or start_date.isoformat() < cutoff
+
+async def find_orders_across(query: dict, projection: dict, include_archive: bool, limit: Optional[int] = None, database: Any = None):
+    database = database if database is not None else analytics_db
+    remaining = limit
+    for collection in ([database.orders, database.orders_archive] if include_archive else [database.orders]):
+        cursor = collection.find(query, projection)
+        if remaining is not None:
+            if remaining <= 0:
+                return
+            cursor = cursor.limit(remaining)
+        async for order in cursor:
+            if remaining is not None:
+                remaining -= 1
+            yield order
+
+async def find_orders_page(query: dict, projection: dict, sort: List[str], limit: int, include_archive: bool = True, collation: Optional[dict] = None) -> List[dict]:
+    """İki koleksiyondan aynı sorgu ve azalan sıralamayla en fazla `limit` sipariş okur, sonuçları
+    birleştirip keser. Projeksiyon sıralama alanlarını içermelidir. Sorguya eklenen keyset imleci
+    iki koleksiyona birlikte uygulandığı için sayfalama arşive de uzanır."""
+    collections = [db.orders]
+    if include_archive and await get_archive_cutoff() is not None:
+        collections.append(db.orders_archive)
+    sort_spec = [(field, -1) for field in sort]
+    results = await asyncio.gather(*(
+        collection.find(query, projection, collation=collation).sort(sort_spec).limit(limit).to_list(limit)
+        for collection in collections
+    ))
+    merged = heapq.merge(*results, key=lambda order: tuple(order.get(field) or "" for field in sort), reverse=True)
+    return list(itertools.islice(merged, limit))
+
+async def find_order_by_id(order_id: str, projection: Optional[dict] = None) -> Optional[dict]:
+    if projection:
+        order = await db.orders.find_one({"order_id": order_id}, projection)
+        if order is None:
+            order = await db.orders_archive.find_one({"order_id": order_id}, projection)
+        return order
+    
+    # Tam okumada v1 doküman bulunursa yerinde v2'ye çevrilir (lazy upgrade)
+    for collection in (db.orders, db.orders_archive):
+        order = await collection.find_one({"order_id": order_id})
+        if order is None:
+            continue
+        if order.get("schema_version") != ORDER_SCHEMA_VERSION:
+            try:
+                await rewrite_orders(collection, [order])
+            except PyMongoError as e:
+                logger.warning("Lazy upgrade of order %s failed: %s", order_id, e)
+        order.pop("_id", None)
+        return upgrade_order(order)
+    return None
+
+async def run_order_archival(archive_after_days: int, batch_size: int) -> dict:
+    """Kapanış tarihi `archive_after_days` günden eski siparişleri parça parça arşive taşır.
+    Önce arşive _id ile upsert, sonra ana koleksiyondan silme yapılır; yarıda kalan bir
+    çalıştırma tekrarlandığında aynı sonuca ulaşır (idempotent). Arşivde aynı order_id'yi taşıyan
+    başka bir sipariş varsa sipariş taşınmaz ve `conflicts` içinde raporlanır."""
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=archive_after_days)).isoformat()
+    query = archivable_orders_query(cutoff)
+    moved, batches = 0, 0
+    conflicts: List[str] = []
+    skipped: list = []  # arşivde aynı order_id'li başka bir sipariş olduğu için taşınmayanlar
+    
+    # Cutoff taşımadan önce kaydedilir; okuyucular taşıma sürerken de arşive bakar
+    previous = await get_archive_cutoff()
+    if previous is None or cutoff > previous:
+        await db.archive_state.update_one({"_id": "orders"}, {"$set": {"cutoff": cutoff}}, upsert=True)
+    
+    while True:
+        batch_query = {**query, "_id": {"$nin": skipped}} if skipped else query
+        orders = await db.orders.find(batch_query).limit(batch_size).to_list(batch_size)
+        if not orders:
+            break
+        archived_at = datetime.now(timezone.utc).isoformat()
+        # Arşiv dokümanı aynı _id ile yazılır: yeniden çalıştırma aynı dokümanı değiştirir, aynı order_id'yi
+        # taşıyan farklı bir sipariş ise unique index'e takılır ve üzerine yazılmaz
+        try:
+            await db.orders_archive.bulk_write([
+                ReplaceOne({"_id": order["_id"]}, {**order, "archived_at": archived_at}, upsert=True)
+                for order in orders
+            ], ordered=False)
+            rejected = []
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            rejected = [orders[error["index"]] for error in errors]
+        if rejected:
+            # Eski sürümün farklı _id ile yazdığı arşiv kopyası aynı siparişse taşıma tamamlanmış sayılır
+            archived = {
+                doc["order_id"]: doc
+                async for doc in db.orders_archive.find({"order_id": {"$in": [order["order_id"] for order in rejected]}}, {"order_id": 1, "created_at": 1, "customer_id": 1})
+            }
+            for order in rejected:
+                copy = archived.get(order["order_id"])
+                if copy is None or (copy.get("created_at"), copy.get("customer_id")) != (order.get("created_at"), order.get("customer_id")):
+                    logger.warning("Order %s not archived: a different order with the same id is already archived", order["order_id"])
+                    conflicts.append(order["order_id"])
+                    skipped.append(order["_id"])
+        skipped_ids = set(skipped)
+        # Arada yeniden açılmış bir sipariş silinmesin diye arşiv koşulu silmede de uygulanır
+        result = await db.orders.delete_many({"_id": {"$in": [order["_id"] for order in orders if order["_id"] not in skipped_ids]}, **query})
+        moved += result.deleted_count
+        batches += 1
+        await asyncio.sleep(0)
+    
+    await db.archive_state.update_one(
+        {"_id": "orders"},
+        {"$set": {"last_run_at": datetime.now(timezone.utc).isoformat()}, "$inc": {"moved": moved}},
+        upsert=True
+    )
+    return {"cutoff": cutoff, "moved": moved, "batches": batches, "conflicts": conflicts}
+
+# ============== ANALYTICS SNAPSHOTS ==============
+
+ORDER_SNAPSHOT_COLUMNS = [
+    "order_id", "customer_id", "customer_name", "customer_phone", "customer_email", "city", "district",
+    "status", "company_id", "company_name", "carpet_count", "actual_total_area", "actual_total_price",
+    "discount_percentage", "discount_amount", "final_price", "special_notes", "created_by_admin",
+    "created_at", "updated_at", "assigned_at", "pickup_date", "washing_date", "delivery_date", "cancelled_at", "cancel_reason"
+]
+ORDER_SNAPSHOT_DATE_COLUMNS = ["created_at", "updated_at", "assigned_at", "pickup_date", "washing_date", "delivery_date", "cancelled_at"]
+ORDER_SNAPSHOT_FLOAT_COLUMNS = ["actual_total_area", "actual_total_price", "discount_percentage", "discount_amount", "final_price"]
+SNAPSHOT_TIMESTAMP = pa.timestamp("ns", tz="UTC")
+
+# Parça dosyaları sabit şema ile yazılır; bir partta tamamen boş olan kolon null tipine düşmez,
+# farklı çalıştırmaların parçaları tek dataset olarak okunabilir
+ORDER_SNAPSHOT_TYPES = {
+    **{column: pa.string() for column in ORDER_SNAPSHOT_COLUMNS},
+    **{column: SNAPSHOT_TIMESTAMP for column in ORDER_SNAPSHOT_DATE_COLUMNS},
+    **{column: pa.float64() for column in ORDER_SNAPSHOT_FLOAT_COLUMNS},
+    "carpet_count": pa.int32(),
+    "created_by_admin": pa.bool_(),
+}
+ORDER_SNAPSHOT_SCHEMA = pa.schema(list(ORDER_SNAPSHOT_TYPES.items()) + [("snapshot_at", SNAPSHOT_TIMESTAMP)])
+CARPET_SNAPSHOT_SCHEMA = pa.schema([
+    ("order_id", pa.string()), ("source", pa.string()), ("position", pa.int32()), ("carpet_type", pa.string()),
+    ("width", pa.float64()), ("length", pa.float64()), ("area", pa.float64()), ("price", pa.float64()),
+    ("snapshot_at", SNAPSHOT_TIMESTAMP),
+])
+
+def flatten_orders_for_snapshot(orders: List[dict], snapshot_at: str):
+    # Siparişler ve halılar iki tabloya ayrılır; halılar order_id ile siparişe bağlanır
+    order_rows, carpet_rows = [], []
+    for order in orders:
+        row = {column: order.get(column) for column in ORDER_SNAPSHOT_COLUMNS}
+        row["created_by_admin"] = bool(order.get("created_by_admin"))
+        row["created_month"] = (order.get("created_at") or "")[:7] or "unknown"
+        row["snapshot_at"] = snapshot_at
+        order_rows.append(row)
+        for source, carpets in (("estimated", order.get("carpets") or []), ("actual", order.get("actual_carpets") or [])):
+            for index, carpet in enumerate(carpets):
+                carpet_rows.append({
+                    "order_id": order["order_id"],
+                    "source": source,
+                    "position": index,
+                    "carpet_type": carpet.get("carpet_type"),
+                    "width": carpet.get("width"),
+                    "length": carpet.get("length"),
+                    "area": carpet.get("area"),
+                    "price": carpet.get("price"),
+                    "created_month": row["created_month"],
+                    "snapshot_at": snapshot_at,
+                })
+    
+    orders_df = pd.DataFrame(order_rows, columns=ORDER_SNAPSHOT_COLUMNS + ["created_month", "snapshot_at"])
+    for column in ORDER_SNAPSHOT_DATE_COLUMNS + ["snapshot_at"]:
+        orders_df[column] = pd.to_datetime(orders_df[column], utc=True, errors="coerce", format="ISO8601")
+    for column in ORDER_SNAPSHOT_FLOAT_COLUMNS:
+        orders_df[column] = pd.to_numeric(orders_df[column], errors="coerce").astype("float64")
+    orders_df["carpet_count"] = pd.to_numeric(orders_df["carpet_count"], errors="coerce").astype("Int32")
+    orders_df["created_by_admin"] = orders_df["created_by_admin"].astype(bool)
+    
+    carpets_df = pd.DataFrame(carpet_rows, columns=["order_id", "source", "position", "carpet_type", "width", "length", "area", "price", "created_month", "snapshot_at"])
+    for column in ("width", "length", "area", "price"):
+        carpets_df[column] = pd.to_numeric(carpets_df[column], errors="coerce").astype("float64")
+    carpets_df["position"] = carpets_df["position"].astype("int32")
+    carpets_df["snapshot_at"] = pd.to_datetime(carpets_df["snapshot_at"], utc=True)
+    return orders_df, carpets_df
+
+def write_partitioned_parquet(df, root: Path, part_name: str, schema: pa.Schema) -> List[str]:
+    # Aylık partition dizinleri (created_month=YYYY-MM) altında sıkıştırılmış parquet parçaları
+    files = []
+    for month, part in df.groupby("created_month"):
+        directory = root / f"created_month={month}"
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{part_name}.parquet"
+        part.drop(columns=["created_month"]).to_parquet(path, engine="pyarrow", compression="zstd", index=False, schema=schema)
+        files.append(str(path))
+    return files
+
+async def run_orders_snapshot(snapshot_dir: Path, batch_size: int, watermark_lag_s: int = 300) -> dict:
+    """Siparişlerin kolon bazlı anlık görüntüsü. İlk çalıştırma tüm siparişleri, sonrakiler
+    yalnızca son çalıştırmadan beri `updated_at` değeri değişenleri ekler. Okuyucular aynı
+    order_id için en büyük `snapshot_at` satırını esas almalıdır.
+    Artımlı okuma primary'den yapılır (geride kalan secondary'de henüz görünmeyen güncellemeler
+    watermark'ın gerisinde kalıp kaybolurdu). Watermark başlangıç zamanından `watermark_lag_s`
+    geride tutulur: farklı worker saatleri ve geç commit edilen yazımlar bir sonraki çalıştırmada
+    yeniden okunur; örtüşen satırlar tekrar yazılır, kaybolmaz."""
+    state = await db.snapshots.find_one({"_id": "orders"}) or {}
+    watermark = state.get("watermark")
+    started = datetime.now(timezone.utc)
+    run_started_at = started.isoformat()
+    run_id = started.strftime("%Y%m%dT%H%M%S") + f"-{uuid.uuid4().hex[:6]}"
+    next_watermark = max(filter(None, [watermark, (started - timedelta(seconds=watermark_lag_s)).isoformat()]))
+    
+    query = {"updated_at": {"$gt": watermark}} if watermark else {}
+    cursor = db.orders.find(query, {"_id": 0}).batch_size(min(batch_size, 10000))
+    
+    files, order_count, carpet_count, batch_index = [], 0, 0, 0
+    
+    async def flush(batch: List[dict]):
+        nonlocal order_count, carpet_count, batch_index
+        orders_df, carpets_df = await asyncio.to_thread(flatten_orders_for_snapshot, batch, run_started_at)
+        part_name = f"part-{run_id}-{batch_index:05d}"
+        files.extend(await asyncio.to_thread(write_partitioned_parquet, orders_df, snapshot_dir / "orders", part_name, ORDER_SNAPSHOT_SCHEMA))
+        if len(carpets_df):
+            files.extend(await asyncio.to_thread(write_partitioned_parquet, carpets_df, snapshot_dir / "order_carpets", part_name, CARPET_SNAPSHOT_SCHEMA))
+        order_count += len(orders_df)
+        carpet_count += len(carpets_df)
+        batch_index += 1
+    
+    batch = []
+    async for order in cursor:
+        batch.append(order)
+        if len(batch) >= batch_size:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+    
+    # Watermark yalnızca tüm parçalar yazıldıktan sonra ilerletilir
+    await db.snapshots.update_one(
+        {"_id": "orders"},
+        {"$set": {"watermark": next_watermark, "last_run_id": run_id, "last_run_at": datetime.now(timezone.utc).isoformat()}, "$inc": {"runs": 1}},
+        upsert=True
+    )
+    return {
+        "run_id": run_id,
+        "incremental": watermark is not None,
+        "since": watermark,
+        "watermark": next_watermark,
+        "orders": order_count,
+        "carpets": carpet_count,
+        "files": files
+    }
+
+# ============== BACKGROUND JOBS ==============
+
+class JobCreate(BaseModel):
+    kind: str
+    params: dict = {}
+
+async def write_rows_to_file(path: Path, rows, batch_size: int = 1000):
+    # Satırları gruplar halinde diske yaz; dosya I/O event loop dışında yapılır
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        batch = []
+        async for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                await asyncio.to_thread(f.write, "".join(batch))
+                batch = []
+        if batch:
+            await asyncio.to_thread(f.write, "".join(batch))
+
+async def run_export_job(entity: str, params: dict, path: Path):
+    if params.get("format") == "xlsx":
+        await write_entity_xlsx(entity, path)
+    else:
+        await write_rows_to_file(path, export_csv_rows(entity))
+
+async def run_export_customers_job(params: dict, path: Path):
+    await run_export_job("customers", params, path)
+
+async def run_export_companies_job(params: dict, path: Path):
+    await run_export_job("companies", params, path)
+
+async def run_export_orders_job(params: dict, path: Path):
+    await run_export_job("orders", params, path)
+
+async def run_admin_report_job(params: dict, path: Path):
+    period = params.get("period", "yearly")
+    start_date, end_date = resolve_report_range(period, params.get("start"), params.get("end"))
+    report = await build_admin_report(period, start_date, end_date, params.get("company_id"))
+    if params.get("format") == "xlsx":
+        await write_report_xlsx(report, path)
+    else:
+        await asyncio.to_thread(path.write_text, json.dumps(report, ensure_ascii=False), "utf-8")
+
+async def run_orders_snapshot_job(params: dict, path: Path):
+    manifest = await run_orders_snapshot(Path(app_settings.snapshot_dir), app_settings.snapshot_batch_size, app_settings.snapshot_watermark_lag_s)
+    await asyncio.to_thread(path.write_text, json.dumps(manifest, ensure_ascii=False), "utf-8")
+
+async def run_order_compaction_job(params: dict, path: Path):
+    result = await run_order_compaction(app_settings.order_compaction_batch_size)
+    await asyncio.to_thread(path.write_text, json.dumps(result), "utf-8")
+
+async def run_email_key_migration_job(params: dict, path: Path):
+    report = await run_email_key_migration(int(params.get("batch_size", 1000)))
+    await asyncio.to_thread(path.write_text, json.dumps(report, ensure_ascii=False), "utf-8")
+
+async def run_order_id_dedupe_job(params: dict, path: Path):
+    report = await run_order_id_dedupe(bool(params.get("dry_run", True)))
+    await asyncio.to_thread(path.write_text, json.dumps(report, ensure_ascii=False), "utf-8")
+
+async def run_order_archival_job(params: dict, path: Path):
+    days = int(params.get("archive_after_days", app_settings.archive_after_days))
+    result = await run_order_archival(days, app_settings.archive_batch_size)
+    await asyncio.to_thread(path.write_text, json.dumps(result), "utf-8")
+
+# kind -> (çalıştırıcı, varsayılan format, desteklenen formatlar, tamamlanmış sonuç yeniden kullanılır mı)
+# Veri değiştiren ya da artımlı ilerleyen işler her istekte yeniden çalışır; yalnızca kuyrukta/çalışan
+# aynı iş tekilleştirilir
+JOB_KINDS = {
+    "archive_orders": (run_order_archival_job, "json", ("json",), False),
+    "compact_orders": (run_order_compaction_job, "json", ("json",), False),
+    "dedupe_order_ids": (run_order_id_dedupe_job, "json", ("json",), False),
+    "migrate_email_keys": (run_email_key_migration_job, "json", ("json",), False),
+    "orders_snapshot": (run_orders_snapshot_job, "json", ("json",), False),
+    "export_customers": (run_export_customers_job, "csv", ("csv", "xlsx"), True),
+    "export_companies": (run_export_companies_job, "csv", ("csv", "xlsx"), True),
+    "export_orders": (run_export_orders_job, "csv", ("csv", "xlsx"), True),
+    "admin_report": (run_admin_report_job, "json", ("json", "xlsx"), True),
+}
+
+def job_format(job: dict) -> str:
+    return job["params"].get("format") or JOB_KINDS[job["kind"]][1]
+
+def job_dedupe_key(kind: str, params: dict) -> str:
+    return hashlib.sha256(json.dumps({"kind": kind, "params": params}, sort_keys=True, default=str).encode()).hexdigest()
+
+JOB_RESULT_GC_INTERVAL_S = 300.0
+
+class JobRunner:
+    """Mongo tabanlı iş kuyruğu - sınırlı sayıda asyncio worker işleri `jobs` koleksiyonundan
+    talep eder (lease ile), sonuçları yerel diske yazar. Birden fazla process aynı koleksiyonu
+    paylaşabilir; çalışan işin lease'i düzenli yenilenir, süresi dolan `running` işler (çöken
+    process) yeniden talep edilir. Kapanışta yarım kalan işler kuyruğa geri bırakılır ve süresi
+    dolan sonuç dosyaları periyodik olarak silinir."""
+
+    def __init__(self, workers: int, results_dir: Path, result_ttl_s: int, lease_s: int, poll_interval_s: float):
+        self.workers = workers
+        self.results_dir = results_dir
+        self.result_ttl_s = result_ttl_s
+        self.lease_s = lease_s
+        self.poll_interval_s = poll_interval_s
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._collect_results_forever()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def result_path(self, job: dict) -> Path:
+        return self.results_dir / f"{job['job_id']}.{EXPORT_FORMATS[job_format(job)][0]}"
+
+    async def submit(self, kind: str, params: dict, user_id: str) -> dict:
+        if kind not in JOB_KINDS:
+            raise HTTPException(status_code=400, detail="Unknown job kind")
+        if params.get("format") and params["format"] not in JOB_KINDS[kind][2]:
+            raise HTTPException(status_code=400, detail="Unsupported format for this job kind")
+        
+        dedupe_key = job_dedupe_key(kind, params)
+        now = datetime.now(timezone.utc)
+        
+        # Aynı iş kuyrukta/çalışıyorsa ya da (yeniden kullanılabilen türlerde) taze bir sonucu varsa onu döndür
+        reusable = [{"status": {"$in": ["queued", "running"]}}]
+        if JOB_KINDS[kind][3]:
+            reusable.append({"status": "completed", "finished_at": {"$gte": (now - timedelta(seconds=self.result_ttl_s)).isoformat()}})
+        existing = await db.jobs.find_one(
+            {"dedupe_key": dedupe_key, "$or": reusable},
+            {"_id": 0},
+            sort=[("created_at", -1)]
+        )
+        if existing and (existing["status"] != "completed" or self.result_path(existing).exists()):
+            existing["reused"] = True
+            return existing
+        
+        job = {
+            "job_id": f"job_{uuid.uuid4().hex[:12]}",
+            "kind": kind,
+            "params": params,
+            "dedupe_key": dedupe_key,
+            "status": "queued",
+            "created_by": user_id,
+            "created_at": now.isoformat(),
+            "started_at": None,
+            "finished_at": None,
+            "lease_expires_at": None,
+            "error": None
+        }
+        await db.jobs.insert_one(job)
+        job.pop("_id", None)
+        self._wakeup.set()
+        return job
+
+    def lease_expiry(self) -> str:
+        return (datetime.now(timezone.utc) + timedelta(seconds=self.lease_s)).isoformat()
+
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        # lease_id talebi sahiplenir; lease'i başka worker'a geçmiş bir işin sonucu yazılmaz
+        return await db.jobs.find_one_and_update(
+            {"$or": [{"status": "queued"}, {"status": "running", "lease_expires_at": {"$lt": now.isoformat()}}]},
+            {"$set": {"status": "running", "started_at": now.isoformat(), "lease_expires_at": self.lease_expiry(), "lease_id": uuid.uuid4().hex}},
+            projection={"_id": 0},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _worker(self, index: int):
+        while True:
+            try:
+                job = await self._claim()
+                if job is None:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval_s)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._run(job)
+            except Exception:
+                # Mongo ya da dosya sistemi hatası worker'ı öldürmez; kısa bir beklemeden sonra devam eder
+                logger.exception("Job worker %d iteration failed", index)
+                await asyncio.sleep(self.poll_interval_s)
+
+    async def _heartbeat(self, lease: dict):
+        # İş sürdükçe lease yenilenir; uzun işler lease süresini aşsa da başka worker'a geçmez
+        while True:
+            await asyncio.sleep(self.lease_s / 3)
+            try:
+                result = await db.jobs.update_one({**lease, "status": "running"}, {"$set": {"lease_expires_at": self.lease_expiry()}})
+            except PyMongoError as e:
+                logger.warning("Job %s lease renewal failed: %s", lease["job_id"], e)
+                continue
+            if result.matched_count == 0:
+                logger.warning("Job %s lost its lease", lease["job_id"])
+                return
+
+    async def _run(self, job: dict):
+        runner = JOB_KINDS[job["kind"]][0]
+        path = self.result_path(job)
+        lease = {"job_id": job["job_id"], "lease_id": job["lease_id"]}
+        heartbeat = asyncio.create_task(self._heartbeat(lease))
+        try:
+            await runner(job["params"], path)
+            size_bytes = (await asyncio.to_thread(path.stat)).st_size
+        except asyncio.CancelledError:
+            # Kapanışta yarım kalan iş kuyruğa geri bırakılır; başka bir worker/process baştan çalıştırır
+            path.unlink(missing_ok=True)
+            try:
+                await db.jobs.update_one(lease, {"$set": {"status": "queued", "started_at": None, "lease_expires_at": None}, "$unset": {"lease_id": ""}})
+            except PyMongoError as e:
+                logger.warning("Job %s could not be requeued, lease expiry will release it: %s", job["job_id"], e)
+            raise
+        except Exception as e:
+            logger.exception("Job %s failed", job["job_id"])
+            path.unlink(missing_ok=True)
+            await db.jobs.update_one(
+                lease,
+                {"$set": {"status": "failed", "error": str(e), "finished_at": datetime.now(timezone.utc).isoformat()}}
+            )
+            return
+        finally:
+            heartbeat.cancel()
+        await db.jobs.update_one(
+            lease,
+            {"$set": {"status": "completed", "finished_at": datetime.now(timezone.utc).isoformat(), "size_bytes": size_bytes}}
+        )
+
+    def collect_results(self) -> int:
+        # Süresi dolan sonuç dosyaları silinir; indirme zaten 410 döner, yeniden kullanım da dosyayı arar
+        cutoff = time.time() - self.result_ttl_s
+        removed = 0
+        for path in self.results_dir.iterdir():
+            try:
+                if path.is_file() and path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
+
+    async def _collect_results_forever(self):
+        while True:
+            try:
+                removed = await asyncio.to_thread(self.collect_results)
+                if removed:
+                    logger.info("Removed %d expired job result file(s)", removed)
+            except OSError as e:
+                logger.warning("Job result cleanup failed: %s", e)
+            await asyncio.sleep(JOB_RESULT_GC_INTERVAL_S)
+
+job_runner: Any = ScopedResource("job_runner")
+
+@api_router.post("/admin/jobs")
+async def submit_job(job_data: JobCreate, admin: dict = Depends(require_admin)):
+    return await job_runner.submit(job_data.kind, job_data.params, admin["user_id"])
+
+@api_router.get("/admin/jobs/{job_id}")
+async def get_job(job_id: str, admin: dict = Depends(require_admin)):
+    job = await db.jobs.find_one({"job_id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@api_router.get("/admin/jobs/{job_id}/download")
+async def download_job_result(job_id: str, admin: dict = Depends(require_admin)):
+    job = await db.jobs.find_one({"job_id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    
+    path = job_runner.result_path(job)
+    if not path.exists():
+        raise HTTPException(status_code=410, detail="Job result expired")
+    
+    extension, media_type = EXPORT_FORMATS[job_format(job)]
+    # FileResponse dosyayı parça parça akıtır, belleğe yüklemez
+    return FileResponse(path, media_type=media_type, filename=f"{job['kind']}_{job_id}.{extension}")
+
+# ============== HEALTH CHECKS ==============
+
+HEALTH_WINDOW_S = 60.0
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Bağlantı havuzundan bağlantı alma (checkout) bekleme sürelerini ve açık/kullanımdaki bağlantı
+    sayılarını tutar. Olaylar Motor'un executor thread'lerinde gelir; checkout başlangıcı ve sonucu
+    aynı thread'de yayınlandığı için başlangıç zamanı thread-local saklanır."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._waits: deque = deque(maxlen=2000)  # (monotonic, wait_ms)
+        self.open = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.failures = 0
+
+    def _checkout_finished(self) -> float:
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+        return (time.monotonic() - started) * 1000 if started is not None else 0.0
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.monotonic()
+
+    def connection_checked_out(self, event):
+        wait_ms = self._checkout_finished()
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self._waits.append((time.monotonic(), wait_ms))
+
+    def connection_check_out_failed(self, event):
+        wait_ms = self._checkout_finished()
+        with self._lock:
+            self.failures += 1
+            self._waits.append((time.monotonic(), wait_ms))
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use = max(0, self.in_use - 1)
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open = max(0, self.open - 1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def snapshot(self) -> dict:
+        since = time.monotonic() - HEALTH_WINDOW_S
+        with self._lock:
+            waits = [wait for at, wait in self._waits if at >= since]
+            stats = {"open": self.open, "in_use": self.in_use, "checkouts": self.checkouts, "checkout_failures": self.failures}
+        stats["checkout_wait_ms"] = {
+            "samples": len(waits),
+            "p50": round(percentile(waits, 0.5), 2),
+            "p95": round(percentile(waits, 0.95), 2),
+            "max": round(max(waits, default=0.0), 2),
+        }
+        return stats
+
+pool_stats: Any = ScopedResource("pool_stats")
+
+class LoopLagMonitor:
+    """Event loop gecikmesini ölçer: sabit aralıkla uyuyan bir görev, uyanışının ne kadar geciktiğini
+    kaydeder. Bloklayan kod veya aşırı yük loop'u geciktirdiğinde değer yükselir."""
+
+    def __init__(self, interval_s: float):
+        self.interval_s = interval_s
+        self._lags: deque = deque(maxlen=max(1, int(HEALTH_WINDOW_S / interval_s)))
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval_s)
+            self._lags.append(max(0.0, (time.monotonic() - started - self.interval_s) * 1000))
+
+    def snapshot(self) -> dict:
+        lags = list(self._lags)
+        return {
+            "last_ms": round(lags[-1], 2) if lags else 0.0,
+            "p95_ms": round(percentile(lags, 0.95), 2),
+            "max_ms": round(max(lags, default=0.0), 2),
+        }
+
+loop_lag_monitor: Any = ScopedResource("loop_lag_monitor")
+
+async def mongo_ping(timeout_s: float) -> dict:
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(db.command("ping"), timeout_s)
+    except (PyMongoError, asyncio.TimeoutError) as e:
+        return {"ok": False, "latency_ms": round((time.monotonic() - started) * 1000, 2), "error": type(e).__name__}
+    return {"ok": True, "latency_ms": round((time.monotonic() - started) * 1000, 2)}
 
 @api_router.get("/health")
+@api_router.get("/health/live")
 async def health():
+    # Liveness: yalnızca process ve event loop'un cevap verdiğini gösterir, bağımlılıklara bakmaz
     return {"status": "healthy"}
 
-app.include_router(api_router)
+@api_router.get("/health/ready")
+async def readiness():
+    """Readiness: Mongo ping süresi, havuz bekleme süresi, loop gecikmesi ve eşzamanlı istek sayısı
+    eşiklerle karşılaştırılır; biri aşılırsa 503 döner ve yük dengeleyici bu worker'ı devreden çıkarır."""
+    settings = app_settings
+    mongo = await mongo_ping(settings.ready_ping_timeout_ms / 1000)
+    pool = pool_stats.snapshot()
+    loop_lag = loop_lag_monitor.snapshot()
+    # Readiness isteğinin kendisi sayılmaz; eşik ve yanıt aynı değeri kullanır
+    in_flight = max(0, active_scope().in_flight_requests - 1)
+    
+    failures = []
+    if not mongo["ok"]:
+        failures.append("mongo_unreachable")
+    elif mongo["latency_ms"] > settings.ready_max_ping_ms:
+        failures.append("mongo_slow")
+    if settings.ready_max_checkout_wait_ms and pool["checkout_wait_ms"]["p95"] > settings.ready_max_checkout_wait_ms:
+        failures.append("pool_saturated")
+    if settings.ready_max_loop_lag_ms and loop_lag["p95_ms"] > settings.ready_max_loop_lag_ms:
+        failures.append("event_loop_lagging")
+    if settings.ready_max_in_flight and in_flight > settings.ready_max_in_flight:
+        failures.append("too_many_in_flight")
+    
+    body = {
+        "status": "ready" if not failures else "not_ready",
+        "failures": failures,
+        "mongo": mongo,
+        "pool": pool,
+        "event_loop": loop_lag,
+        "circuits": {"mongo": mongo_breaker.snapshot(), "oauth": oauth_breaker.snapshot()},
+        # Yalnızca bilgi amaçlı: eksik index tüm worker'larda aynıdır, trafiği kesmek bir şey düzeltmez
+        "missing_unique_indexes": active_scope().missing_unique_indexes,
+        "in_flight_requests": in_flight,
+    }
+    return JSONResponse(status_code=200 if not failures else 503, content=body, headers={"Cache-Control": "no-store"})
+
+# ============== ROOT ROUTES ==============
+
+@api_router.get("/")
+async def root():
+    return {"message": "HALIYOL API - Halı Yıkama Platformu"}
+
+def create_app(settings: Optional[Settings] = None, database: Any = None) -> FastAPI:
+    """Uygulama fabrikası - ayarlar verilmezse lifespan sırasında ortam değişkenlerinden okunur.
+    Test ve benchmark'lar `database` ile yerel bir veritabanı nesnesi enjekte edebilir."""
+    application = FastAPI(title="HALIYOL API", lifespan=lifespan)
+    application.state.settings = settings
+    application.state.database = database
+    application.state.scope = None
+    application.include_router(api_router)
+    # Mongo koruması en içte: süre bütçesi ve devre kesici yalnızca uygulama koduna uygulanır
+    application.add_middleware(MongoGuardMiddleware)
+    # Profil: yük atma ve sıkıştırma profillenen süreye girmez
+    application.add_middleware(ProfilingMiddleware)
+    application.add_middleware(LoadSheddingMiddleware)
+    application.add_middleware(CompressionMiddleware)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    cors_origins = settings.cors_origins if settings else os.environ.get('CORS_ORIGINS', '*').split(',')
+    application.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=cors_origins,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    # En dışta: alt katmanların hepsi bu uygulamanın kapsamını görür
+    application.add_middleware(AppScopeMiddleware)
+    return application
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
+app = create_app()
@@ -0,0 +1,147 @@
+import asyncio
+import contextvars
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import mongomock.collection
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+from pymongo import ReturnDocument
+from starlette.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import server  # noqa: E402
+
+# mongomock, return_document=AFTER ile filtreyi güncellenmiş dokümana yeniden uygular; gerçek
+# MongoDB güncellenen dokümanı döndürür ($inc ile değişen alanlar filtrede olsa bile)
+_find_one_and_update = mongomock.collection.Collection.find_one_and_update
+
+def _find_one_and_update_after(self, filter, update, projection=None, return_document=ReturnDocument.BEFORE, **kwargs):
+    if return_document != ReturnDocument.AFTER:
+        return _find_one_and_update(self, filter, update, projection=projection, **kwargs)
+    before = _find_one_and_update(self, filter, update, **kwargs)
+    if before is None:
+        return self.find_one(filter, projection) if kwargs.get("upsert") else None
+    return self.find_one({"_id": before["_id"]}, projection)
+
+mongomock.collection.Collection.find_one_and_update = _find_one_and_update_after
+
+
+# Gerçek MongoDB gerektiren testler (mongomock'un desteklemediği operatörler, index seçenekleri)
+# yalnızca bu değişken verilirse çalışır: TEST_MONGO_URL=mongodb://localhost:27017 python -m pytest -q tests
+TEST_MONGO_URL = os.environ.get("TEST_MONGO_URL")
+
+
+def make_settings(**overrides) -> server.Settings:
+    overrides.setdefault("job_workers", 0)
+    overrides.setdefault("rate_limit_backend", "off")
+    overrides.setdefault("mongo_url", "")
+    overrides.setdefault("db_name", "test")
+    return server.Settings(**overrides)
+
+
+@pytest.fixture
+def database():
+    return AsyncMongoMockClient()["test"]
+
+
+async def wait_for_indexes(scope, timeout_s=10):
+    await asyncio.wait_for(asyncio.shield(scope.index_task), timeout_s)
+
+
+@pytest.fixture
+def make_client(database):
+    clients = []
+
+    def factory(database=database, **settings):
+        client = TestClient(server.create_app(make_settings(**settings), database))
+        client.__enter__()
+        clients.append(client)
+        # Index bakımı arka planda çalışır; testler unique index'lere güvendiği için bitmesi beklenir
+        client.portal.call(wait_for_indexes, client.app.state.scope)
+        return client
+
+    yield factory
+    for client in reversed(clients):
+        client.__exit__(None, None, None)
+
+
+@pytest.fixture
+def make_mongo_client():
+    """Gerçek MongoDB üzerinde geçici bir veritabanıyla uygulama; test sonunda veritabanı silinir."""
+    if not TEST_MONGO_URL:
+        pytest.skip("TEST_MONGO_URL is not set")
+    clients = []
+
+    def factory(**settings):
+        db_name = f"test_{uuid.uuid4().hex[:8]}"
+        client = TestClient(server.create_app(make_settings(mongo_url=TEST_MONGO_URL, db_name=db_name, mongo_request_timeout_ms=0, **settings)))
+        client.__enter__()
+        clients.append((client, db_name))
+        client.portal.call(wait_for_indexes, client.app.state.scope, 60)
+        return client
+
+    yield factory
+    for client, db_name in reversed(clients):
+        call(client, client.app.state.scope.client.drop_database, db_name)
+        client.__exit__(None, None, None)
+
+
+def register(client, email, role="customer", **extra):
+    body = {
+        "email": email, "password": "pw123456", "name": f"User {email}", "role": role,
+        "phone": "5550000000", "city": "İstanbul", "district": "Kadıköy", "address": "Moda Cd. 1",
+    }
+    body.update(extra)
+    return client.post("/api/auth/register", json=body)
+
+
+def auth_headers(client, email):
+    response = client.post("/api/auth/login", json={"email": email, "password": "pw123456"})
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['session_token']}"}
+
+
+def call(client, function, *args, **kwargs):
+    """Coroutine'i istemcinin event loop'unda ve uygulamanın kapsamında çalıştırır."""
+    async def run():
+        server.current_app_scope.set(client.app.state.scope)
+        return await function(*args, **kwargs)
+    return client.portal.call(run)
+
+
+def wait_until(client, predicate, timeout_s=5.0):
+    async def poll():
+        deadline = asyncio.get_running_loop().time() + timeout_s
+        while asyncio.get_running_loop().time() < deadline:
+            server.current_app_scope.set(client.app.state.scope)
+            if await predicate():
+                return True
+            await asyncio.sleep(0.02)
+        return False
+    assert client.portal.call(poll), "condition not reached in time"
+
+
+def in_scope(client, function, *args, **kwargs):
+    """Senkron bir fonksiyonu uygulamanın kapsamında, test thread'inin bağlamını kirletmeden çalıştırır."""
+    def run():
+        server.current_app_scope.set(client.app.state.scope)
+        return function(*args, **kwargs)
+    return contextvars.copy_context().run(run)
+
+
+def admin_headers(client, database, email="admin@example.com"):
+    register(client, email)
+    call(client, database.users.update_one, {"email_key": email}, {"$set": {"role": "admin"}})
+    return auth_headers(client, email)
+
+
+def company_headers(client, database, email="firma@example.com"):
+    # Kayıtlı firma onaylanmadan giriş yapamaz; onay doğrudan veritabanında verilir
+    register(client, email, role="company", company_name="Temiz Halı", service_areas=["Kadıköy"])
+    user = call(client, database.users.find_one, {"email_key": email})
+    call(client, database.companies.update_one, {"user_id": user["user_id"]}, {"$set": {"is_approved": True, "is_active": True}})
+    return auth_headers(client, email), user["user_id"]
@@ -0,0 +1,38 @@
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import ServerSelectionTimeoutError
+from starlette.testclient import TestClient
+
+import server
+from tests.conftest import auth_headers, make_settings, register
+
+
+def test_injected_database_does_not_need_mongo_env(monkeypatch, database):
+    monkeypatch.delenv("MONGO_URL", raising=False)
+    monkeypatch.delenv("DB_NAME", raising=False)
+    monkeypatch.setenv("JOB_WORKERS", "0")
+    with TestClient(server.create_app(database=database)) as client:
+        assert client.get("/api/health/live").status_code == 200
+        assert register(client, "env@example.com").status_code == 200
+
+
+def test_two_apps_in_one_process_do_not_share_state(make_client):
+    first = make_client(database=AsyncMongoMockClient()["first"])
+    second = make_client(database=AsyncMongoMockClient()["second"])
+
+    assert register(first, "only-first@example.com").status_code == 200
+    auth_headers(first, "only-first@example.com")
+    response = second.post("/api/auth/login", json={"email": "only-first@example.com", "password": "pw123456"})
+    assert response.status_code == 401
+    assert first.app.state.scope is not second.app.state.scope
+    assert first.app.state.scope.db is not second.app.state.scope.db
+
+
+def test_startup_does_not_wait_for_index_maintenance(monkeypatch, database):
+    async def unreachable(*args, **kwargs):
+        raise ServerSelectionTimeoutError("no servers available")
+
+    monkeypatch.setattr(database, "command", unreachable)
+    with TestClient(server.create_app(make_settings(), database)) as client:
+        assert client.get("/api/health/live").status_code == 200
+        # Mongo cevap vermediği için bakım ertelendi, ama uygulama istek kabul ediyor
+        assert not client.app.state.scope.index_task.done()
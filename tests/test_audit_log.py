@@ -0,0 +1,30 @@
+from tests.conftest import admin_headers, call
+
+
+def test_audit_pages_do_not_skip_entries_sharing_a_timestamp(make_client, database):
+    client = make_client()
+    headers = admin_headers(client, database)
+    at = "2026-05-01T10:00:00.123000+00:00"
+    call(client, database.audit_log.insert_many, [
+        {"audit_id": f"aud_{i:03d}", "at": at if i < 5 else f"2026-05-01T09:00:0{i}+00:00", "action": "order.status", "target_type": "order", "target_id": "ORD-1"}
+        for i in range(8)
+    ])
+
+    seen, cursor = [], None
+    while True:
+        params = {"action": "order.status", "limit": 3, **({"cursor": cursor} if cursor else {})}
+        page = client.get("/api/admin/audit", params=params, headers=headers).json()
+        seen += [entry["audit_id"] for entry in page["entries"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+
+    assert seen == [f"aud_{i:03d}" for i in (4, 3, 2, 1, 0, 7, 6, 5)]
+
+
+def test_audit_target_id_requires_target_type(make_client, database):
+    client = make_client()
+    headers = admin_headers(client, database)
+    assert client.get("/api/admin/audit", params={"target_id": "ORD-1"}, headers=headers).status_code == 400
+    assert client.get("/api/admin/audit", params={"target_type": "order", "target_id": "ORD-1"}, headers=headers).status_code == 200
+    assert client.get("/api/admin/audit", params={"cursor": "bogus"}, headers=headers).status_code == 400
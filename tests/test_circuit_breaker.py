@@ -0,0 +1,155 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from pymongo.errors import AutoReconnect, ExecutionTimeout, NetworkTimeout, ServerSelectionTimeoutError, WaitQueueTimeoutError
+
+import server
+from tests.conftest import call
+
+
+def wait_for_half_open(breaker):
+    time.sleep(breaker.retry_after_s() + 0.01)
+
+
+@pytest.fixture
+def guarded(make_client):
+    # Hata enjekte edilebilen, guard'ın arkasındaki test yolları
+    client = make_client(breaker_failure_threshold=2, breaker_reset_timeout_s=0.2)
+    state = {"error": None, "calls": 0}
+
+    async def handler():
+        state["calls"] += 1
+        if state["error"] is not None:
+            raise state["error"]
+        return {"ok": True}
+
+    client.app.get("/api/_test/mongo")(handler)
+    client.app.get("/api/_test/analytics")(handler)
+    return client, state
+
+
+def test_mongo_breaker_opens_and_recovers_through_half_open(guarded):
+    client, state = guarded
+    breaker = client.app.state.scope.mongo_breaker
+
+    state["error"] = AutoReconnect("connection reset")
+    assert client.get("/api/_test/mongo").status_code == 503
+    assert breaker.state == "closed"
+    state["error"] = ServerSelectionTimeoutError("No servers found yet")
+    response = client.get("/api/_test/mongo")
+    assert response.status_code == 503 and "Retry-After" in response.headers
+    assert breaker.state == "open"
+
+    # Açık devrede istek uygulamaya ulaşmaz; public ayarlar önbellekten/varsayılanlardan döner
+    calls = state["calls"]
+    assert client.get("/api/_test/mongo").status_code == 503
+    assert state["calls"] == calls
+    settings = client.get("/api/public/settings")
+    assert settings.status_code == 200
+    assert settings.json() == server.PUBLIC_SETTINGS_DEFAULTS
+
+    wait_for_half_open(breaker)
+    state["error"] = None
+    assert client.get("/api/_test/mongo").status_code == 200
+    assert breaker.snapshot()["state"] == "closed"
+    assert breaker.failures == 0
+
+
+def test_probe_that_never_reaches_mongo_does_not_close_the_circuit(guarded, monkeypatch):
+    client, state = guarded
+    breaker = client.app.state.scope.mongo_breaker
+    state["error"] = AutoReconnect("down")
+    client.get("/api/_test/mongo")
+    client.get("/api/_test/mongo")
+    assert breaker.state == "open"
+
+    async def unreachable(timeout_s):
+        return {"ok": False, "latency_ms": 0.0, "error": "ServerSelectionTimeoutError"}
+
+    monkeypatch.setattr(server, "mongo_ping", unreachable)
+    wait_for_half_open(breaker)
+    state["error"] = None
+    # Yol Mongo'ya dokunmadan başarılı oldu ama Mongo hâlâ cevap vermiyor
+    assert client.get("/api/_test/mongo").status_code == 200
+    assert breaker.state == "open"
+
+
+def test_cancelled_probe_leaves_the_circuit_half_open(guarded):
+    client, _ = guarded
+    breaker = client.app.state.scope.mongo_breaker
+    breaker.state, breaker.opened_at = "open", time.monotonic() - 1
+
+    async def cancelled_app(scope, receive, send):
+        raise asyncio.CancelledError()
+
+    async def run():
+        guard = server.MongoGuardMiddleware(cancelled_app)
+        with pytest.raises(asyncio.CancelledError):
+            await guard({"type": "http", "path": "/api/orders", "method": "GET", "headers": []}, None, None)
+
+    call(client, run)
+    assert breaker.state == "half_open"
+    # Sıradaki istek yeni bir deneme yapabilir
+    assert breaker.allow()
+
+
+def test_time_limits_and_analytics_timeouts_do_not_open_the_circuit(guarded, monkeypatch):
+    client, state = guarded
+    breaker = client.app.state.scope.mongo_breaker
+    monkeypatch.setattr(server, "MONGO_ANALYTICS_PREFIXES", ("/api/_test/analytics",))
+
+    # Sunucu tarafı maxTimeMS ve istemci tarafı CSOT bütçesi (komut beklerken ya da havuz kuyruğunda)
+    # aynı biçimde sınıflanır: 504, devreye hata yazılmaz
+    for error in (ExecutionTimeout("operation exceeded time limit", 50), NetworkTimeout("timed out"), WaitQueueTimeoutError("pool checkout timed out")):
+        state["error"] = error
+        for _ in range(3):
+            assert client.get("/api/_test/mongo").status_code == 504
+    state["error"] = ServerSelectionTimeoutError("No replica set members match selector Secondary")
+    for _ in range(3):
+        assert client.get("/api/_test/analytics").status_code == 504
+    assert breaker.state == "closed"
+
+    # Ana yolda sunucu seçimi süre aşımı erişilemezliktir
+    state["error"] = ServerSelectionTimeoutError("No servers found yet")
+    client.get("/api/_test/mongo")
+    assert client.get("/api/_test/mongo").status_code == 503
+    assert breaker.state == "open"
+
+
+def test_connection_errors_on_analytics_paths_open_the_circuit(guarded, monkeypatch):
+    client, state = guarded
+    breaker = client.app.state.scope.mongo_breaker
+    monkeypatch.setattr(server, "MONGO_ANALYTICS_PREFIXES", ("/api/_test/analytics",))
+    state["error"] = AutoReconnect("connection refused")
+    client.get("/api/_test/analytics")
+    client.get("/api/_test/analytics")
+    assert breaker.state == "open"
+
+
+def test_oauth_breaker_with_stub_transport(make_client, monkeypatch):
+    client = make_client(breaker_failure_threshold=2, breaker_reset_timeout_s=0.2)
+    breaker = client.app.state.scope.oauth_breaker
+    provider = {"calls": 0, "fail": True}
+
+    def handler(request):
+        provider["calls"] += 1
+        if provider["fail"]:
+            raise httpx.ConnectTimeout("provider timed out", request=request)
+        return httpx.Response(401, json={"detail": "unknown session"})
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(server.httpx, "AsyncClient", lambda **kwargs: real_client(transport=httpx.MockTransport(handler), **kwargs))
+
+    for _ in range(2):
+        assert client.post("/api/auth/session", json={"session_id": "s"}).status_code == 503
+    assert breaker.state == "open"
+    assert client.post("/api/auth/session", json={"session_id": "s"}).status_code == 503
+    assert provider["calls"] == 2
+
+    wait_for_half_open(breaker)
+    provider["fail"] = False
+    # Sağlayıcı cevap verdi (geçersiz oturum); devre kapanır
+    assert client.post("/api/auth/session", json={"session_id": "s"}).status_code == 401
+    assert breaker.state == "closed"
@@ -0,0 +1,28 @@
+from tests.conftest import auth_headers, call, company_headers, register
+
+
+def test_company_order_routes_resolve_the_profile_through_the_dependency(make_client, database):
+    client = make_client()
+    headers, company_id = company_headers(client, database)
+    call(client, database.orders.insert_one, {"order_id": "ORD-1", "customer_id": "c1", "status": "pending", "city": None, "created_at": "2024-01-01T00:00:00+00:00", "version": 1})
+
+    assert client.get("/api/orders/pool", headers=headers).status_code == 200
+    accepted = client.post("/api/orders/ORD-1/accept", headers=headers).json()
+    assert accepted["company_id"] == company_id and accepted["company_name"] == "Temiz Halı"
+    assert [o["order_id"] for o in client.get("/api/orders", headers=headers).json()["orders"]] == ["ORD-1"]
+
+    # Profili silinen firma hesabı tüm uç noktalarda aynı hatayı alır
+    call(client, database.companies.delete_one, {"user_id": company_id})
+    client.app.state.scope.company_cache.clear()
+    for method, path in (("get", "/api/orders"), ("get", "/api/orders/pool"), ("post", "/api/orders/ORD-1/accept")):
+        response = getattr(client, method)(path, headers=headers)
+        assert response.status_code == 404 and response.json()["detail"] == "Company profile not found"
+
+
+def test_non_company_roles_keep_their_order_views(make_client, database):
+    client = make_client()
+    register(client, "musteri@example.com")
+    headers = auth_headers(client, "musteri@example.com")
+    assert client.get("/api/orders", headers=headers).json() == {"orders": []}
+    assert client.get("/api/orders/pool", headers=headers).status_code == 403
+    assert client.post("/api/orders/ORD-1/accept", headers=headers).json()["detail"] == "Only companies can accept orders"
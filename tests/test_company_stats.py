@@ -0,0 +1,16 @@
+from tests.conftest import call, company_headers
+
+
+def test_company_stats_include_archived_orders(make_client, database):
+    client = make_client()
+    headers, company_id = company_headers(client, database)
+    order = lambda i, status, company=company_id: {"order_id": f"ORD-{i}", "company_id": company, "status": status}
+    call(client, database.orders.insert_many, [order(1, "assigned"), order(2, "delivered"), order(3, "washing")])
+    call(client, database.orders_archive.insert_many, [
+        order(4, "delivered"), order(5, "delivered"), order(6, "cancelled"), order(7, "delivered", company="co_baska"),
+    ])
+
+    stats = client.get("/api/company/stats", headers=headers).json()
+    assert stats["total_orders"] == 6
+    assert stats["completed_orders"] == 3
+    assert stats["pending_orders"] == 2
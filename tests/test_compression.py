@@ -0,0 +1,105 @@
+import asyncio
+import gzip
+import json
+
+import brotli
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("gzip, deflate, br", "br"),
+    ("br;q=0, gzip", "gzip"),
+    ("gzip;q=0.5, br;q=0", "gzip"),
+    ("identity", None),
+    ("*", "br"),
+    ("", None),
+])
+def test_negotiate_encoding(header, expected):
+    assert server.negotiate_encoding(header) == expected
+
+
+@pytest.fixture
+def app_client(make_client):
+    client = make_client(compression_min_size=1024)
+    rows = [{"order_id": f"ORD-{i:08d}", "status": "delivered"} for i in range(200)]
+
+    @client.app.get("/api/_test/large")
+    async def large():
+        return rows
+
+    @client.app.get("/api/_test/small")
+    async def small():
+        return {"ok": True}
+
+    @client.app.get("/api/_test/stream")
+    async def stream(size: int = 64):
+        async def body():
+            for i in range(size):
+                yield f"{i},satır\n".encode() * 10
+        return server.StreamingResponse(body(), media_type="text/csv")
+
+    @client.app.get("/api/_test/png")
+    async def png():
+        return server.Response(b"\x89PNG" + b"0" * 5000, media_type="image/png")
+
+    return client, rows
+
+
+def test_large_json_is_compressed_with_the_negotiated_encoding(app_client):
+    client, rows = app_client
+    for encoding, decode in (("br", brotli.decompress), ("gzip", gzip.decompress)):
+        with client.stream("GET", "/api/_test/large", headers={"Accept-Encoding": encoding}) as response:
+            raw = b"".join(response.iter_raw())
+        assert response.headers["content-encoding"] == encoding
+        assert "Accept-Encoding" in response.headers["vary"]
+        assert int(response.headers["content-length"]) == len(raw)
+        assert json.loads(decode(raw)) == rows
+
+
+def test_bodies_below_threshold_and_binary_types_pass_through(app_client):
+    client, _ = app_client
+    small = client.get("/api/_test/small", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+    png = client.get("/api/_test/png", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in png.headers and len(png.content) == 5004
+    identity = client.get("/api/_test/large", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in identity.headers
+
+
+def test_streaming_response_is_compressed_chunk_by_chunk(app_client):
+    client, _ = app_client
+    expected = b"".join(f"{i},satır\n".encode() * 10 for i in range(64))
+    with client.stream("GET", "/api/_test/stream", headers={"Accept-Encoding": "gzip"}) as response:
+        raw = b"".join(response.iter_raw())
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert gzip.decompress(raw) == expected
+
+    # Toplamı eşiğin altında kalan akış sıkıştırılmaz
+    short = client.get("/api/_test/stream", params={"size": 1}, headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in short.headers
+    assert short.content == "0,satır\n".encode() * 10
+
+
+def test_large_bodies_are_compressed_off_the_event_loop(make_client, monkeypatch):
+    client = make_client(compression_min_size=1024, compression_offload_size=4096)
+    offloaded = []
+    to_thread = asyncio.to_thread
+
+    async def counting_to_thread(func, *args):
+        offloaded.append(len(args[0]))
+        return await to_thread(func, *args)
+
+    monkeypatch.setattr(server.asyncio, "to_thread", counting_to_thread)
+
+    @client.app.get("/api/_test/sized")
+    async def sized(size: int):
+        return server.PlainTextResponse("x" * size)
+
+    client.get("/api/_test/sized", params={"size": 2000}, headers={"Accept-Encoding": "gzip"})
+    assert offloaded == []
+    response = client.get("/api/_test/sized", params={"size": 10000}, headers={"Accept-Encoding": "gzip"})
+    assert response.text == "x" * 10000
+    assert offloaded == [10000]
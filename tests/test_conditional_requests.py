@@ -0,0 +1,50 @@
+import server
+from tests.conftest import call, company_headers, in_scope
+
+
+def test_company_profile_revalidates_against_mongo(make_client, database):
+    client = make_client(company_cache_ttl_s=300)
+    headers, company_id = company_headers(client, database)
+
+    first = client.get("/api/company/profile", headers=headers)
+    etag = first.headers["etag"]
+    assert etag.startswith('W/"')
+    assert client.get("/api/company/profile", headers={**headers, "If-None-Match": etag}).status_code == 304
+
+    # Başka bir worker profili günceller; bu sürecin önbelleği henüz eski sürümü tutuyor
+    call(client, database.companies.update_one, {"user_id": company_id}, {"$set": {"company_name": "Yeni Ad"}, "$inc": {"version": 1}})
+    refreshed = client.get("/api/company/profile", headers={**headers, "If-None-Match": etag})
+    assert refreshed.status_code == 200
+    assert refreshed.json()["company_name"] == "Yeni Ad"
+    assert refreshed.headers["etag"] != etag
+
+    # Sıkıştırılmış ve sıkıştırılmamış yanıt aynı zayıf ETag ile doğrulanır
+    again = client.get("/api/company/profile", headers={**headers, "If-None-Match": refreshed.headers["etag"].removeprefix("W/"), "Accept-Encoding": "gzip"})
+    assert again.status_code == 304
+
+
+def test_order_list_revalidation_does_not_mutate_the_pool(make_client, database):
+    client = make_client()
+    headers, company_id = company_headers(client, database)
+    city = call(client, database.companies.find_one, {"user_id": company_id})["city"]
+    pool = client.app.state.scope.order_pool
+    for i, status in enumerate(("pending", "pending", "assigned")):
+        order = {"order_id": f"ORD-{i}", "customer_id": "c1", "status": status, "city": city, "created_at": f"2024-01-0{i + 1}T00:00:00+00:00", "version": 1}
+        call(client, database.orders.insert_one, order)
+        # Üçüncü sipariş başka bir worker'da atanmış, bu sürecin havuzunda hâlâ bekliyor görünüyor
+        in_scope(client, pool.add, {**order, "status": "pending"})
+    # Başka bir worker'da verilmiş red de henüz bu sürece yansımadı
+    call(client, database.order_fanout.insert_one, {"order_id": "ORD-1", "company_id": company_id, "rejected_at": "2024-01-05T00:00:00+00:00"})
+
+    # ETag için yapılan okuma havuzu düzeltmez ama düzelten okumayla aynı listeyi görür
+    peeked = call(client, pool.fetch, city, company_id, 100, server.ORDER_VERSION_PROJECTION, repair=False)
+    assert pool.order_ids(city, company_id) == ["ORD-2", "ORD-1", "ORD-0"]
+    fetched = call(client, pool.fetch, city, company_id, 100, server.ORDER_VERSION_PROJECTION)
+    assert [o["order_id"] for o in peeked] == [o["order_id"] for o in fetched] == ["ORD-0"]
+    assert pool.order_ids(city, company_id) == ["ORD-0"]
+
+    # Doğrulama yolu ile tam yanıt aynı ETag'i üretir
+    etag = client.get("/api/orders", headers=headers).headers["etag"]
+    assert client.get("/api/orders", headers={**headers, "If-None-Match": etag}).status_code == 304
+    call(client, database.orders.update_one, {"order_id": "ORD-0"}, {"$set": {"status": "assigned"}, "$inc": {"version": 1}})
+    assert client.get("/api/orders", headers={**headers, "If-None-Match": etag}).status_code == 200
@@ -0,0 +1,71 @@
+import server
+from tests.conftest import call
+
+
+def test_legacy_fallback_only_reads_unkeyed_users(make_client, database):
+    client = make_client()
+    call(client, database.users.insert_many, [
+        {"user_id": "legacy", "email": "Legacy@Example.com"},
+        {"user_id": "keyed", "email": "Keyed@Example.com", "email_key": "other@example.com"},
+    ])
+    client.app.state.scope.email_keys_migrated = False
+
+    assert call(client, server.find_user_by_email, " Legacy@Example.com")["user_id"] == "legacy"
+    # Anahtarı yazılmış kayıt yalnızca email_key ile bulunur
+    assert call(client, server.find_user_by_email, "Keyed@Example.com") is None
+    assert call(client, server.find_user_by_email, "OTHER@example.com")["user_id"] == "keyed"
+
+
+def test_workers_pick_up_a_migration_completed_elsewhere(make_client, database, monkeypatch):
+    client = make_client()
+    scope = client.app.state.scope
+    call(client, database.users.insert_one, {"user_id": "legacy", "email": "old@example.com"})
+    call(client, server.load_email_migration_state)
+    assert not scope.email_keys_migrated
+
+    # Migration başka bir worker'da tamamlandı; bu worker bir sonraki yeniden okumada görür
+    call(client, database.migrations.insert_one, {"_id": "email_keys", "completed_at": "2026-10-01T00:00:00+00:00"})
+    assert call(client, server.find_user_by_email, "old@example.com")["user_id"] == "legacy"
+    assert not scope.email_keys_migrated
+
+    monkeypatch.setattr(server, "EMAIL_MIGRATION_RECHECK_S", 0)
+    assert call(client, server.find_user_by_email, "old@example.com") is None
+    assert scope.email_keys_migrated
+
+
+def partial_filter_operators(expression):
+    for field, condition in expression.items():
+        if isinstance(condition, dict):
+            yield from ((field, op, value) for op, value in condition.items())
+        else:
+            yield field, "$eq", condition
+
+
+def test_partial_index_filters_only_use_operators_mongodb_accepts():
+    # Partial filtrelerde $exists yalnızca true olabilir; $ne/$nin/$not hiç desteklenmez
+    for collection, keys, options in server.INDEX_SPECS:
+        for field, op, value in partial_filter_operators(options.get("partialFilterExpression", {})):
+            assert op in ("$eq", "$exists", "$gt", "$gte", "$lt", "$lte", "$type"), (collection, keys, field, op)
+            assert op != "$exists" or value is True, (collection, keys, field)
+
+
+def test_legacy_email_index_is_created(make_client, database):
+    client = make_client()
+    indexes = call(client, database.users.index_information)
+    assert indexes["email_ci"]["key"] == [("email", 1)]
+    assert "email_key_ci" in indexes
+
+
+def test_every_index_is_created_on_a_real_server(make_mongo_client):
+    # mongomock index seçeneklerini doğrulamaz; geçersiz bir spec yalnızca gerçek sunucuda reddedilir
+    client = make_mongo_client()
+    database = client.app.state.scope.db
+    for collection, keys, options in server.INDEX_SPECS:
+        key = [(keys, 1)] if isinstance(keys, str) else list(keys)
+        created = call(client, database[collection].index_information).values()
+        assert any(index["key"] == key for index in created), f"{server.index_label(collection, keys)} missing"
+    assert client.app.state.scope.missing_unique_indexes == []
+
+    call(client, database.users.insert_one, {"user_id": "legacy", "email": "Legacy@Example.com"})
+    client.app.state.scope.email_keys_migrated = False
+    assert call(client, server.find_user_by_email, "legacy@example.COM")["user_id"] == "legacy"
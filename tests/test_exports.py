@@ -0,0 +1,75 @@
+import asyncio
+import io
+import re
+import zipfile
+
+import server
+from tests.conftest import admin_headers, call
+
+
+def sheet_rows(content: bytes, sheet: int = 1) -> list:
+    # constant_memory modunda hücreler satır içi string/sayı olarak yazılır
+    xml = zipfile.ZipFile(io.BytesIO(content)).read(f"xl/worksheets/sheet{sheet}.xml").decode()
+    return [re.findall(r"<(?:t|v)[^>]*>([^<]*)</(?:t|v)>", row) for row in re.findall(r"<row [^>]*>(.*?)</row>", xml)]
+
+
+def seed_orders(client, database, live, archived, **fields):
+    make = lambda i: {"order_id": f"ORD-{i:08d}", "customer_name": f"Müşteri {i}", "status": "delivered",
+                      "created_at": f"2024-01-01T00:00:{i % 60:02d}+00:00", **fields}
+    if live:
+        call(client, database.orders.insert_many, [make(i) for i in range(live)])
+    if archived:
+        call(client, database.orders_archive.insert_many, [make(i) for i in range(live, live + archived)])
+
+
+def test_order_exports_stream_every_row_including_the_archive(make_client, database):
+    client = make_client()
+    headers = admin_headers(client, database)
+    seed_orders(client, database, 2500, 300)
+
+    csv = client.get("/api/admin/export/orders", headers=headers)
+    lines = csv.text.splitlines()
+    assert lines[0].startswith("Order ID,Customer Name")
+    assert len(lines) == 1 + 2800
+
+    xlsx = client.get("/api/admin/export/orders", params={"format": "xlsx"}, headers=headers)
+    assert xlsx.headers["content-type"] == server.XLSX_MEDIA_TYPE
+    rows = sheet_rows(xlsx.content)
+    assert len(rows) == 1 + 2800
+    assert rows[0][0] == "Order ID" and rows[-1][0] == "ORD-00002799"
+
+    assert client.get("/api/admin/export/orders", params={"format": "pdf"}, headers=headers).status_code == 400
+
+
+def test_write_xlsx_handles_exact_batch_boundaries(tmp_path):
+    rows = [[i, f"satır {i}"] for i in range(2000)]
+    path = tmp_path / "out.xlsx"
+    asyncio.run(server.write_xlsx(path, [("Data", ["N", "Text"], server.iterate_rows(rows)), ("Empty", ["N"], server.iterate_rows([]))], batch_size=1000))
+    content = path.read_bytes()
+    assert len(sheet_rows(content, 1)) == 2001
+    assert sheet_rows(content, 1)[-1] == ["1999", "satır 1999"]
+    assert sheet_rows(content, 2) == [["N"]]
+
+
+def test_report_export_is_not_cut_at_the_interactive_limit(make_client, database):
+    client = make_client()
+    headers = admin_headers(client, database)
+    seed_orders(client, database, 1200, 0, delivery_date="2024-03-10T10:00:00+00:00", final_price=10.0, company_id="co_1", company_name="Temiz")
+    params = {"start": "2024-03-01T00:00:00+00:00", "end": "2024-03-31T00:00:00+00:00"}
+
+    report = client.get("/api/admin/reports", params=params, headers=headers).json()
+    assert report["total_orders"] == 1000
+    assert report["truncated"] is True
+
+    xlsx = client.get("/api/admin/export/reports", params=params, headers=headers)
+    summary = dict(sheet_rows(xlsx.content, 1)[1:])
+    assert summary["Total Orders"] == "1200"
+    assert float(summary["Total Final Price"]) == 12000.0
+
+
+def test_small_report_is_not_marked_truncated(make_client, database):
+    client = make_client()
+    headers = admin_headers(client, database)
+    seed_orders(client, database, 1000, 0, delivery_date="2024-03-10T10:00:00+00:00", final_price=1.0)
+    report = client.get("/api/admin/reports", params={"start": "2024-03-01T00:00:00+00:00", "end": "2024-03-31T00:00:00+00:00"}, headers=headers).json()
+    assert report["total_orders"] == 1000 and report["truncated"] is False
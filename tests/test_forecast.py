@@ -0,0 +1,85 @@
+from datetime import timedelta
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import server
+from tests.conftest import admin_headers, call
+
+
+@pytest.mark.parametrize("days", [0, 1, 3, 6, 7, 10])
+def test_histories_shorter_than_the_training_window_use_the_default_model(days):
+    history = np.tile(np.full(days, 4.0), (3, 1))
+    fit = server.fit_demand_forecast(history, 14)
+
+    assert fit["forecast"].shape == (3, 14)
+    assert np.isfinite(fit["forecast"]).all() and (fit["forecast"] >= 0).all()
+    assert fit["backtest"]["folds"] == 0 and fit["backtest"]["wape"] is None
+    assert set(fit["choice"]) == {server.FORECAST_MODELS.index(server.FORECAST_DEFAULT_MODEL)}
+    assert fit["series_wape"] == [None, None, None]
+
+
+def test_sub_week_history_counts_missing_days_as_zero_demand():
+    # Yalnızca son 3 gün: eksik 4 gün sıfır, mevsimsel naive geçen haftanın aynı gününü tekrarlar
+    naive = server.forecast_models(np.array([[5.0, 6.0, 7.0]]), 7)[0, 0]
+    assert naive.tolist() == [0.0, 0.0, 0.0, 0.0, 5.0, 6.0, 7.0]
+    assert server.forecast_models(np.zeros((2, 0)), 7).sum() == 0
+
+
+@pytest.mark.parametrize("days, folds", [
+    (server.FORECAST_MIN_TRAIN_DAYS + 6, 0),
+    (server.FORECAST_MIN_TRAIN_DAYS + 7, 1),
+    (server.FORECAST_MIN_TRAIN_DAYS + 20, 2),
+    (server.FORECAST_MIN_TRAIN_DAYS + 70, server.FORECAST_BACKTEST_FOLDS),
+])
+def test_backtest_folds_grow_with_history(days, folds):
+    rng = np.random.default_rng(3)
+    history = rng.poisson(20, size=(2, days)).astype(float)
+    fit = server.fit_demand_forecast(history, 7)
+    assert fit["backtest"]["folds"] == folds
+    assert (fit["backtest"]["wape"] is None) == (folds == 0)
+
+
+def test_constant_demand_is_forecast_flat():
+    fit = server.fit_demand_forecast(np.full((1, 60), 12.5), 7)
+    assert np.allclose(fit["forecast"], 12.5)
+    assert fit["backtest"]["wape"] == 0.0
+
+
+def stub_demand(client, monkeypatch, rows):
+    def aggregate(pipeline):
+        async def iterate():
+            for row in rows:
+                yield row
+        return iterate()
+
+    monkeypatch.setattr(client.app.state.scope, "analytics_db", SimpleNamespace(orders=SimpleNamespace(aggregate=aggregate)))
+
+
+def test_forecast_route_with_a_new_district(make_client, database, monkeypatch):
+    client = make_client()
+    headers = admin_headers(client, database)
+    _, end_day = server.forecast_history_range(56)
+    # Kadıköy yalnızca son üç gündür sipariş alıyor
+    rows = [
+        {"_id": {"day": (end_day - timedelta(days=i)).isoformat(), "city": "İstanbul", "district": "Kadıköy", "carpet_type": "normal"}, "area": 9.0}
+        for i in (1, 2, 3)
+    ]
+    stub_demand(client, monkeypatch, rows)
+
+    body = client.get("/api/admin/forecast", params={"history_days": 56, "horizon_days": 7}, headers=headers).json()
+    [series] = body["series"]
+    assert series["district"] == "Kadıköy" and len(series["daily"]) == 7
+    assert series["history_avg_daily_m2"] == round(27 / 56, 2)
+    assert all(day["area_m2"] >= 0 for day in series["daily"])
+    assert body["backtest"]["folds"] == server.FORECAST_BACKTEST_FOLDS
+
+
+def test_forecast_route_without_orders(make_client, database, monkeypatch):
+    client = make_client()
+    headers = admin_headers(client, database)
+    stub_demand(client, monkeypatch, [])
+    body = client.get("/api/admin/forecast", params={"history_days": 56}, headers=headers).json()
+    assert body["series"] == [] and body["backtest"]["folds"] == 1 and body["backtest"]["wape"] is None
+    assert client.get("/api/admin/forecast", params={"history_days": 30}, headers=headers).status_code == 400
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import time
+
+import server
+from tests.conftest import call, wait_until
+
+
+async def _status_is(database, job_id, status):
+    return (await database.jobs.find_one({"job_id": job_id}))["status"] == status
+
+
+def test_data_changing_jobs_never_reuse_completed_results(make_client, database, tmp_path):
+    client = make_client(job_results_dir=str(tmp_path))
+    runner = client.app.state.scope.job_runner
+
+    async def complete(job):
+        await database.jobs.update_one({"job_id": job["job_id"]}, {"$set": {
+            "status": "completed", "finished_at": server.datetime.now(server.timezone.utc).isoformat()}})
+        runner.result_path(job).write_text("{}")
+
+    archive = call(client, runner.submit, "archive_orders", {}, "admin")
+    assert call(client, runner.submit, "archive_orders", {}, "admin")["job_id"] == archive["job_id"]
+    call(client, complete, archive)
+    assert call(client, runner.submit, "archive_orders", {}, "admin")["job_id"] != archive["job_id"]
+
+    export = call(client, runner.submit, "export_orders", {}, "admin")
+    call(client, complete, export)
+    reused = call(client, runner.submit, "export_orders", {}, "admin")
+    assert reused["job_id"] == export["job_id"] and reused["reused"]
+
+
+def test_worker_survives_errors_outside_the_job(make_client, database, tmp_path, monkeypatch):
+    claim = server.JobRunner._claim
+    calls = {"n": 0}
+
+    async def flaky_claim(self):
+        calls["n"] += 1
+        if calls["n"] == 1:
+            raise server.ConnectionFailure("primary stepped down")
+        return await claim(self)
+
+    async def no_file(params, path):
+        pass  # sonuç dosyası yazmayan iş: stat() FileNotFoundError verir
+
+    monkeypatch.setattr(server.JobRunner, "_claim", flaky_claim)
+    monkeypatch.setitem(server.JOB_KINDS, "admin_report", (no_file, "json", ("json",), True))
+    client = make_client(job_results_dir=str(tmp_path), job_workers=1, job_poll_interval_s=0.05)
+    runner = client.app.state.scope.job_runner
+
+    first = call(client, runner.submit, "admin_report", {}, "admin")
+    wait_until(client, lambda: _status_is(database, first["job_id"], "failed"))
+    second = call(client, runner.submit, "admin_report", {"period": "weekly"}, "admin")
+    wait_until(client, lambda: _status_is(database, second["job_id"], "failed"))
+    assert calls["n"] > 1
+
+
+def test_lease_is_renewed_while_the_job_runs(make_client, database, tmp_path, monkeypatch):
+    release = asyncio.Event()
+
+    async def slow(params, path):
+        await release.wait()
+        path.write_text("done")
+
+    monkeypatch.setitem(server.JOB_KINDS, "export_orders", (slow, "csv", ("csv",), True))
+    client = make_client(job_results_dir=str(tmp_path), job_workers=1, job_poll_interval_s=0.05, job_lease_s=1)
+    runner = client.app.state.scope.job_runner
+    job = call(client, runner.submit, "export_orders", {}, "admin")
+    wait_until(client, lambda: _status_is(database, job["job_id"], "running"))
+    first_expiry = call(client, database.jobs.find_one, {"job_id": job["job_id"]})["lease_expires_at"]
+    time.sleep(1.5)
+    doc = call(client, database.jobs.find_one, {"job_id": job["job_id"]})
+    assert doc["status"] == "running" and doc["lease_expires_at"] > first_expiry
+    client.portal.call(release.set)
+    wait_until(client, lambda: _status_is(database, job["job_id"], "completed"))
+
+
+def test_job_cancelled_at_shutdown_is_requeued(make_client, database, tmp_path, monkeypatch):
+    async def forever(params, path):
+        path.write_text("partial")
+        await asyncio.Event().wait()
+
+    monkeypatch.setitem(server.JOB_KINDS, "export_orders", (forever, "csv", ("csv",), True))
+    client = make_client(job_results_dir=str(tmp_path), job_workers=1, job_poll_interval_s=0.05)
+    runner = client.app.state.scope.job_runner
+    job = call(client, runner.submit, "export_orders", {}, "admin")
+    wait_until(client, lambda: _status_is(database, job["job_id"], "running"))
+    client.__exit__(None, None, None)
+
+    doc = asyncio.run(database.jobs.find_one({"job_id": job["job_id"]}))
+    assert doc["status"] == "queued" and "lease_id" not in doc
+    assert not runner.result_path(job).exists()
+
+
+def test_expired_result_files_are_collected(make_client, tmp_path):
+    client = make_client(job_results_dir=str(tmp_path), job_result_ttl_s=60)
+    runner = client.app.state.scope.job_runner
+    old, fresh = tmp_path / "job_old.csv", tmp_path / "job_fresh.csv"
+    old.write_text("x")
+    fresh.write_text("y")
+    os.utime(old, (time.time() - 120, time.time() - 120))
+
+    assert runner.collect_results() == 1
+    assert not old.exists() and fresh.exists()
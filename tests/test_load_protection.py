@@ -0,0 +1,51 @@
+from starlette.requests import Request
+
+import server
+from tests.conftest import in_scope
+
+
+def make_request(peer, forwarded=None):
+    headers = [(b"x-forwarded-for", value.encode()) for value in ([forwarded] if forwarded else [])]
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers, "client": (peer, 40000)})
+
+
+def test_forwarded_for_is_ignored_without_trusted_proxies(make_client):
+    client = make_client()
+    assert in_scope(client, server.client_ip, make_request("203.0.113.9", "1.2.3.4")) == "203.0.113.9"
+
+
+def test_forwarded_for_uses_right_most_untrusted_hop(make_client):
+    client = make_client(trusted_proxies=["10.0.0.0/8", "192.168.1.5"])
+    # İstemci sahte bir ilk adres eklese de gerçek adres güvenilen proxy'nin eklediği son adrestir
+    assert in_scope(client, server.client_ip, make_request("10.1.2.3", "6.6.6.6, 198.51.100.7, 192.168.1.5")) == "198.51.100.7"
+    assert in_scope(client, server.client_ip, make_request("10.1.2.3", "10.9.9.9")) == "10.9.9.9"
+    assert in_scope(client, server.client_ip, make_request("10.1.2.3")) == "10.1.2.3"
+    # Güvenilmeyen bir eş başlığı kendisi yazamaz
+    assert in_scope(client, server.client_ip, make_request("198.51.100.7", "8.8.8.8")) == "198.51.100.7"
+
+
+def test_streamed_response_counts_as_in_flight_until_the_body_is_sent(make_client):
+    client = make_client(max_in_flight_requests=10)
+    scope = client.app.state.scope
+    seen = []
+
+    async def body():
+        for _ in range(3):
+            seen.append(scope.in_flight_requests)
+            yield b"chunk"
+
+    @client.app.get("/api/_test/stream")
+    async def stream():
+        return server.StreamingResponse(body(), media_type="text/plain")
+
+    assert client.get("/api/_test/stream").text == "chunk" * 3
+    assert seen == [1, 1, 1]
+    assert scope.in_flight_requests == 0
+
+
+def test_requests_over_the_limit_are_shed(make_client):
+    client = make_client(max_in_flight_requests=1)
+    client.app.state.scope.in_flight_requests = 1
+    response = client.get("/api/locations")
+    assert response.status_code == 503 and response.headers["Retry-After"] == "1"
+    assert client.get("/api/health/live").status_code == 200
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta, timezone
+
+import server
+from tests.conftest import admin_headers, auth_headers, call, register
+
+OLD = (datetime.now(timezone.utc) - timedelta(days=800)).isoformat()
+
+
+def test_archived_orders_stay_visible_in_lists_and_search(make_client, database):
+    client = make_client()
+    register(client, "musteri@example.com")
+    customer = call(client, database.users.find_one, {"email_key": "musteri@example.com"})
+    call(client, database.orders.insert_many, [
+        {"order_id": "ORD-OLD", "customer_id": customer["user_id"], "customer_name": "Ayşe", "status": "delivered",
+         "delivery_date": OLD, "created_at": OLD, "version": 1},
+        {"order_id": "ORD-NEW", "customer_id": customer["user_id"], "customer_name": "Ayşe", "status": "pending",
+         "created_at": datetime.now(timezone.utc).isoformat(), "version": 1},
+    ])
+    result = call(client, server.run_order_archival, 365, 100)
+    assert result["moved"] == 1 and call(client, database.orders_archive.count_documents, {}) == 1
+
+    listed = client.get("/api/orders", headers=auth_headers(client, "musteri@example.com")).json()["orders"]
+    assert [o["order_id"] for o in listed] == ["ORD-NEW", "ORD-OLD"]
+
+    headers = admin_headers(client, database)
+    found = client.get("/api/admin/orders/search", params={"name": "Ayşe"}, headers=headers).json()["orders"]
+    assert [o["order_id"] for o in found] == ["ORD-NEW", "ORD-OLD"]
+    hot_only = client.get("/api/admin/orders/search", params={"name": "Ayşe", "include_archive": False}, headers=headers).json()["orders"]
+    assert [o["order_id"] for o in hot_only] == ["ORD-NEW"]
+
+
+def test_archival_never_overwrites_a_different_archived_order(make_client, database):
+    client = make_client()
+    call(client, database.orders_archive.insert_one, {"order_id": "ORD-1", "customer_id": "legacy", "created_at": "2020-01-01", "status": "delivered"})
+    call(client, database.orders.insert_many, [
+        {"order_id": "ORD-1", "customer_id": "new", "created_at": OLD, "status": "delivered", "delivery_date": OLD},
+        {"order_id": "ORD-2", "customer_id": "new", "created_at": OLD, "status": "delivered", "delivery_date": OLD},
+    ])
+
+    result = call(client, server.run_order_archival, 365, 1)
+    assert result["conflicts"] == ["ORD-1"] and result["moved"] == 1
+    assert call(client, database.orders_archive.find_one, {"order_id": "ORD-1"})["customer_id"] == "legacy"
+    assert call(client, database.orders.find_one, {"order_id": "ORD-1"})["customer_id"] == "new"
+    # Yeniden çalıştırma aynı sonuca ulaşır
+    assert call(client, server.run_order_archival, 365, 1)["moved"] == 0
@@ -0,0 +1,79 @@
+import asyncio
+
+import server
+from tests.conftest import call
+
+
+def test_concurrent_workers_never_allocate_the_same_id(make_client, database):
+    client = make_client()
+
+    async def stress():
+        # Her allocator ayrı bir worker process'i temsil eder; bloklar aynı sayaçtan ayrılır.
+        # Küçük bloklar sayaç çekişmesini, büyükler yüksek hacmi zorlar (toplam ~1M ID)
+        allocators = [server.OrderIdAllocator(block_size=size) for size in (7, 61, 499, 997) * 2]
+
+        async def worker(allocator):
+            return [await allocator.allocate() for _ in range(42_000)]
+
+        batches = await asyncio.gather(*(worker(a) for a in allocators for _ in range(3)))
+        return [order_id for batch in batches for order_id in batch]
+
+    ids = call(client, stress)
+    assert len(ids) == 8 * 3 * 42_000
+    assert len(set(ids)) == len(ids)
+    assert all(len(order_id) == 12 and order_id.startswith("ORD-") for order_id in ids)
+
+
+def test_insert_skips_ids_taken_by_archived_or_legacy_orders(make_client, database):
+    client = make_client(order_id_block_size=10)
+    first, second = (f"ORD-{server.scramble_order_number(n):08X}" for n in (1, 2))
+    call(client, database.orders_archive.insert_one, {"order_id": first, "customer_id": "legacy"})
+    call(client, database.orders.insert_one, {"order_id": second, "customer_id": "legacy"})
+
+    order = {"order_id": None, "customer_id": "new", "status": "pending"}
+    call(client, server.insert_order, order)
+    assert order["order_id"] not in (first, second)
+    assert call(client, database.orders_archive.find_one, {"order_id": first})["customer_id"] == "legacy"
+    assert call(client, database.orders.count_documents, {"customer_id": "new"}) == 1
+
+
+def test_missing_unique_index_is_reported_without_failing_readiness(make_client, database):
+    client = make_client(ready_max_checkout_wait_ms=0, ready_max_loop_lag_ms=0, ready_max_ping_ms=10000)
+    # Eski rastgele ID'lerden kalan çakışma unique index'in kurulmasını engeller
+    call(client, database.orders.drop_index, "order_id_1")
+    call(client, database.orders.insert_many, [{"order_id": "ORD-LEGACY01", "customer_id": f"c{i}"} for i in range(2)])
+    call(client, server.ensure_indexes, [("orders", "order_id", {"unique": True})])
+
+    response = client.get("/api/health/ready")
+    assert response.status_code == 200, response.json()
+    assert response.json()["missing_unique_indexes"] == ["orders.order_id"]
+
+
+def test_dedupe_job_reassigns_duplicate_ids_and_rebuilds_the_index(make_client, database):
+    client = make_client(order_id_block_size=10)
+    legacy = lambda customer, day: {"order_id": "ORD-LEGACY01", "customer_id": customer, "created_at": f"2023-01-0{day}T00:00:00+00:00", "version": 1}
+    call(client, database.orders.drop_index, "order_id_1")
+    call(client, database.orders.insert_many, [legacy("newer", 3), legacy("oldest", 1), legacy("middle", 2)])
+    call(client, database.order_fanout.insert_one, {"order_id": "ORD-LEGACY01", "company_id": "co_1", "notified_at": "2023-01-01T00:00:00+00:00"})
+    call(client, server.ensure_indexes, [("orders", "order_id", {"unique": True})])
+    assert client.app.state.scope.missing_unique_indexes == ["orders.order_id"]
+
+    report = call(client, server.run_order_id_dedupe, True)
+    assert report["orders"]["duplicate_groups"] == 1 and report["orders"]["duplicate_orders"] == 2
+    assert report["orders"]["reassigned"] == []
+    assert call(client, database.orders.count_documents, {"order_id": "ORD-LEGACY01"}) == 3
+
+    report = call(client, server.run_order_id_dedupe, False)
+    new_ids = [entry["order_id"] for entry in report["orders"]["reassigned"]]
+    assert len(set(new_ids)) == 2 and "ORD-LEGACY01" not in new_ids
+    assert report["missing_unique_indexes"] == []
+    # En eski sipariş numarasını korur, diğerleri eski numarayı previous_order_id'de taşır
+    assert call(client, database.orders.find_one, {"order_id": "ORD-LEGACY01"})["customer_id"] == "oldest"
+    for order_id in new_ids:
+        order = call(client, database.orders.find_one, {"order_id": order_id})
+        assert order["previous_order_id"] == "ORD-LEGACY01" and order["version"] == 2
+        assert call(client, database.order_fanout.count_documents, {"order_id": order_id, "company_id": "co_1"}) == 1
+
+    # İkinci çalıştırma yapacak iş bulamaz
+    report = call(client, server.run_order_id_dedupe, False)
+    assert report["orders"]["duplicate_groups"] == 0 and report["orders_archive"]["duplicate_groups"] == 0
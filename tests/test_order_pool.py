@@ -0,0 +1,47 @@
+import asyncio
+
+from tests.conftest import call
+
+
+def pending(i, **extra):
+    return {"order_id": f"ORD-{i:04d}", "city": "Ankara", "status": "pending", "created_at": f"2026-01-01T00:{i:02d}:00", "schema_version": 2, **extra}
+
+
+def test_fetch_skips_rejections_made_by_other_workers_and_backfills(make_client, database):
+    client = make_client()
+    pool = client.app.state.scope.order_pool
+    call(client, database.orders.insert_many, [pending(i) for i in range(6)] + [
+        {**pending(6, schema_version=None), "rejected_by": ["company_a"]},
+    ])
+    call(client, pool.load)
+    # Yükleme sonrası başka bir worker'da verilen red: bu process'in belleğinde yok
+    call(client, database.order_fanout.insert_one, {"order_id": "ORD-0005", "company_id": "company_a", "rejected_at": "2026-01-02"})
+    call(client, database.orders.update_one, {"order_id": "ORD-0004"}, {"$set": {"status": "assigned"}})
+
+    fetched = [o["order_id"] for o in call(client, pool.fetch, "Ankara", "company_a", 3)]
+    assert fetched == ["ORD-0003", "ORD-0002", "ORD-0001"]
+    assert call(client, pool.fetch, "Ankara", "company_a", 10)[-1]["order_id"] == "ORD-0000"
+    # Red yalnızca o firma için geçerlidir; eski rejected_by'lı sipariş diğer firmalara görünür kalır
+    others = [o["order_id"] for o in call(client, pool.fetch, "Ankara", "company_b", 10)]
+    assert others == ["ORD-0006", "ORD-0005", "ORD-0003", "ORD-0002", "ORD-0001", "ORD-0000"]
+
+
+def test_mutations_during_load_survive_the_swap(make_client, database, monkeypatch):
+    client = make_client()
+    pool = client.app.state.scope.order_pool
+    call(client, database.orders.insert_many, [pending(i) for i in range(2)])
+    read = pool._read
+
+    async def slow_read():
+        maps = await read()
+        # Okuma bittikten sonra, görünüm değiştirilmeden önce gelen mutasyonlar
+        pool.add(pending(9))
+        pool.reject("ORD-0000", "company_a")
+        pool.remove("ORD-0001")
+        await asyncio.sleep(0)
+        return maps
+
+    monkeypatch.setattr(pool, "_read", slow_read)
+    call(client, pool.load)
+    assert pool.order_ids("Ankara", "company_a") == ["ORD-0009"]
+    assert pool.order_ids("Ankara", "company_b") == ["ORD-0009", "ORD-0000"]
@@ -0,0 +1,88 @@
+import server
+from tests.conftest import call
+
+
+def v1_order(order_id="ORD-1", version=3, **fields):
+    return {
+        "order_id": order_id, "customer_id": "c1", "status": "pending", "city": "İstanbul", "district": "Kadıköy",
+        "company_id": None, "company_name": None, "pickup_date": None, "notes": "", "final_price": 0,
+        "notified_companies": ["co_1", "co_2", "co_3"], "rejected_by": ["co_2", "co_9"],
+        "created_at": "2024-01-01T00:00:00+00:00", "updated_at": "2024-01-02T00:00:00+00:00", "version": version, **fields,
+    }
+
+
+def test_compact_order_strips_nulls_and_moves_arrays_to_fanout_rows():
+    order = v1_order()
+    rows = server.compact_order(order)
+
+    assert order["schema_version"] == server.ORDER_SCHEMA_VERSION
+    assert not any(value is None for value in order.values())
+    assert "notified_companies" not in order and "rejected_by" not in order
+    # Boş string ve sıfır "yok" değildir, korunur
+    assert order["notes"] == "" and order["final_price"] == 0
+    by_company = {row["company_id"]: row for row in rows}
+    assert sorted(by_company) == ["co_1", "co_2", "co_3", "co_9"]
+    # Hem bildirilmiş hem reddetmiş firma tek satırda iki zamanı taşır
+    assert by_company["co_2"] == {"order_id": "ORD-1", "company_id": "co_2", "notified_at": "2024-01-01T00:00:00+00:00", "rejected_at": "2024-01-02T00:00:00+00:00"}
+    assert by_company["co_1"] == {"order_id": "ORD-1", "company_id": "co_1", "notified_at": "2024-01-01T00:00:00+00:00"}
+    assert "notified_at" not in by_company["co_9"]
+
+
+def test_v1_read_view_matches_the_rewritten_document():
+    original = v1_order()
+    compact = dict(original)
+    server.compact_order(compact)
+
+    upgraded = server.upgrade_order(original)
+    assert upgraded == {key: value for key, value in compact.items() if key != "schema_version"}
+    assert original["notified_companies"] == ["co_1", "co_2", "co_3"]  # okuma yolu dokümanı değiştirmez
+    assert server.upgrade_order(compact) is compact
+    assert server.upgrade_order(None) is None
+
+
+def test_rewrite_orders_is_idempotent_and_keeps_the_earliest_fanout_stamp(make_client, database):
+    client = make_client()
+    call(client, database.orders.insert_many, [v1_order("ORD-1"), v1_order("ORD-2", rejected_by=[])])
+    # Aynı satır daha önce (daha geç bir zamanla) yazılmış olabilir
+    call(client, database.order_fanout.insert_one, {"order_id": "ORD-1", "company_id": "co_1", "notified_at": "2024-06-01T00:00:00+00:00"})
+
+    orders = call(client, database.orders.find({}).sort("_id", 1).to_list, None)
+    first = call(client, server.rewrite_orders, database.orders, orders)
+    assert first["rewritten"] == 2 and first["skipped"] == 0 and first["fanout_rows"] == 7
+    assert first["bytes_after"] < first["bytes_before"]
+
+    # Aynı (artık eski) girdilerle tekrar çalıştırmak hiçbir şeyi değiştirmez
+    second = call(client, server.rewrite_orders, database.orders, orders)
+    assert second["rewritten"] == 0 and second["skipped"] == 2
+    assert call(client, database.order_fanout.count_documents, {}) == 7
+    assert call(client, database.order_fanout.find_one, {"order_id": "ORD-1", "company_id": "co_1"})["notified_at"] == "2024-01-01T00:00:00+00:00"
+
+    stored = call(client, database.orders.find_one, {"order_id": "ORD-1"}, {"_id": 0})
+    assert stored["schema_version"] == server.ORDER_SCHEMA_VERSION and stored["version"] == 3
+    assert "company_id" not in stored and "rejected_by" not in stored
+
+
+def test_rewrite_orders_skips_documents_updated_in_between(make_client, database):
+    client = make_client()
+    call(client, database.orders.insert_one, v1_order("ORD-1"))
+    orders = call(client, database.orders.find({}).to_list, None)
+    call(client, database.orders.update_one, {"order_id": "ORD-1"}, {"$set": {"status": "assigned"}, "$inc": {"version": 1}})
+
+    result = call(client, server.rewrite_orders, database.orders, orders)
+    assert result["rewritten"] == 0 and result["skipped"] == 1
+    assert call(client, database.orders.find_one, {"order_id": "ORD-1"})["status"] == "assigned"
+
+
+def test_compaction_job_converges(make_client, database):
+    client = make_client()
+    call(client, database.orders.insert_many, [v1_order(f"ORD-{i}") for i in range(25)])
+    call(client, database.orders_archive.insert_many, [v1_order(f"ORD-A{i}", status="delivered") for i in range(5)])
+
+    report = call(client, server.run_order_compaction, 10)
+    assert report["orders"]["rewritten"] == 25 and report["orders"]["batches"] == 3
+    assert report["orders_archive"]["rewritten"] == 5
+    assert report["orders"]["reduction_pct"] > 0
+
+    again = call(client, server.run_order_compaction, 10)
+    assert again["orders"]["rewritten"] == 0 and again["orders"]["batches"] == 0
+    assert again["orders_archive"]["rewritten"] == 0
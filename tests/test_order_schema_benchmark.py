@@ -0,0 +1,76 @@
+"""Sipariş şeması (v1 -> v2) depolama benchmark'ı - ek servis gerektirmez.
+
+    ORDER_SCHEMA_BENCHMARK_ORDERS=100000 python -m pytest -q -s tests/test_order_schema_benchmark.py
+
+Sentetik v1 siparişleri `compact_order` ile (rewrite_orders'ın yazdığı dönüşüm) v2'ye çevirir;
+sipariş dokümanlarının, fan-out satırlarının ve sıcak çalışma kümesinin (aktif siparişler ile havuzun
+okuduğu red satırları) BSON boyutunu önce/sonra raporlar."""
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+import bson
+
+import server
+
+ORDER_COUNT = int(os.environ.get("ORDER_SCHEMA_BENCHMARK_ORDERS", 5000))
+ACTIVE_STATUSES = ["pending", "assigned", "picked_up", "washing", "ready"]
+OPTIONAL_FIELDS = ["company_id", "company_name", "assigned_at", "pickup_date", "picked_up_at", "delivery_date", "pickup_slot", "notes_company"]
+
+
+def make_v1_orders(count, seed=11):
+    rng = random.Random(seed)
+    companies = [f"user_{i:012x}" for i in range(60)]
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    orders = []
+    for i in range(count):
+        status = rng.choices(ACTIVE_STATUSES + ["delivered", "cancelled"], weights=[15, 8, 6, 6, 5, 55, 5])[0]
+        created = start + timedelta(minutes=rng.randrange(365 * 24 * 60))
+        notified = rng.sample(companies, rng.randint(5, 40))
+        order = {
+            "order_id": f"ORD-{i:08X}", "customer_id": f"user_c{i % 3000:08d}", "customer_name": "Ayşe Yılmaz",
+            "customer_phone": f"5{rng.randrange(10**9):09d}", "city": "İstanbul", "district": "Kadıköy",
+            "address": "Caferağa Mah. Moda Cad. No: 12", "carpets": [{"carpet_type": "normal", "area": 6.0, "price": 300.0}],
+            "total_area": 6.0, "total_price": 300.0, "discount": 0, "final_price": 300.0, "status": status,
+            "notified_companies": notified, "rejected_by": rng.sample(notified, rng.randint(0, 4)),
+            "created_at": created.isoformat(), "updated_at": (created + timedelta(hours=2)).isoformat(), "version": 1,
+            **{field: None for field in OPTIONAL_FIELDS},
+        }
+        if status != "pending":
+            order.update(company_id=rng.choice(notified), company_name="Temiz Halı", assigned_at=order["updated_at"])
+        orders.append(order)
+    return orders
+
+
+def sizes(orders, fanout):
+    active = {o["order_id"] for o in orders if o["status"] in ACTIVE_STATUSES}
+    pending = {o["order_id"] for o in orders if o["status"] == "pending"}
+    order_bytes = sum(len(bson.encode(o)) for o in orders)
+    fanout_bytes = sum(len(bson.encode(r)) for r in fanout)
+    working_set = sum(len(bson.encode(o)) for o in orders if o["order_id"] in active)
+    working_set += sum(len(bson.encode(r)) for r in fanout if r["order_id"] in pending and "rejected_at" in r)
+    return order_bytes, fanout_bytes, working_set
+
+
+def test_compaction_reduces_order_storage_and_working_set():
+    orders = make_v1_orders(ORDER_COUNT)
+    before = sizes(orders, [])
+
+    compacted, fanout = [], []
+    for order in orders:
+        order = dict(order)
+        fanout.extend(server.compact_order(order))
+        compacted.append(order)
+    after = sizes(compacted, fanout)
+
+    reduction = lambda old, new: 100 * (1 - new / old)
+    print(f"\n{ORDER_COUNT} orders: order documents {before[0] / 1e6:.1f} MB -> {after[0] / 1e6:.1f} MB ({reduction(before[0], after[0]):.1f}%), "
+          f"fan-out rows {len(fanout)} / {after[1] / 1e6:.1f} MB, total {before[0] / 1e6:.1f} MB -> {(after[0] + after[1]) / 1e6:.1f} MB, "
+          f"working set {before[2] / 1e6:.1f} MB -> {after[2] / 1e6:.1f} MB ({reduction(before[2], after[2]):.1f}%)")
+
+    assert all(order["schema_version"] == server.ORDER_SCHEMA_VERSION for order in compacted)
+    assert reduction(before[0], after[0]) > 40
+    assert reduction(before[2], after[2]) > 40
+    # Fan-out satırı (~100 bayt) dizideki bir ID'den büyüktür; toplam disk kullanımı artar, kazanç
+    # sıcak sipariş dokümanlarının küçülmesi ve yalnızca redlerin havuz okumasına girmesidir
+    assert after[1] > 0
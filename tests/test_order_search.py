@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta, timezone
+
+from tests.conftest import admin_headers, call
+
+BASE = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def seed_orders(client, database, names):
+    orders = [
+        {
+            "order_id": f"ORD-{i:06d}", "customer_name": name, "customer_phone": f"555{i:07d}",
+            "city": "İstanbul", "district": "Kadıköy", "status": "pending",
+            # Her iki siparişte bir aynı created_at: sıralama order_id ile kesinleşir
+            "created_at": (BASE + timedelta(minutes=i // 2)).isoformat(),
+        }
+        for i, name in enumerate(names)
+    ]
+    call(client, database.orders.insert_many, orders)
+    return orders
+
+
+def test_name_search_matches_prefix(make_client, database):
+    client = make_client()
+    headers = admin_headers(client, database)
+    seed_orders(client, database, ["Ayşe Yılmaz", "Ayşegül Demir", "Mehmet Ay", "Ali Ayşe"])
+
+    response = client.get("/api/admin/orders/search", params={"name": "Ayşe"}, headers=headers)
+    assert response.status_code == 200
+    assert sorted(o["customer_name"] for o in response.json()["orders"]) == ["Ayşe Yılmaz", "Ayşegül Demir"]
+
+
+def test_cursor_pages_cover_every_order_once_in_order(make_client, database):
+    client = make_client()
+    headers = admin_headers(client, database)
+    orders = seed_orders(client, database, [f"Müşteri {i}" for i in range(23)])
+
+    seen, cursor = [], None
+    while True:
+        params = {"city": "İstanbul", "page_size": 5, **({"cursor": cursor} if cursor else {})}
+        page = client.get("/api/admin/orders/search", params=params, headers=headers).json()
+        seen.extend(o["order_id"] for o in page["orders"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    expected = [o["order_id"] for o in sorted(orders, key=lambda o: (o["created_at"], o["order_id"]), reverse=True)]
+    assert seen == expected
+
+
+def test_invalid_cursor_is_rejected(make_client, database):
+    client = make_client()
+    headers = admin_headers(client, database)
+    assert client.get("/api/admin/orders/search", params={"cursor": "not-a-cursor"}, headers=headers).status_code == 400
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+from tests.conftest import call
+
+
+def message(recipient, order_id, text, created, due):
+    doc = server.outbox_message(recipient, order_id, "order_status", text)
+    doc.update({"channel": "stub", "created_at": created.isoformat(), "next_attempt_at": due.isoformat()})
+    return doc
+
+
+def test_notification_sender_requires_send():
+    with pytest.raises(TypeError):
+        server.NotificationSender()
+
+    class Incomplete(server.NotificationSender):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_messages_coalesce_across_claims_within_the_window(make_client, database):
+    # Uygulamanın kendi dispatcher'ı testin mesajlarını talep etmesin
+    client = make_client(outbox_poll_interval_s=3600)
+    now = datetime.now(timezone.utc)
+    call(client, database.outbox.insert_many, [
+        message("5551", "ORD-1", "alındı", now - timedelta(seconds=20), now - timedelta(seconds=5)),
+        # Pencere dolmadı; tek başına henüz vadesi gelmemiş olsa da eski mesajla birlikte gider
+        message("5551", "ORD-1", "yıkanıyor", now - timedelta(seconds=5), now + timedelta(seconds=10)),
+        message("5552", "ORD-2", "alındı", now - timedelta(seconds=5), now + timedelta(seconds=10)),
+    ])
+    sender = server.StubSender()
+    dispatcher = server.OutboxDispatcher({"stub": sender}, batch_size=1, poll_interval_s=1, max_attempts=3, backoff_base_s=1, lease_s=60)
+
+    batch = call(client, dispatcher._claim)
+    assert sorted(m["text"] for m in batch) == ["alındı", "yıkanıyor"]
+    call(client, dispatcher.dispatch, batch)
+
+    assert list(sender.sent) == [("5551", "yıkanıyor")]
+    rows = {m["text"] + m["recipient"]: m for m in call(client, database.outbox.find({}).to_list, None)}
+    assert rows["alındı5551"]["status"] == "coalesced"
+    assert rows["yıkanıyor5551"]["status"] == "sent"
+    assert isinstance(rows["yıkanıyor5551"]["sent_at"], datetime)
+    assert rows["alındı5552"]["status"] == "pending"
+    assert call(client, dispatcher._claim) == []
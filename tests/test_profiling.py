@@ -0,0 +1,96 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import server
+from tests.conftest import admin_headers, auth_headers, call, register
+
+
+def command_event(request_id, name="find", collection="orders", duration_micros=2500):
+    return SimpleNamespace(request_id=request_id, command_name=name, command={name: collection}, duration_micros=duration_micros)
+
+
+def test_profiling_flag_parsing():
+    scope = lambda headers=(), query=b"": {"headers": list(headers), "query_string": query}
+    assert server.profiling_requested(scope([(b"x-profile", b"1")]))
+    assert not server.profiling_requested(scope([(b"x-profile", b"0")]))
+    assert not server.profiling_requested(scope([(b"x-profile", b"false")]))
+    assert server.profiling_requested(scope(query=b"status=pending&_profile=1"))
+    assert not server.profiling_requested(scope(query=b"status=pending"))
+
+
+def test_profile_records_commands_and_folds_them_into_synthetic_frames():
+    profile = server.RequestProfile("GET /api/orders", 0, 0.005)
+    profile.command_started(command_event(1))
+    profile.command_finished(command_event(1), ok=True)
+    profile.command_started(command_event(2, duration_micros=7500))
+    profile.command_finished(command_event(2, duration_micros=7500), ok=False)
+    # Başlangıcı görülmeyen komut adıyla kaydedilir, koleksiyonu bilinmez
+    profile.command_finished(command_event(3, name="ping", collection=1), ok=True)
+    profile.stacks = {"main (a.py:1);handler (b.py:2)": 4}
+
+    assert [(c["command"], c["collection"], c["ok"]) for c in profile.commands] == [("find", "orders", True), ("find", "orders", False), ("ping", None, True)]
+    folded = profile.folded().splitlines()
+    assert "GET /api/orders;python;main (a.py:1);handler (b.py:2) 4" in folded
+    # 2.5 + 7.5 ms, 5 ms'lik örnekleme aralığında 2 örneğe denk gelir
+    assert "GET /api/orders;mongo;find orders 2" in folded
+    assert "GET /api/orders;mongo;ping - 1" in folded
+
+
+def test_profile_command_list_is_capped():
+    profile = server.RequestProfile("GET /", 0, 0.005)
+    for i in range(server.PROFILE_MAX_COMMANDS + 50):
+        profile.command_started(command_event(i))
+        profile.command_finished(command_event(i), ok=True)
+    assert len(profile.commands) == server.PROFILE_MAX_COMMANDS
+    assert profile._pending == {}
+
+
+def test_sampler_sees_the_busy_thread():
+    profile = server.RequestProfile("busy", threading.get_ident(), 0.001)
+    profile.start()
+    deadline = time.perf_counter() + 0.1
+    while time.perf_counter() < deadline:
+        sum(range(1000))
+    profile.stop()
+    assert profile.samples > 0
+    assert any("test_sampler_sees_the_busy_thread" in stack for stack in profile.stacks)
+    assert profile.wall_ms >= 100
+
+
+def test_admin_profile_is_stored_and_served(make_client, database):
+    client = make_client()
+    headers = admin_headers(client, database)
+
+    plain = client.get("/api/admin/stats", headers=headers)
+    assert "x-profile-id" not in plain.headers
+
+    response = client.get("/api/admin/stats", headers={**headers, "X-Profile": "1"})
+    assert response.status_code == 200
+    profile_id = response.headers["x-profile-id"]
+    stored = call(client, database.profiles.find_one, {"profile_id": profile_id})
+    assert stored["label"] == "GET /api/admin/stats" and stored["status_code"] == 200
+    assert stored["wall_ms"] > 0 and stored["expires_at"] is not None
+
+    listed = client.get("/api/admin/profiles", headers=headers).json()["profiles"]
+    assert [p["profile_id"] for p in listed] == [profile_id]
+    assert "folded" not in listed[0]
+    assert client.get(f"/api/admin/profiles/{profile_id}", headers=headers).json()["profile_id"] == profile_id
+    folded = client.get(f"/api/admin/profiles/{profile_id}", params={"format": "folded"}, headers=headers)
+    assert folded.headers["content-type"].startswith("text/plain")
+    assert client.get(f"/api/admin/profiles/{profile_id}", params={"format": "svg"}, headers=headers).status_code == 400
+    assert client.get("/api/admin/profiles/prof_missing", headers=headers).status_code == 404
+
+
+def test_profiling_requires_admin_and_can_be_disabled(make_client, database):
+    client = make_client()
+    register(client, "musteri@example.com")
+    response = client.get("/api/orders", params={"_profile": "1"}, headers=auth_headers(client, "musteri@example.com"))
+    assert response.status_code == 403
+    assert client.get("/api/orders", headers={"X-Profile": "1"}).status_code == 401
+
+    disabled = make_client(profiling_enabled=False)
+    headers = admin_headers(disabled, database, "admin2@example.com")
+    response = disabled.get("/api/admin/stats", headers={**headers, "X-Profile": "1"})
+    assert response.status_code == 200 and "x-profile-id" not in response.headers
+    assert call(disabled, database.profiles.count_documents, {}) == 0
@@ -0,0 +1,32 @@
+from tests.conftest import call
+
+
+def test_out_of_order_tasks_leave_orders_at_the_current_source_value(make_client, database):
+    client = make_client()
+    worker = client.app.state.scope.propagation_worker
+    call(client, database.companies.insert_one, {"user_id": "co_1", "company_name": "Yeni Ad"})
+    call(client, database.orders.insert_many, [{"order_id": f"ORD-{i}", "company_id": "co_1", "company_name": "Eski Ad", "version": 1} for i in range(3)])
+    call(client, database.orders_archive.insert_one, {"order_id": "ORD-9", "company_id": "co_1", "company_name": "Eski Ad", "version": 4})
+
+    # İki ardışık yeniden adlandırmanın görevleri farklı worker'larda ters sırada çalışır
+    newer = {"task_id": "t2", "kind": "company_name", "match": {"company_id": "co_1"}, "fields": {"company_name": "Yeni Ad"}}
+    older = {"task_id": "t1", "kind": "company_name", "match": {"company_id": "co_1"}, "fields": {"company_name": "Ara Ad"}}
+    call(client, worker._run, newer)
+    call(client, worker._run, older)
+
+    names = {o["company_name"] for o in call(client, database.orders.find({}).to_list, None)}
+    archived = call(client, database.orders_archive.find_one, {"order_id": "ORD-9"})
+    assert names == {"Yeni Ad"}
+    assert archived["company_name"] == "Yeni Ad" and archived["version"] == 5
+
+
+def test_customer_contact_uses_current_user_fields(make_client, database):
+    client = make_client()
+    worker = client.app.state.scope.propagation_worker
+    call(client, database.users.insert_one, {"user_id": "cu_1", "name": "Ayşe Kaya", "phone": "5551112233"})
+    call(client, database.orders.insert_one, {"order_id": "ORD-1", "customer_id": "cu_1", "customer_name": "Ayşe Yılmaz", "customer_phone": "5550000000"})
+
+    call(client, worker._run, {"task_id": "t", "kind": "customer_contact", "match": {"customer_id": "cu_1"}, "fields": {"customer_name": "Ayşe Demir"}})
+    order = call(client, database.orders.find_one, {"order_id": "ORD-1"})
+    # Yalnızca görevdeki alan yayılır, değeri kaynaktan okunur
+    assert order["customer_name"] == "Ayşe Kaya" and order["customer_phone"] == "5550000000"
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+import server
+from tests.conftest import call
+
+
+def age_memory_bucket(limiter, key, seconds):
+    tokens, ts = limiter._buckets[key]
+    limiter._buckets[key] = (tokens, ts - seconds)
+
+
+@pytest.mark.parametrize("backend", ["memory", "mongo"])
+def test_bucket_denies_when_empty_and_refills_at_rate(make_client, database, backend):
+    client = make_client(rate_limit_backend=backend)
+    limiter = client.app.state.scope.rate_limiter
+
+    def age(seconds):
+        # Saati ilerletmek yerine kovanın son dolum zamanı geriye alınır
+        if backend == "memory":
+            age_memory_bucket(limiter, "k", seconds)
+        else:
+            call(client, database.rate_limits.update_one, {"_id": "k"}, {"$inc": {"ts": -seconds}})
+
+    acquire = lambda: call(client, limiter.acquire, "k", 3, 30)
+    assert [acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    retry_after = acquire()
+    assert 9.5 < retry_after <= 10.0  # saniyede 0.1 jeton
+
+    age(10)
+    assert acquire() == 0.0
+    assert acquire() > 0
+
+    # Uzun bekleme kovayı kapasitesinin üstüne doldurmaz
+    age(3600)
+    assert [acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert acquire() > 0
+
+
+def test_memory_limiter_evicts_oldest_buckets():
+    limiter = server.InMemoryRateLimiter(max_keys=2)
+
+    async def fill():
+        for key in ("a", "b", "c"):
+            await limiter.acquire(key, 1, 60)
+        return await limiter.acquire("a", 1, 60)
+
+    # "a" atıldığı için yeni bir kova ile başlar
+    assert asyncio.run(fill()) == 0.0
+    assert list(limiter._buckets) == ["c", "a"]
+
+
+def test_endpoint_returns_429_with_retry_after(make_client):
+    client = make_client(rate_limit_backend="memory")
+    capacity, _ = server.RATE_LIMIT_POLICIES["pricing"]["ip"]
+    for _ in range(capacity):
+        assert client.post("/api/pricing/calculate", json={"carpets": []}).status_code == 200
+    response = client.post("/api/pricing/calculate", json={"carpets": []})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
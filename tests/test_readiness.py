@@ -0,0 +1,33 @@
+import server
+
+
+def test_in_flight_threshold_uses_the_reported_value(make_client):
+    client = make_client(ready_max_in_flight=1, ready_max_checkout_wait_ms=0, ready_max_loop_lag_ms=0, ready_max_ping_ms=10000)
+    scope = client.app.state.scope
+
+    # Başka bir istek sürüyor: readiness isteğiyle birlikte sayaç 2, raporlanan ve eşikle karşılaştırılan 1
+    scope.in_flight_requests += 1
+    try:
+        response = client.get("/api/health/ready")
+        assert response.status_code == 200, response.json()
+        assert response.json()["in_flight_requests"] == 1
+
+        scope.in_flight_requests += 1
+        response = client.get("/api/health/ready")
+        assert response.status_code == 503
+        assert response.json()["failures"] == ["too_many_in_flight"]
+        assert response.json()["in_flight_requests"] == 2
+    finally:
+        scope.in_flight_requests -= 2
+
+
+def test_each_client_reports_to_its_own_pool_listener():
+    settings = server.Settings(mongo_url="mongodb://127.0.0.1:1", db_name="test", profiling_enabled=False)
+    first, second = server.PoolStatsListener(), server.PoolStatsListener()
+    clients = [server.create_mongo_client(settings, listener) for listener in (first, second)]
+    try:
+        assert clients[0].options.event_listeners == [first]
+        assert clients[1].options.event_listeners == [second]
+    finally:
+        for client in clients:
+            client.close()
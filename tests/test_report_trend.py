@@ -0,0 +1,115 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from tests.conftest import admin_headers, call
+
+IST = ZoneInfo(server.REPORT_TIMEZONE)
+
+
+def test_bucket_boundaries():
+    assert server.truncate_to_bucket(datetime(2024, 3, 14, 17, 5, tzinfo=IST), "week") == datetime(2024, 3, 11, tzinfo=IST)
+    assert server.truncate_to_bucket(datetime(2024, 3, 14, 17, 5, tzinfo=IST), "month") == datetime(2024, 3, 1, tzinfo=IST)
+    assert server.next_bucket(datetime(2024, 12, 1, tzinfo=IST), "month") == datetime(2025, 1, 1, tzinfo=IST)
+    assert server.next_bucket(datetime(2024, 2, 28, tzinfo=IST), "day") == datetime(2024, 2, 29, tzinfo=IST)
+
+
+def test_default_range_is_twelve_months_including_the_end_month():
+    start, end = server.resolve_trend_range(None, "2025-02-10T12:00:00")
+    assert start == datetime(2024, 3, 1, tzinfo=IST)
+    assert end == datetime(2025, 2, 10, 12, tzinfo=IST)
+    with pytest.raises(HTTPException):
+        server.resolve_trend_range("2025-03-01", "2025-02-01")
+    with pytest.raises(HTTPException):
+        server.resolve_trend_range("yesterday", None)
+
+
+def stub_aggregate(client, monkeypatch, rows):
+    pipelines = []
+
+    def aggregate(pipeline):
+        pipelines.append(pipeline)
+
+        async def iterate():
+            for row in rows:
+                yield row
+        return iterate()
+
+    monkeypatch.setattr(client.app.state.scope, "analytics_db", SimpleNamespace(orders=SimpleNamespace(aggregate=aggregate)))
+    return pipelines
+
+
+def row(bucket_utc, orders, final_price):
+    # Mongo $dateTrunc sonucunu saat dilimsiz UTC datetime olarak döndürür
+    return {"_id": {"bucket": bucket_utc}, "total_orders": orders, "total_area": 10.0 * orders, "total_price": final_price,
+            "total_discount": 0, "total_final_price": final_price}
+
+
+def test_empty_periods_are_zero_filled_in_istanbul_time(make_client, monkeypatch):
+    client = make_client()
+    # 1 Mart İstanbul = 29 Şubat 21:00 UTC
+    pipelines = stub_aggregate(client, monkeypatch, [row(datetime(2024, 2, 29, 21), 2, 500.0)])
+    start, end = datetime(2024, 1, 15, tzinfo=IST), datetime(2024, 4, 1, tzinfo=IST)
+
+    trend = call(client, server.build_report_trend, "month", start, end)
+    assert [b["bucket"] for b in trend["buckets"]] == [
+        "2024-01-01T00:00:00+03:00", "2024-02-01T00:00:00+03:00", "2024-03-01T00:00:00+03:00", "2024-04-01T00:00:00+03:00",
+    ]
+    assert [b["total_orders"] for b in trend["buckets"]] == [0, 0, 2, 0]
+    assert trend["buckets"][2]["total_final_price"] == 500.0
+    # Aralık UTC string karşılaştırmasıyla eşleşir; sınır anları dahildir
+    match = pipelines[0][0]["$match"]
+    assert match["delivery_date"] == {"$gte": "2024-01-14T21:00:00+00:00", "$lte": "2024-03-31T21:00:00+00:00"}
+
+
+def test_single_instant_range_has_one_bucket_and_large_ranges_are_rejected(make_client, monkeypatch):
+    client = make_client()
+    stub_aggregate(client, monkeypatch, [])
+    moment = datetime(2024, 5, 5, 10, tzinfo=IST)
+    trend = call(client, server.build_report_trend, "week", moment, moment)
+    assert [b["bucket"] for b in trend["buckets"]] == ["2024-04-29T00:00:00+03:00"]
+    assert trend["buckets"][0]["total_orders"] == 0
+
+    with pytest.raises(HTTPException) as error:
+        call(client, server.build_report_trend, "day", datetime(2020, 1, 1, tzinfo=IST), datetime(2024, 1, 1, tzinfo=IST))
+    assert error.value.status_code == 400
+    with pytest.raises(HTTPException):
+        call(client, server.build_report_trend, "year", moment, moment)
+
+
+def test_trend_endpoint_validates_parameters(make_client, database):
+    client = make_client()
+    headers = admin_headers(client, database)
+    assert client.get("/api/admin/reports/trend", params={"unit": "hour"}, headers=headers).status_code == 400
+    assert client.get("/api/admin/reports/trend", params={"start": "2024-05-01", "end": "2024-04-01"}, headers=headers).status_code == 400
+
+
+def test_trend_against_mongo(make_mongo_client):
+    client = make_mongo_client()
+    database = client.app.state.scope.db
+    headers = admin_headers(client, database)
+
+    def delivered(order_id, at, carpets, final_price, discount=0):
+        return {"order_id": order_id, "status": "delivered", "company_id": "co_1", "company_name": "Temiz",
+                "delivery_date": at.astimezone(timezone.utc).isoformat(), "actual_carpets": carpets,
+                "final_price": final_price, "discount_amount": discount}
+
+    call(client, database.orders.insert_many, [
+        # Şubat'ın son anı ve Mart'ın ilk anı (İstanbul) farklı kovalara düşer
+        delivered("A", datetime(2024, 2, 29, 23, 59, 59, tzinfo=IST), [{"carpet_type": "normal", "area": 4, "price": 100}], 90, 10),
+        delivered("B", datetime(2024, 3, 1, 0, 0, 0, tzinfo=IST), [{"carpet_type": "normal", "area": 2, "price": 50}, {"carpet_type": "silk", "area": 3, "price": 150}], 200),
+        delivered("C", datetime(2024, 3, 20, tzinfo=IST), [], 40),
+    ])
+    params = {"unit": "month", "start": "2024-02-01T00:00:00", "end": "2024-03-31T23:59:59"}
+    trend = client.get("/api/admin/reports/trend", params=params, headers=headers).json()
+    assert [(b["bucket"][:7], b["total_orders"], b["total_final_price"]) for b in trend["buckets"]] == [("2024-02", 1, 90), ("2024-03", 2, 240)]
+
+    split = client.get("/api/admin/reports/trend", params={**params, "by_carpet_type": True}, headers=headers).json()
+    march = [b for b in split["buckets"] if b["bucket"].startswith("2024-03")]
+    # Kırılımların toplamı kırılımsız seriyle aynı
+    assert abs(sum(b["total_final_price"] for b in march) - 240) < 1e-9
+    assert {b["carpet_type"]: round(b["total_final_price"], 6) for b in march} == {"normal": 50.0, "silk": 150.0, None: 40.0}
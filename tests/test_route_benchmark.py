@@ -0,0 +1,62 @@
+"""Rota planlama benchmark'ı - saf Python/numpy, ek servis gerektirmez.
+
+    ROUTE_BENCHMARK_STOPS=2000 python -m pytest -q -s tests/test_route_benchmark.py
+
+İlçe merkezlerine dağılmış duraklar için plan süresini ölçer; 2-opt'un süre bütçesine uyduğunu
+ve en yakın komşu rotasını uzatmadığını doğrular."""
+import os
+import random
+import time
+
+import numpy as np
+
+import server
+
+STOP_COUNT = int(os.environ.get("ROUTE_BENCHMARK_STOPS", 600))
+
+
+def make_stops(count, seed=7):
+    rng = random.Random(seed)
+    districts = list(server.DISTRICT_CENTROIDS["İstanbul"].items())
+    stops = []
+    for i in range(count):
+        district, (lat, lon) = rng.choice(districts)
+        stops.append({
+            "order_id": f"ORD-{i:08d}", "type": rng.choice(["pickup", "delivery"]), "district": district,
+            "area_m2": round(rng.uniform(2, 12), 2), "location": (lat + rng.uniform(-0.01, 0.01), lon + rng.uniform(-0.01, 0.01)),
+        })
+    return stops
+
+
+def nearest_neighbour_km(stops, depot, vehicles, capacity):
+    coords = np.array([depot] + [stop["location"] for stop in stops])
+    areas = np.array([0.0] + [stop["area_m2"] for stop in stops])
+    dist = server.distance_matrix_km(coords)
+    routes, _ = server.nearest_neighbour_routes(dist, areas, vehicles, capacity)
+    return sum(float(dist[[0] + route, route + [0]].sum()) for route in routes)
+
+
+def test_plan_routes_respects_time_budget():
+    stops = make_stops(STOP_COUNT)
+    depot = server.DISTRICT_CENTROIDS["İstanbul"]["Kadıköy"]
+    vehicles, capacity = 4, sum(stop["area_m2"] for stop in stops) / 4 + 50
+    budget = 1.0
+
+    started = time.perf_counter()
+    plan = server.plan_routes(stops, depot, vehicles, capacity, time_budget_s=budget)
+    elapsed = time.perf_counter() - started
+    print(f"\n{STOP_COUNT} stops, {vehicles} vehicles: {elapsed:.2f}s, {plan['total_distance_km']} km "
+          f"(nearest neighbour {nearest_neighbour_km(stops, depot, vehicles, capacity):.2f} km)")
+
+    # Bütçe yalnızca 2-opt'u sınırlar; mesafe matrisi ve en yakın komşu için pay bırakılır
+    assert elapsed < budget + 3.0
+    assert not plan["unassigned"]
+    assert sum(len(vehicle["stops"]) for vehicle in plan["vehicles"]) == STOP_COUNT
+    assert plan["total_distance_km"] <= nearest_neighbour_km(stops, depot, vehicles, capacity) + 0.01
+
+
+def test_plan_routes_with_zero_budget_keeps_nearest_neighbour_order():
+    stops = make_stops(50)
+    depot = server.DISTRICT_CENTROIDS["İstanbul"]["Kadıköy"]
+    plan = server.plan_routes(stops, depot, 1, 10_000, time_budget_s=0)
+    assert abs(plan["total_distance_km"] - nearest_neighbour_km(stops, depot, 1, 10_000)) < 0.05
@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+
+import server
+from tests.conftest import call, company_headers
+
+
+def test_routes_only_plan_pickups_booked_for_the_requested_day(make_client, database):
+    client = make_client()
+    headers, company_id = company_headers(client, database)
+    day = datetime(2026, 3, 10, 9)
+    slot = lambda moment: {"slot_id": "slot_x", "start": server.slot_timestamp(moment), "end": server.slot_timestamp(moment + timedelta(hours=2)), "area_m2": 6, "released": False}
+    base = {"company_id": company_id, "city": "İstanbul", "carpets": [{"area": 6}], "created_at": "2026-03-01T00:00:00+00:00"}
+    call(client, database.orders.insert_many, [
+        {**base, "order_id": "ORD-TODAY", "status": "assigned", "district": "Kadıköy", "pickup_slot": slot(day)},
+        {**base, "order_id": "ORD-LATER", "status": "assigned", "district": "Üsküdar", "pickup_slot": slot(day + timedelta(days=1))},
+        {**base, "order_id": "ORD-UNBOOKED", "status": "assigned", "district": "Fatih"},
+        {**base, "order_id": "ORD-READY", "status": "ready", "district": "Şişli", "actual_total_area": 5},
+        {**base, "order_id": "ORD-WASHING", "status": "washing", "district": "Beşiktaş"},
+    ])
+
+    response = client.get("/api/company/routes", params={"date": "2026-03-10"}, headers=headers)
+    assert response.status_code == 200, response.text
+    plan = response.json()
+    stops = {stop["order_id"]: stop for vehicle in plan["vehicles"] for stop in vehicle["stops"]}
+    assert plan["date"] == "2026-03-10"
+    assert set(stops) == {"ORD-TODAY", "ORD-UNBOOKED", "ORD-READY"}
+    assert stops["ORD-TODAY"]["slot_start"] == server.slot_timestamp(day)
+    assert stops["ORD-READY"]["type"] == "delivery"
+
+    assert client.get("/api/company/routes", params={"date": "10.03.2026"}, headers=headers).status_code == 400
@@ -0,0 +1,116 @@
+"""Sipariş araması benchmark'ı - gerçek bir MongoDB gerektirir (mongomock index kullanmaz).
+
+    BENCHMARK_MONGO_URL=mongodb://localhost:27017 BENCHMARK_ORDERS=200000 python -m pytest -q -s tests/test_search_benchmark.py
+
+Geçici bir veritabanına sipariş yükler, arama sorgularının gecikmesini ölçer ve sorgu planında
+koleksiyon taraması (COLLSCAN) ya da bellek içi sıralama (SORT) olmadığını doğrular."""
+import os
+import random
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from starlette.testclient import TestClient
+
+import server
+from tests.conftest import admin_headers, call
+
+MONGO_URL = os.environ.get("BENCHMARK_MONGO_URL")
+ORDER_COUNT = int(os.environ.get("BENCHMARK_ORDERS", 200000))
+pytestmark = pytest.mark.skipif(not MONGO_URL, reason="BENCHMARK_MONGO_URL is not set")
+
+FIRST_NAMES = ["Ayşe", "Mehmet", "Fatma", "Ali", "Zeynep", "Mustafa", "Emine", "Hüseyin", "Elif", "İbrahim"]
+LAST_NAMES = ["Yılmaz", "Kaya", "Demir", "Şahin", "Çelik", "Yıldız", "Öztürk", "Aydın", "Arslan", "Doğan"]
+STATUSES = ["pending", "assigned", "picked_up", "washing", "ready", "delivered", "cancelled"]
+
+
+def plan_stages(plan):
+    stages = [plan.get("stage")]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+
+@pytest.fixture(scope="module")
+def bench():
+    db_name = f"bench_search_{uuid.uuid4().hex[:8]}"
+    settings = server.Settings(mongo_url=MONGO_URL, db_name=db_name, job_workers=0, rate_limit_backend="off", mongo_request_timeout_ms=0)
+    client = TestClient(server.create_app(settings))
+    client.__enter__()
+    database = client.app.state.scope.db
+    rng = random.Random(42)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    locations = [(city, district) for city, districts in server.TURKEY_LOCATIONS.items() for district in districts]
+    for offset in range(0, ORDER_COUNT, 10000):
+        batch = []
+        for i in range(offset, min(offset + 10000, ORDER_COUNT)):
+            city, district = rng.choice(locations)
+            batch.append({
+                "order_id": f"ORD-{i:08d}", "customer_name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+                "customer_phone": f"5{rng.randrange(10**9):09d}", "city": city, "district": district,
+                "status": rng.choice(STATUSES), "company_id": f"user_{rng.randrange(200)}",
+                "created_at": (start + timedelta(seconds=rng.randrange(2 * 365 * 86400))).isoformat(),
+            })
+        call(client, database.orders.insert_many, batch, ordered=False)
+    headers = admin_headers(client, database, "bench-admin@example.com")
+    yield client, database, headers
+    call(client, client.app.state.scope.client.drop_database, db_name)
+    client.__exit__(None, None, None)
+
+
+def measure(client, headers, params, runs=20):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        response = client.get("/api/admin/orders/search", params=params, headers=headers)
+        timings.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1], response.json()
+
+
+@pytest.mark.parametrize("params", [
+    {"phone": "5000000000"},
+    {"name": "Ayşe Y"},
+    {"city": "İstanbul", "district": "Kadıköy", "status": "delivered"},
+    {"status": "pending"},
+    {"company_id": "user_7", "status": "washing"},
+])
+def test_search_latency_and_plan(bench, params):
+    client, database, headers = bench
+    p50, p95, body = measure(client, headers, params)
+    print(f"\n{params}: p50={p50:.1f}ms p95={p95:.1f}ms orders={len(body['orders'])}")
+
+    query = {k: v for k, v in params.items() if k != "name"}
+    query = {{"phone": "customer_phone"}.get(k, k): v for k, v in query.items()}
+    collation = None
+    if "name" in params:
+        query["customer_name"] = {"$gte": params["name"], "$lt": params["name"] + "\uffff"}
+        collation = server.TURKISH_CI_COLLATION
+    cursor = database.orders.find(query, collation=collation).sort([("created_at", -1), ("order_id", -1)]).limit(51)
+    stages = plan_stages(call(client, cursor.explain)["queryPlanner"]["winningPlan"])
+    assert "COLLSCAN" not in stages
+    if "name" not in params:
+        assert "SORT" not in stages
+    assert p95 < 250
+
+
+def test_deep_cursor_pages_stay_flat(bench):
+    client, database, headers = bench
+    params = {"status": "delivered", "page_size": 100}
+    timings = []
+    for _ in range(50):
+        started = time.perf_counter()
+        page = client.get("/api/admin/orders/search", params=params, headers=headers).json()
+        timings.append((time.perf_counter() - started) * 1000)
+        if not page["next_cursor"]:
+            break
+        params["cursor"] = page["next_cursor"]
+    print(f"\nfirst page {timings[0]:.1f}ms, page {len(timings)} {timings[-1]:.1f}ms")
+    # skip/limit'in aksine son sayfa ilk sayfadan belirgin biçimde yavaş olmamalı
+    assert statistics.median(timings[-5:]) < 3 * statistics.median(timings[:5]) + 20
@@ -0,0 +1,39 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import server
+from tests.conftest import call
+
+
+def future_slot(**overrides):
+    start = datetime.now(timezone.utc) + timedelta(days=2)
+    return {
+        "slot_id": "slot_1", "company_id": "co_1", "city": "İstanbul", "districts": ["Kadıköy", "Üsküdar"],
+        "start": server.slot_timestamp(start), "end": server.slot_timestamp(start + timedelta(hours=2)),
+        "capacity_m2": 100.0, "reserved_m2": 0.0, **overrides,
+    }
+
+
+def test_concurrent_reservations_never_overbook(make_client, database):
+    client = make_client()
+    call(client, database.slots.insert_one, future_slot())
+
+    async def stress():
+        areas = [7.5, 3.0, 12.0, 5.5] * 25
+        return await asyncio.gather(*(server.reserve_slot("slot_1", "İstanbul", "Kadıköy", area) for area in areas)), areas
+
+    results, areas = call(client, stress)
+    granted = sum(area for area, slot in zip(areas, results) if slot)
+    slot = call(client, database.slots.find_one, {"slot_id": "slot_1"})
+    assert granted <= 100.0
+    assert abs(slot["reserved_m2"] - granted) < 1e-9
+    # Kalan kapasite en küçük istekten azdır; aksi halde reddedilen bir istek sığardı
+    assert 100.0 - granted < min(areas)
+
+
+def test_reservation_requires_a_served_district_and_city(make_client, database):
+    client = make_client()
+    call(client, database.slots.insert_one, future_slot())
+    assert call(client, server.reserve_slot, "slot_1", "İstanbul", "Fatih", 5.0) is None
+    assert call(client, server.reserve_slot, "slot_1", "Ankara", "Kadıköy", 5.0) is None
+    assert call(client, server.reserve_slot, "slot_1", "İstanbul", "Üsküdar", 5.0)["reserved_m2"] == 5.0
@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta, timezone
+
+import pyarrow.dataset as ds
+
+import server
+from tests.conftest import call
+
+
+def order(i, updated_at, **extra):
+    return {
+        "order_id": f"ORD-{i:04d}", "customer_name": f"Müşteri {i}", "city": "İzmir", "status": "pending",
+        "created_at": "2026-01-10T08:00:00+00:00", "updated_at": updated_at,
+        "carpets": [{"carpet_type": "Makine Halısı", "width": 2, "length": 3, "area": 6}], **extra,
+    }
+
+
+def test_parts_share_one_schema_when_a_batch_has_only_nulls(make_client, database, tmp_path):
+    client = make_client()
+    now = datetime.now(timezone.utc)
+    # İlk parçada cancel_reason/final_price hep boş, ikincide dolu
+    call(client, database.orders.insert_many, [
+        order(1, (now - timedelta(hours=2)).isoformat()),
+        order(2, (now - timedelta(hours=1)).isoformat(), status="cancelled", cancel_reason="Müşteri vazgeçti", final_price=120.0,
+              cancelled_at=now.isoformat(), actual_carpets=[{"carpet_type": "Yün Halı", "area": 4.0, "price": 120.0}]),
+    ])
+    call(client, server.run_orders_snapshot, tmp_path, 1)
+
+    orders = ds.dataset(tmp_path / "orders", format="parquet", partitioning="hive").to_table()
+    assert orders.num_rows == 2
+    assert orders.schema.field("cancel_reason").type == "string"
+    assert orders.schema.field("cancelled_at").type == server.SNAPSHOT_TIMESTAMP
+    assert sorted(v for v in orders.column("cancel_reason").to_pylist() if v) == ["Müşteri vazgeçti"]
+    carpets = ds.dataset(tmp_path / "order_carpets", format="parquet", partitioning="hive").to_table()
+    assert carpets.schema.field("price").type == "double"
+
+
+def test_watermark_lags_the_run_so_late_updates_are_picked_up(make_client, database, tmp_path):
+    client = make_client()
+    now = datetime.now(timezone.utc)
+    call(client, database.orders.insert_one, order(1, (now - timedelta(hours=1)).isoformat()))
+    first = call(client, server.run_orders_snapshot, tmp_path, 100, 300)
+    assert first["orders"] == 1
+    assert first["watermark"] <= (now - timedelta(seconds=290)).isoformat()
+
+    # Önceki çalıştırma sırasında damgalanmış ama o an görünmeyen (geç commit) bir güncelleme
+    call(client, database.orders.insert_one, order(2, (now - timedelta(seconds=30)).isoformat()))
+    second = call(client, server.run_orders_snapshot, tmp_path, 100, 300)
+    assert second["incremental"]
+    assert second["orders"] == 1 and second["watermark"] >= first["watermark"]